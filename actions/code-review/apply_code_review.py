@@ -2,9 +2,10 @@ import json
 import sys
 import os
 
-from github import Github
 import traceback
 
+from github_client import get_github
+
 
 def process_json_data(json_string, pr, last_commit):
     try:
@@ -53,14 +54,14 @@ def process_json_data(json_string, pr, last_commit):
 
 def main():
     """Main function to process the JSON data and post comments to the PR."""
-    g = Github(os.environ["GITHUB_TOKEN"])
+    g = get_github(os.environ["GITHUB_TOKEN"])
     repo = g.get_repo(os.environ["GITHUB_REPOSITORY"])
     pr = repo.get_pull(int(os.environ["GITHUB_EVENT_NUMBER"]))
 
     review_data = sys.argv[1]
 
     try:
-        last_commit = list(pr.get_commits())[-1]
+        last_commit = repo.get_commit(pr.head.sha)
 
         with open(review_data) as f:
             review_data = f.read()
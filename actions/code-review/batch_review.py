@@ -0,0 +1,267 @@
+"""Review the open pull requests of several repositories with a single batch of requests, e.g. nightly.
+
+The input of each pull request is gathered like in `review_pipeline.py`, concurrently for several pull requests.
+The requests of all reviews (one per shard) are submitted as one job to the Message Batches API, which processes
+them asynchronously at a lower price. When the batch has ended, the answers are posted to their pull requests
+like by `code_review_bot.py`.
+
+The progress is stored in a state file, so an interrupted run is resumed by running the script again: a batch
+that was already submitted is not submitted again, and reviews that were already posted are not posted again.
+The state is saved before the batch is created; if the run is interrupted before the ID of the batch is saved,
+the batch is looked up among the latest batches. The state file is removed when all reviews are posted.
+
+Pull requests that are drafts, or whose head commit was already reviewed, are skipped.
+
+Required arguments:
+- names of the repositories, e.g. 'MannLabs/alphadia MannLabs/alphabase'
+
+Required environment:
+- GITHUB_TOKEN, ANTHROPIC_API_KEY, CODE_REVIEW_PROMPT, CODE_REVIEW_SYSTEM_MESSAGE: cf. `code_review_bot.py`.
+
+Optional environment:
+- BATCH_REVIEW_STATE: Path of the state file (default: 'batch_review_state.json').
+- BATCH_REVIEW_LABEL: Only review pull requests with this label, e.g. 'code-review' (default: all).
+- BATCH_REVIEW_POLL_SECONDS: Interval between checks whether the batch has ended (default: 60).
+- ANTHROPIC_BASE_URL: URL of the Anthropic API, e.g. of a local fake for testing.
+- CODE_REVIEW_CACHE_DIR, CODE_REVIEW_CACHE_MAX_MB: Configuration of the cache, cf. `blob_cache.py`.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+from github.PullRequest import PullRequest
+from github.Repository import Repository
+
+from code_review_bot import CodeReviewBot
+from notebooks import is_notebook
+from review_pipeline import ReviewPipeline
+
+STATE_PATH = os.environ.get("BATCH_REVIEW_STATE", "batch_review_state.json")
+LABEL = os.environ.get("BATCH_REVIEW_LABEL")
+POLL_SECONDS = float(os.environ.get("BATCH_REVIEW_POLL_SECONDS", 60))
+
+MAX_CONCURRENT_PULL_REQUESTS = 4  # whose input is gathered at the same time
+
+# parts of the plan of a review that are needed to post the answers, cf. `CodeReviewBot.finish_review()`
+PLAN_KEYS = [
+    "review_instructions",
+    "config",
+    "line_index",
+    "head_sha",
+    "last_reviewed_sha",
+    "untrimmed_tokens",
+    "trimmed_tokens",
+    "adapted_notes",
+]
+
+# tolerance for the clocks of the runner and the API, when looking up the batch of an interrupted submission
+CLOCK_SKEW_SECONDS = 300
+
+STATUS_PENDING = "pending"
+STATUS_POSTED = "posted"
+STATUS_SKIPPED = "skipped"
+
+
+def _to_state_plan(plan: dict) -> dict:
+    state_plan = {key: plan[key] for key in PLAN_KEYS}
+    # the lines of notebooks are mapped to their cells, cf. `diff_index.py`
+    state_plan["line_index"] = {
+        path: sorted(lines.items() if isinstance(lines, dict) else lines)
+        for path, lines in plan["line_index"].items()
+    }
+    return state_plan
+
+
+def _from_state_plan(state_plan: dict) -> dict:
+    line_index = {
+        path: {line: cell for line, cell in lines} if is_notebook(path) else set(lines)
+        for path, lines in state_plan["line_index"].items()
+    }
+    return {**state_plan, "line_index": line_index}
+
+
+class BatchReviewer:
+    """Review many pull requests with a single, resumable batch of requests."""
+
+    def __init__(
+        self,
+        state_path: str = STATE_PATH,
+        anthropic_client=None,
+        github_client=None,
+        poll_seconds: float = POLL_SECONDS,
+    ):
+        self.state_path = state_path
+        self.poll_seconds = poll_seconds
+        self.bot = CodeReviewBot(anthropic_client, github_client)
+        # the answers to many pull requests are not written to the same files
+        self.bot.github_workspace_path = None
+
+    def _load_state(self) -> dict | None:
+        if not os.path.isfile(self.state_path):
+            return None
+        with open(self.state_path) as infile:
+            # None for the empty state that marks a complete run, cf. `batch_review.yml`
+            return json.load(infile)
+
+    def _save_state(self, state: dict) -> None:
+        # replaced atomically, so an interruption does not leave a broken state file
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w") as outfile:
+            json.dump(state, outfile)
+        os.replace(temp_path, self.state_path)
+
+    def _get_pull_requests(self, repo_names: list[str]) -> list[tuple[Repository, PullRequest]]:
+        """Get the open pull requests to review."""
+        pull_requests = []
+        for repo_name in repo_names:
+            repo = self.bot.github_client.get_repo(repo_name)
+            for pull_request in repo.get_pulls(state="open"):
+                if pull_request.draft:
+                    continue
+                if LABEL and LABEL not in [label.name for label in pull_request.labels]:
+                    continue
+                if self.bot.get_last_reviewed_sha(pull_request) == pull_request.head.sha:
+                    print(f"Skipping {repo_name}#{pull_request.number}, its head commit was already reviewed")
+                    continue
+                pull_requests.append((repo, pull_request))
+        print(f"Found {len(pull_requests)} pull requests to review in {len(repo_names)} repositories")
+        return pull_requests
+
+    async def _gather_inputs(self, pull_requests: list[tuple[Repository, PullRequest]]) -> list[tuple[str, str, str]]:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_PULL_REQUESTS)
+
+        async def get_input(repo: Repository, pull_request: PullRequest) -> tuple[str, str, str]:
+            async with semaphore:
+                # the definitions would need a checkout of each repository
+                pipeline = ReviewPipeline(
+                    repo.full_name, pull_request.number, symbol_context_tokens=0, write_side_outputs=False
+                )
+                return await pipeline.get_input()
+
+        return await asyncio.gather(*(get_input(repo, pull_request) for repo, pull_request in pull_requests))
+
+    def submit(self, repo_names: list[str]) -> dict | None:
+        """Gather the input of the pull requests, and submit the requests of their reviews as one batch.
+
+        Returns the state of the batch, or None if there is nothing to review.
+        """
+        pull_requests = self._get_pull_requests(repo_names)
+        inputs = asyncio.run(self._gather_inputs(pull_requests))
+
+        # the custom IDs are unique to this submission, so the results of another batch are never posted
+        submission_id = uuid.uuid4().hex[:16]
+        reviews, requests = [], []
+        for (repo, pull_request), (patches_str, changed_files_str, definitions_str) in zip(pull_requests, inputs):
+            plan = self.bot.prepare_review(changed_files_str, patches_str, repo, pull_request, definitions_str)
+            if plan is None:
+                continue
+            custom_ids = []
+            for params in self.bot.get_batch_request_params(plan):
+                custom_ids.append(custom_id := f"{submission_id}-{len(requests)}")
+                requests.append({"custom_id": custom_id, "params": params})
+            reviews.append(
+                {
+                    "repo_name": repo.full_name,
+                    "pr_number": pull_request.number,
+                    "custom_ids": custom_ids,
+                    "plan": _to_state_plan(plan),
+                    "status": STATUS_PENDING,
+                }
+            )
+
+        if not requests:
+            print("Nothing to review")
+            return None
+
+        # saved before the batch is created, so an interrupted run does not create (and pay for) it again
+        state = {"batch_id": None, "submitted_at": time.time(), "num_requests": len(requests), "reviews": reviews}
+        self._save_state(state)
+        batch = self.bot.anthropic_client.messages.batches.create(requests=requests)
+        print(f"Submitted batch {batch.id} with {len(requests)} requests for {len(reviews)} pull requests")
+        state["batch_id"] = batch.id
+        self._save_state(state)
+        return state
+
+    def _find_submitted_batch(self, state: dict) -> str | None:
+        """Get the ID of the batch of an interrupted submission, or None if the batch was not created."""
+        # the latest batches first
+        for batch in self.bot.anthropic_client.messages.batches.list(limit=20):
+            if batch.created_at.timestamp() < state["submitted_at"] - CLOCK_SKEW_SECONDS:
+                break
+            counts = batch.request_counts
+            num_requests = counts.processing + counts.succeeded + counts.errored + counts.canceled + counts.expired
+            if num_requests == state["num_requests"]:
+                return batch.id
+        return None
+
+    def wait(self, batch_id: str) -> None:
+        """Wait until the processing of a batch has ended."""
+        while (batch := self.bot.anthropic_client.messages.batches.retrieve(batch_id)).processing_status != "ended":
+            print(f"Batch {batch_id} is {batch.processing_status}: {batch.request_counts}")
+            time.sleep(self.poll_seconds)
+        print(f"Batch {batch_id} has ended: {batch.request_counts}")
+
+    def post_results(self, state: dict) -> None:
+        """Post the answers of an ended batch to the pull requests whose reviews were not posted yet."""
+        messages = {}
+        for response in self.bot.anthropic_client.messages.batches.results(state["batch_id"]):
+            if response.result.type == "succeeded":
+                messages[response.custom_id] = response.result.message
+            else:
+                print(f"Request {response.custom_id} {response.result.type}")
+
+        for review in state["reviews"]:
+            if review["status"] != STATUS_PENDING:
+                continue
+
+            name = f"{review['repo_name']}#{review['pr_number']}"
+            pull_request = self.bot.github_client.get_repo(review["repo_name"]).get_pull(review["pr_number"])
+            # the summary of the stage timings is limited to the posting of this review
+            plan = {**_from_state_plan(review["plan"]), "start_time": time.time()}
+            if any(custom_id not in messages for custom_id in review["custom_ids"]):
+                print(f"Skipping {name}, not all of its requests succeeded")
+                review["status"] = STATUS_SKIPPED
+            elif pull_request.head.sha != plan["head_sha"]:
+                # the comments would be placed on lines of the new head commit
+                print(f"Skipping {name}, it was updated after the batch was submitted")
+                review["status"] = STATUS_SKIPPED
+            else:
+                try:
+                    self.bot.finish_review(
+                        pull_request, plan, [messages[custom_id] for custom_id in review["custom_ids"]]
+                    )
+                    review["status"] = STATUS_POSTED
+                except Exception as e:
+                    print(f"Error posting the review of {name}: {e}")
+                    review["status"] = STATUS_SKIPPED
+            self._save_state(state)
+
+        num_posted = sum(review["status"] == STATUS_POSTED for review in state["reviews"])
+        print(f"Posted {num_posted} of {len(state['reviews'])} reviews")
+
+    def run(self, repo_names: list[str]) -> None:
+        """Review the open pull requests of the repositories, or resume an interrupted run."""
+        if (state := self._load_state()) is not None and state["batch_id"] is None:
+            if (batch_id := self._find_submitted_batch(state)) is None:
+                print("The batch of the interrupted submission was not created, submitting again")
+                state = None
+            else:
+                state["batch_id"] = batch_id
+                self._save_state(state)
+
+        if state is not None:
+            print(f"Resuming batch {state['batch_id']} from '{self.state_path}'")
+        elif (state := self.submit(repo_names)) is None:
+            return
+
+        self.wait(state["batch_id"])
+        self.post_results(state)
+        os.remove(self.state_path)
+
+
+if __name__ == "__main__":
+    BatchReviewer().run(" ".join(sys.argv[1:]).split())
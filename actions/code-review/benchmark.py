@@ -0,0 +1,724 @@
+"""Offline end-to-end benchmark of the code review pipeline.
+
+Runs the stages of the action against synthetic pull requests of different sizes:
+- `pr_to_string.py` and `files_to_string.py`, executed like in the workflow,
+- `CodeReviewBot.process_pull_request`,
+or, with `--single-process`, `review_pipeline.py` instead of all of them,
+or, with `--batch`, `batch_review.py` instead of all of them,
+with a local fake of the GitHub REST API (served over HTTP, so the real PyGithub client is used)
+and a fake Anthropic client with adjustable latency and output size.
+For each stage, the wall time, the peak memory (of Python allocations, cf. `tracemalloc`),
+the number of API calls and the number of input tokens sent to the model are reported.
+
+Usage:
+    python benchmark.py --num-files 1 10 100 500 --runs 2 --output results.json
+
+Optional environment:
+- CODE_REVIEW_CACHE_DIR, CODE_REVIEW_CACHE_MAX_MB: Configuration of the cache, cf. `blob_cache.py`.
+    If set, the runs after the first one of each pull request are warm.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import difflib
+import hashlib
+import json
+import os
+import random
+import re
+import runpy
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from anthropic.types import Message, TextBlock, ToolUseBlock, Usage
+
+from batch_review import BatchReviewer
+from blob_cache import git_blob_sha
+from code_review_bot import REVIEW_TOOL_NAME, CodeReviewBot
+from diff_index import build_line_index
+from review_pipeline import ReviewPipeline
+from sharding import estimate_tokens
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+REPO_NAME = "benchmark/repo"
+PR_NUMBER = 1
+BOT_LOGIN = "benchmark-bot"
+
+STAGE_PR_TO_STRING = "pr_to_string"
+STAGE_FILES_TO_STRING = "files_to_string"
+STAGE_CODE_REVIEW_BOT = "code_review_bot"
+STAGE_REVIEW_PIPELINE = "review_pipeline"
+STAGE_BATCH_REVIEW = "batch_review"
+
+
+def _git(repo_path: str, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", *args],
+        cwd=repo_path,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+
+
+def _create_file_content(rng: random.Random, num_lines: int) -> list[str]:
+    lines = []
+    while len(lines) < num_lines:
+        i = len(lines)
+        lines.extend(
+            [
+                f"def function_{i}(x):",
+                f'    """Compute value {i}."""',
+                f"    y = x * {rng.randint(1, 100)}",
+                f"    return y + {rng.randint(1, 100)}",
+                "",
+            ]
+        )
+    return lines[:num_lines]
+
+
+def _modify_file_content(rng: random.Random, lines: list[str]) -> list[str]:
+    """Change one line and add one line in every block of 25 lines."""
+    new_lines = []
+    for start in range(0, len(lines), 25):
+        block = list(lines[start : start + 25])
+        block[rng.randrange(len(block))] = f"    z = {rng.randint(1, 100)}  # changed"
+        block.insert(rng.randrange(len(block) + 1), f"    # added {rng.randint(1, 100)}")
+        new_lines.extend(block)
+    return new_lines
+
+
+def _create_patch(original_content: str, new_content: str) -> str:
+    """Create a patch in the format of `File.patch`, i.e. the hunks of a unified diff without file headers."""
+    diff = difflib.unified_diff(original_content.splitlines(), new_content.splitlines(), lineterm="")
+    return "\n".join(list(diff)[2:])
+
+
+class SyntheticPullRequest:
+    """A pull request modifying `num_files` files, as a git repository with a base and a head commit.
+
+    Like in the action when the changed files are dumped, the working tree of `repo_path` is at the base commit.
+    For a fraction of the files, the (fake) GitHub API provides no patch, like for large files.
+    """
+
+    def __init__(
+        self, repo_path: str, num_files: int, lines_per_file: int, no_patch_fraction: float, seed: int
+    ):
+        rng = random.Random(seed)
+        self.repo_path = repo_path
+        self.file_names = [f"src/module_{i:04d}.py" for i in range(num_files)]
+
+        base_contents = {
+            name: "\n".join(_create_file_content(rng, lines_per_file)) + "\n" for name in self.file_names
+        }
+        head_contents = {
+            name: "\n".join(_modify_file_content(rng, content.splitlines())) + "\n"
+            for name, content in base_contents.items()
+        }
+
+        os.makedirs(os.path.join(repo_path, "src"), exist_ok=True)
+        _git(repo_path, "init", "--quiet")
+        self.base_sha = self._commit(base_contents, "base")
+        self.head_sha = self._commit(head_contents, "head")
+        _git(repo_path, "checkout", "--quiet", self.base_sha)
+
+        self.blobs = {}  # content by blob SHA
+        self.base_tree = {}  # blob SHA by path
+        for name, content in base_contents.items():
+            self.base_tree[name] = sha = git_blob_sha(content.encode())
+            self.blobs[sha] = content.encode()
+
+        self.files = []  # file data as returned by the API
+        for name in self.file_names:
+            data = head_contents[name].encode()
+            self.blobs[sha := git_blob_sha(data)] = data
+            patch = _create_patch(base_contents[name], head_contents[name])
+            additions = sum(line.startswith("+") for line in patch.split("\n"))
+            deletions = sum(line.startswith("-") for line in patch.split("\n"))
+            file = {
+                "sha": sha,
+                "filename": name,
+                "status": "modified",
+                "additions": additions,
+                "deletions": deletions,
+                "changes": additions + deletions,
+            }
+            if rng.random() >= no_patch_fraction:
+                file["patch"] = patch
+            self.files.append(file)
+
+    def _commit(self, contents: dict[str, str], message: str) -> str:
+        for name, content in contents.items():
+            with open(os.path.join(self.repo_path, name), "w") as outfile:
+                outfile.write(content)
+        _git(self.repo_path, "add", "--all")
+        _git(self.repo_path, "commit", "--quiet", "-m", message)
+        return _git(self.repo_path, "rev-parse", "HEAD")
+
+
+class FakeGitHub:
+    """Local fake of the GitHub REST API, serving synthetic pull requests with the numbers 1, 2, ...
+
+    Only the endpoints used by the action are implemented. Responses to GET requests carry an ETag and
+    conditional requests are answered with `304 Not Modified`, like by GitHub.
+    """
+
+    def __init__(self, prs: list[SyntheticPullRequest], pr_description: str, latency: float):
+        self.prs = dict(enumerate(prs, start=PR_NUMBER))  # by number
+        self.pr_description = pr_description
+        self.latency = latency
+
+        self.requests = Counter()  # by route
+        self.num_not_modified = 0
+        self.issue_comments = {number: [] for number in self.prs}
+        self.num_review_comments = Counter()  # by number
+        self._lock = threading.Lock()
+
+        fake_github = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake_github._handle(self, "GET")
+
+            def do_POST(self):
+                fake_github._handle(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._repo_url = f"{self.url}/repos/{REPO_NAME}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.requests.clear()
+            self.num_not_modified = 0
+
+    def reset_comments(self) -> None:
+        with self._lock:
+            self.issue_comments = {number: [] for number in self.prs}
+            self.num_review_comments.clear()
+
+    def _handle(self, handler: BaseHTTPRequestHandler, verb: str) -> None:
+        time.sleep(self.latency)
+
+        url = urlparse(handler.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        route, status, data = self._route(verb, url.path, query, json.loads(body) if body else None)
+
+        text = json.dumps(data)
+        etag = f'"{hashlib.sha1(text.encode()).hexdigest()}"'
+        not_modified = verb == "GET" and handler.headers.get("If-None-Match") == etag
+        with self._lock:
+            self.requests[f"{verb} {route}"] += 1
+            self.num_not_modified += not_modified
+
+        handler.send_response(304 if not_modified else status)
+        handler.send_header("ETag", etag)
+        handler.send_header("Content-Type", "application/json; charset=utf-8")
+        handler.send_header("Content-Length", "0" if not_modified else str(len(text.encode())))
+        handler.end_headers()
+        if not not_modified:
+            handler.wfile.write(text.encode())
+
+    def _get_repo_data(self) -> dict:
+        return {
+            "id": 1,
+            "name": REPO_NAME.split("/")[1],
+            "full_name": REPO_NAME,
+            "owner": {"login": REPO_NAME.split("/")[0]},
+            "url": self._repo_url,
+        }
+
+    def _get_pull_data(self, number: int) -> dict:
+        pr = self.prs[number]
+        return {
+            "id": number,
+            "number": number,
+            "url": f"{self._repo_url}/pulls/{number}",
+            "issue_url": f"{self._repo_url}/issues/{number}",
+            "body": self.pr_description,
+            "changed_files": len(pr.files),
+            "draft": False,
+            "labels": [],
+            "head": {"sha": pr.head_sha, "repo": self._get_repo_data()},
+            "base": {"sha": pr.base_sha, "repo": self._get_repo_data()},
+        }
+
+    def _get_blob_data(self, sha: str, blob: bytes) -> dict:
+        return {
+            "sha": sha,
+            "size": len(blob),
+            "encoding": "base64",
+            "content": base64.b64encode(blob).decode(),
+        }
+
+    def _find_pr(self, sha: str) -> SyntheticPullRequest | None:
+        """Get the pull request with this base or head commit."""
+        return next((pr for pr in self.prs.values() if sha in (pr.base_sha, pr.head_sha)), None)
+
+    def _route(self, verb: str, path: str, query: dict, body: dict | None) -> tuple[str, int, object]:
+        """Get the name of the route, the status and the data of the response to a request."""
+        prefix = f"/repos/{REPO_NAME}"
+        url_path, path = path, path[len(prefix) :] if path.startswith(prefix) else None
+
+        if path == "" and verb == "GET":
+            return "/repos/{repo}", 200, self._get_repo_data()
+
+        if path == "/pulls" and verb == "GET":
+            data = [self._get_pull_data(number) for number in self.prs] if int(query.get("page", 1)) == 1 else []
+            return "/pulls", 200, data
+
+        if path is None and url_path == "/user" and verb == "GET":
+            return "/user", 200, {"login": BOT_LOGIN}
+
+        match = re.fullmatch(r"/(pulls|issues)/(\d+)(/.*)?", path or "")
+        if match and int(match.group(2)) in self.prs:
+            return self._route_pull(verb, match.group(1), int(match.group(2)), match.group(3) or "", query, body)
+
+        if path is not None and (match := re.fullmatch(r"/compare/([0-9a-f]{40})\.\.\.([0-9a-f]{40})", path)):
+            if (pr := self._find_pr(match.group(1))) is not None:
+                # the synthetic pull requests branch off their base commits
+                merge_base_commit = {"sha": pr.base_sha, "url": f"{self._repo_url}/commits/{pr.base_sha}"}
+                data = {"status": "ahead", "merge_base_commit": merge_base_commit, "files": pr.files}
+                return "/compare/{basehead}", 200, data
+
+        if path is not None and (match := re.fullmatch(r"/commits/([0-9a-f]{40})", path)):
+            return "/commits/{sha}", 200, {"sha": match.group(1), "url": f"{self._repo_url}{path}"}
+
+        if path is not None and (match := re.fullmatch(r"/git/trees/([0-9a-f]{40})", path)):
+            if (pr := self._find_pr(match.group(1))) is not None and match.group(1) == pr.base_sha:
+                tree = [
+                    {"path": name, "mode": "100644", "type": "blob", "sha": sha}
+                    for name, sha in pr.base_tree.items()
+                ]
+                return "/git/trees/{sha}", 200, {"sha": pr.base_sha, "tree": tree, "truncated": False}
+
+        if path is not None and (match := re.fullmatch(r"/git/blobs/([0-9a-f]{40})", path)):
+            sha = match.group(1)
+            if (blob := next((pr.blobs[sha] for pr in self.prs.values() if sha in pr.blobs), None)) is not None:
+                return "/git/blobs/{sha}", 200, self._get_blob_data(sha, blob)
+
+        if path is not None and path.startswith("/contents/"):
+            file_name = unquote(path[len("/contents/") :])
+            ref = query.get("ref")
+            if (pr := self._find_pr(ref)) is not None:
+                sha = (
+                    pr.base_tree.get(file_name)
+                    if ref == pr.base_sha
+                    else next((f["sha"] for f in pr.files if f["filename"] == file_name), None)
+                )
+                if sha is not None:
+                    data = {"type": "file", "name": os.path.basename(file_name), "path": file_name}
+                    return "/contents/{path}", 200, {**data, **self._get_blob_data(sha, pr.blobs[sha])}
+
+        return "unknown", 404, {"message": "Not Found"}
+
+    def _route_pull(
+        self, verb: str, kind: str, number: int, path: str, query: dict, body: dict | None
+    ) -> tuple[str, int, object]:
+        """Route the requests for a pull request, or for its issue."""
+        if kind == "pulls" and path == "" and verb == "GET":
+            return "/pulls/{number}", 200, self._get_pull_data(number)
+
+        if kind == "pulls" and path == "/files" and verb == "GET":
+            per_page = int(query.get("per_page", 30))
+            page = int(query.get("page", 1))
+            return "/pulls/{number}/files", 200, self.prs[number].files[(page - 1) * per_page : page * per_page]
+
+        if kind == "pulls" and path == "/comments" and verb == "POST":
+            with self._lock:
+                self.num_review_comments[number] += 1
+            return "/pulls/{number}/comments", 201, {"id": 1, **body}
+
+        if kind == "pulls" and path == "/reviews" and verb == "POST":
+            with self._lock:
+                self.num_review_comments[number] += len(body.get("comments", []))
+            return "/pulls/{number}/reviews", 200, {"id": 1, "body": body.get("body")}
+
+        if kind == "issues" and path == "/comments":
+            issue_comments = self.issue_comments[number]
+            if verb == "POST":
+                with self._lock:
+                    issue_comments.append({"id": len(issue_comments) + 1, "user": {"login": BOT_LOGIN}, **body})
+                return "/issues/{number}/comments", 201, issue_comments[-1]
+            return "/issues/{number}/comments", 200, issue_comments
+
+        return "unknown", 404, {"message": "Not Found"}
+
+
+class _FakeStream:
+    """Fake of `anthropic.MessageStreamManager` and `anthropic.MessageStream`."""
+
+    CHUNK_CHARS = 64
+
+    def __init__(self, message: Message, latency: float, tokens_per_second: float):
+        self._message = message
+        self._latency = latency
+        self._tokens_per_second = tokens_per_second
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        time.sleep(self._latency)
+        block = self._message.content[0]
+        text = block.text if block.type == "text" else json.dumps(block.input)
+        for start in range(0, len(text), self.CHUNK_CHARS):
+            chunk = text[start : start + self.CHUNK_CHARS]
+            time.sleep(estimate_tokens(chunk) / self._tokens_per_second)
+            if block.type == "text":
+                yield SimpleNamespace(type="text", text=chunk)
+            else:
+                yield SimpleNamespace(type="input_json", partial_json=chunk)
+
+    @property
+    def text_stream(self):
+        return (event.text for event in self if event.type == "text")
+
+    def get_final_message(self) -> Message:
+        return self._message
+
+
+class FakeMessages:
+    """Fake of `anthropic.Client.messages`, answering with review comments on the patches of the request.
+
+    If tools are given, the comments are submitted with a call of the review tool. Each answer takes `latency` seconds until the first token, plus the time to generate the output tokens.
+    """
+
+    def __init__(self, latency: float, tokens_per_second: float, num_comments: int, comment_chars: int):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.num_comments = num_comments
+        self.comment_chars = comment_chars
+        self.num_requests = 0
+        self.num_input_tokens = 0
+        self._lock = threading.Lock()
+
+    def _get_answer(self, params: dict) -> Message:
+        texts = [params["system"] if isinstance(params["system"], str) else params["system"][0]["text"]]
+        for message in params["messages"]:
+            content = message["content"]
+            texts.extend([content] if isinstance(content, str) else [block["text"] for block in content])
+
+        line_index = build_line_index("\n".join(texts))
+        file_names = [name for name, lines in line_index.items() if lines]
+        items = []
+        for i in range(min(self.num_comments, len(file_names))):
+            lines = sorted(line_index[file_names[i]])
+            items.append(
+                {
+                    "change_id": i,
+                    "file_name": f"./{file_names[i]}",
+                    "start_line": lines[len(lines) // 2],
+                    "comment": ("Consider renaming this. " * self.comment_chars)[: self.comment_chars],
+                    "proposed_code": "pass",
+                }
+            )
+        text = json.dumps(items, indent=2)
+
+        content = [TextBlock(type="text", text=text)]
+        if "tools" in params:
+            content = [ToolUseBlock(type="tool_use", id="toolu_benchmark", name=REVIEW_TOOL_NAME, input={"items": items})]
+
+        stop_reason = "tool_use" if "tools" in params else "end_turn"
+        if estimate_tokens(text) > params["max_tokens"]:
+            text = text[: params["max_tokens"] * 4]
+            # the input of a truncated tool call is incomplete and therefore not parsed
+            content = [content[0].model_copy(update={"input": {}} if "tools" in params else {"text": text})]
+            stop_reason = "max_tokens"
+
+        input_tokens = sum(estimate_tokens(text) for text in texts)
+        with self._lock:
+            self.num_requests += 1
+            self.num_input_tokens += input_tokens
+
+        return Message(
+            id="msg_benchmark",
+            type="message",
+            role="assistant",
+            model=params["model"],
+            content=content,
+            stop_reason=stop_reason,
+            stop_sequence=None,
+            usage=Usage(
+                input_tokens=input_tokens,
+                output_tokens=estimate_tokens(text),
+                cache_creation_input_tokens=0,
+                cache_read_input_tokens=0,
+            ),
+        )
+
+    def create(self, **params) -> Message:
+        message = self._get_answer(params)
+        time.sleep(self.latency + message.usage.output_tokens / self.tokens_per_second)
+        return message
+
+    def stream(self, **params) -> _FakeStream:
+        return _FakeStream(self._get_answer(params), self.latency, self.tokens_per_second)
+
+
+class FakeBatches:
+    """Fake of `anthropic.Client.messages.batches`, whose batches end after the latency of a single request."""
+
+    def __init__(self, messages: FakeMessages):
+        self._messages = messages
+        self._batches = {}  # end time and responses by ID
+
+    def create(self, requests: list[dict]) -> SimpleNamespace:
+        responses = [
+            SimpleNamespace(
+                custom_id=request["custom_id"],
+                result=SimpleNamespace(type="succeeded", message=self._messages._get_answer(request["params"])),
+            )
+            for request in requests
+        ]
+        batch_id = f"msgbatch_benchmark_{len(self._batches)}"
+        self._batches[batch_id] = (time.perf_counter() + self._messages.latency, responses)
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id: str) -> SimpleNamespace:
+        end_time, responses = self._batches[batch_id]
+        num_ended = len(responses) if time.perf_counter() >= end_time else 0
+        return SimpleNamespace(
+            id=batch_id,
+            processing_status="ended" if num_ended else "in_progress",
+            request_counts=SimpleNamespace(processing=len(responses) - num_ended, succeeded=num_ended),
+        )
+
+    def results(self, batch_id: str):
+        return iter(self._batches[batch_id][1])
+
+
+class FakeAnthropic:
+    """Fake of `anthropic.Client`."""
+
+    def __init__(self, **kwargs):
+        self.messages = FakeMessages(**kwargs)
+        self.messages.batches = FakeBatches(self.messages)
+
+
+def _run_script(script_name: str, args: list[str], cwd: str) -> None:
+    """Run one of the scripts of the action in this process, like `python <script> <args>`."""
+    previous_argv, previous_cwd = sys.argv, os.getcwd()
+    sys.argv = [script_name, *args]
+    os.chdir(cwd)
+    try:
+        runpy.run_path(os.path.join(SCRIPT_DIR, script_name), run_name="__main__")
+    finally:
+        sys.argv = previous_argv
+        os.chdir(previous_cwd)
+
+
+def _measure(
+    stage: str,
+    function,
+    fake_github: FakeGitHub,
+    fake_anthropic: FakeAnthropic,
+    log_path: str,
+    trace_memory: bool,
+) -> dict:
+    """Run a stage of the pipeline and measure wall time, peak memory and API calls."""
+    fake_github.reset_counts()
+    fake_anthropic.messages.num_requests = 0
+    fake_anthropic.messages.num_input_tokens = 0
+
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    with open(log_path, "a") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print(f"===== {stage}")
+        function()
+    wall_time = time.perf_counter() - start_time
+    peak_memory_mb = None
+    if trace_memory:
+        peak_memory_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    return {
+        "stage": stage,
+        "wall_time_s": wall_time,
+        "peak_memory_mb": peak_memory_mb,
+        "github_requests": sum(fake_github.requests.values()),
+        "github_not_modified": fake_github.num_not_modified,
+        "github_requests_by_route": dict(fake_github.requests),
+        "anthropic_requests": fake_anthropic.messages.num_requests,
+        "anthropic_input_tokens": fake_anthropic.messages.num_input_tokens,
+    }
+
+
+def benchmark_pull_request(args: argparse.Namespace, num_files: int, work_dir: str) -> list[dict]:
+    """Run all stages for a synthetic pull request with `num_files` files, `args.runs` times."""
+    repo_path = os.path.join(work_dir, "repo")
+    pr = SyntheticPullRequest(repo_path, num_files, args.lines_per_file, args.no_patch_fraction, args.seed)
+    pr_description = "```code-review\n" + "\n".join(args.config) + "\n```" if args.config else ""
+
+    changed_files_path = os.path.join(work_dir, "changed_files.txt")
+    patches_path = os.path.join(work_dir, "patches.txt")
+    log_path = os.path.join(work_dir, "benchmark.log")
+    fake_anthropic = FakeAnthropic(
+        latency=args.anthropic_latency,
+        tokens_per_second=args.tokens_per_second,
+        num_comments=args.num_comments,
+        comment_chars=args.comment_chars,
+    )
+
+    results = []
+    with FakeGitHub([pr], pr_description, args.github_latency) as fake_github:
+        os.environ.update(
+            {
+                "GITHUB_API_URL": fake_github.url,
+                "GITHUB_REPOSITORY": REPO_NAME,
+                "GITHUB_EVENT_NUMBER": str(PR_NUMBER),
+                "GITHUB_TOKEN": "benchmark",
+                "ANTHROPIC_API_KEY": "benchmark",
+                "CODE_REVIEW_PROMPT": "Review the following pull request.",
+                "CODE_REVIEW_SYSTEM_MESSAGE": "You are a code reviewer.",
+                "GITHUB_WORKSPACE_PATH": work_dir,
+                "PATCH_BACKEND": args.patch_backend,
+                "BASE_SHA": pr.base_sha,
+                "HEAD_SHA": pr.head_sha,
+            }
+        )
+
+        def review():
+            bot = CodeReviewBot(anthropic_client=fake_anthropic)
+            with open(changed_files_path) as changed_files, open(patches_path) as patches:
+                bot.process_pull_request(changed_files.read(), patches.read(), REPO_NAME, PR_NUMBER)
+
+        stages = [
+            (
+                STAGE_PR_TO_STRING,
+                lambda: _run_script("pr_to_string.py", [" ".join(pr.file_names), patches_path], repo_path),
+            ),
+            (
+                STAGE_FILES_TO_STRING,
+                lambda: _run_script(
+                    "files_to_string.py", [" ".join(pr.file_names), changed_files_path], repo_path
+                ),
+            ),
+            (STAGE_CODE_REVIEW_BOT, review),
+        ]
+
+        def review_pipeline():
+            pipeline = ReviewPipeline(
+                REPO_NAME, PR_NUMBER, patch_backend=args.patch_backend, anthropic_client=fake_anthropic
+            )
+            previous_cwd = os.getcwd()
+            os.chdir(repo_path)  # for the 'git' backend
+            try:
+                asyncio.run(pipeline.run())
+            finally:
+                os.chdir(previous_cwd)
+
+        def batch_review():
+            reviewer = BatchReviewer(
+                os.path.join(work_dir, "batch_review_state.json"), fake_anthropic, poll_seconds=0.1
+            )
+            reviewer.run([REPO_NAME])
+
+        if args.single_process:
+            stages = [(STAGE_REVIEW_PIPELINE, review_pipeline)]
+        elif args.batch:
+            stages = [(STAGE_BATCH_REVIEW, batch_review)]
+
+        for run in range(args.runs):
+            fake_github.reset_comments()
+            for stage, function in stages:
+                result = _measure(stage, function, fake_github, fake_anthropic, log_path, not args.no_memory)
+                results.append({"num_files": num_files, "run": run + 1, **result})
+                _print_result(results[-1])
+
+            print(
+                f"{' ' * 18}posted {fake_github.num_review_comments[PR_NUMBER]} review comments "
+                f"and {len(fake_github.issue_comments[PR_NUMBER])} issue comments"
+            )
+
+    return results
+
+
+def _print_header() -> None:
+    print(
+        f"{'files':>6} {'run':>4} {'stage':<17} {'wall [s]':>9} {'peak [MB]':>10} "
+        f"{'GitHub (304)':>14} {'Anthropic':>10} {'input tokens':>13}"
+    )
+
+
+def _print_result(result: dict) -> None:
+    peak_memory = "-" if result["peak_memory_mb"] is None else f"{result['peak_memory_mb']:.1f}"
+    github_requests = f"{result['github_requests']} ({result['github_not_modified']})"
+    print(
+        f"{result['num_files']:>6} {result['run']:>4} {result['stage']:<17} {result['wall_time_s']:>9.2f} "
+        f"{peak_memory:>10} {github_requests:>14} {result['anthropic_requests']:>10} "
+        f"{result['anthropic_input_tokens']:>13}"
+    )
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-files", type=int, nargs="+", default=[1, 10, 100, 500],
+                        help="Sizes of the synthetic pull requests (default: 1 10 100 500).")
+    parser.add_argument("--lines-per-file", type=int, default=200, help="Lines per changed file (default: 200).")
+    parser.add_argument("--no-patch-fraction", type=float, default=0.0,
+                        help="Fraction of files the API provides no patch for (default: 0).")
+    parser.add_argument("--runs", type=int, default=1, help="Runs per pull request (default: 1).")
+    parser.add_argument("--config", nargs="*", default=[],
+                        help="Lines of the code-review block of the PR description, e.g. 'stream: true'.")
+    parser.add_argument("--patch-backend", default="api", help="PATCH_BACKEND of pr_to_string.py (default: api).")
+    parser.add_argument("--single-process", action="store_true",
+                        help="Run review_pipeline.py instead of the separate stages.")
+    parser.add_argument("--batch", action="store_true",
+                        help="Run batch_review.py instead of the separate stages.")
+    parser.add_argument("--github-latency", type=float, default=0.02,
+                        help="Latency of the fake GitHub API per request in seconds (default: 0.02).")
+    parser.add_argument("--anthropic-latency", type=float, default=0.5,
+                        help="Time to the first token of the fake Anthropic API in seconds (default: 0.5).")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0,
+                        help="Output speed of the fake Anthropic API (default: 500).")
+    parser.add_argument("--num-comments", type=int, default=5, help="Review comments per answer (default: 5).")
+    parser.add_argument("--comment-chars", type=int, default=300,
+                        help="Characters per review comment (default: 300).")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Do not trace memory, which slows down the stages.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic pull requests.")
+    parser.add_argument("--output", help="Path of a JSON file to write the results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+
+    results = []
+    _print_header()
+    for num_files in args.num_files:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results.extend(benchmark_pull_request(args, num_files, work_dir))
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"args": vars(args), "results": results}, outfile, indent=2)
+        print(f"Wrote results to '{args.output}'.")
@@ -0,0 +1,148 @@
+"""Content-addressed on-disk cache for file contents, shared by the scripts of the code review action.
+
+Contents are stored under their git blob SHA, so a file that did not change is never fetched twice from the API,
+also across workflow runs if the cache directory is restored. The size of the cache is bounded,
+the least recently used entries are evicted first.
+
+The contents are stored in the subdirectory 'blobs' of the cache directory. The other caches in the cache directory
+(e.g. of `github_client.py` and `symbol_index.py`) use their own subdirectories, each with its own maximum size,
+so they do not evict each other's entries.
+
+Optional environment:
+- CODE_REVIEW_CACHE_DIR: Directory of the cache. If not set, caching is disabled.
+- CODE_REVIEW_CACHE_MAX_MB: Maximum size of each cache in the cache directory in MB (default: 500).
+"""
+
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+from typing import Callable
+
+CACHE_DIR = os.environ.get("CODE_REVIEW_CACHE_DIR")
+MAX_MB = int(os.environ.get("CODE_REVIEW_CACHE_MAX_MB", 500))
+BLOBS_DIR = os.path.join(CACHE_DIR, "blobs") if CACHE_DIR else None
+
+
+def git_blob_sha(data: bytes) -> str:
+    """Get the git blob SHA of some content, as given by `git hash-object`."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def get_blob_shas(repo_path: str = ".") -> dict[str, str]:
+    """Get the blob SHAs of all files in the git index of `repo_path`, by relative path.
+
+    Returns an empty dict if `repo_path` is not a git repository.
+    """
+    try:
+        output = subprocess.run(
+            ["git", "ls-files", "--stage", "-z"],
+            cwd=repo_path,
+            capture_output=True,
+            check=True,
+        ).stdout.decode()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return {}
+
+    blob_shas = {}
+    for entry in output.split("\0"):
+        if not entry:
+            continue
+        # <mode> <sha> <stage>\t<path>
+        info, path = entry.split("\t", maxsplit=1)
+        blob_shas[path] = info.split()[1]
+    return blob_shas
+
+
+class BlobCache:
+    """Cache of file contents by git blob SHA, evicting the least recently used entries."""
+
+    def __init__(self, cache_dir: str | None = BLOBS_DIR, max_mb: int = MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # the cache is used from thread pools
+
+    def _get_path(self, key: str) -> str:
+        # two-level layout like in .git/objects to keep directories small
+        return os.path.join(self.cache_dir, key[:2], key[2:])
+
+    def _count(self, *, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> bytes | None:
+        """Get the cached content for `key`, or None if it is not cached."""
+        if self.cache_dir is None:
+            self._count(hit=False)
+            return None
+
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        os.utime(path)  # the modification time is used as last access time for eviction
+        self._count(hit=True)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store `data` under `key`."""
+        if self.cache_dir is None:
+            return
+
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so concurrent readers never see partial content
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as outfile:
+            outfile.write(data)
+        os.replace(outfile.name, path)
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], bytes]) -> bytes:
+        """Get the cached content for `key`, calling `fetch` to get and store it if it is not cached."""
+        data = self.get(key)
+        if data is None:
+            data = fetch()
+            self.put(key, data)
+        return data
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits into its maximum size."""
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return
+
+        # only the entries of the two-level layout, the directory might contain other files
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            if len(prefix) != 2 or not os.path.isdir(dir_path := os.path.join(self.cache_dir, prefix)):
+                continue
+            for file_name in os.listdir(dir_path):
+                stat = os.stat(path := os.path.join(dir_path, file_name))
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            num_evicted += 1
+
+        if num_evicted:
+            print(f"Evicted {num_evicted} entries from blob cache '{self.cache_dir}'.")
+
+    def print_stats(self) -> None:
+        """Print the number of cache hits and misses."""
+        if self.cache_dir is None:
+            print("Blob cache disabled.")
+            return
+        print(f"Blob cache '{self.cache_dir}': {self.hits} hits, {self.misses} misses.")
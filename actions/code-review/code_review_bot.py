@@ -3,26 +3,159 @@ import json
 import logging
 import re
 import sys
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
 import anthropic
 import untruncate_json
-from github import Github
+from github import GithubException
 from github.PullRequest import PullRequest
+from github.Repository import Repository
+
+from blob_cache import BlobCache
+from context_trimming import trim_changed_files
+from diff_index import build_line_index, snap_line
+from github_client import get_github, get_num_requests
+from json_stream import JsonArrayStreamParser
+from notebooks import is_notebook
+from pr_to_string import format_pr, get_file_patch, get_notebook_patch
+from sharding import FILE_SECTION_PATTERN, PATCH_SECTION_PATTERN, Sections, build_shards, estimate_tokens
+from token_estimator import TokenEstimator, get_input_limit, get_output_budget
+from tracing import Tracer
 
 DEFAULT_MODEL_NAME = "claude-3-7-sonnet-latest"
 UPPER_MAX_TOKEN_LIMIT = 20000
 DEFAULT_NUM_MAX_TOKENS = 4096
 MIN_NUM_THINKING_TOKENS = 1024  # https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking#important-considerations-when-using-extended-thinking
+DEFAULT_MAX_CONCURRENCY = 4
+
+# optional cheaper model for small inputs, if the model is not set in the instructions
+SMALL_INPUT_MODEL = os.environ.get("CODE_REVIEW_SMALL_INPUT_MODEL")
+SMALL_INPUT_TOKENS = 8000
 
 
 # special keys to extract from the instructions block
 MAX_TOKENS = 'max_tokens'
 MODEL = 'model'
 THINKING_TOKENS = 'thinking_tokens'
-SPECIAL_KEYS = [MODEL, THINKING_TOKENS, MAX_TOKENS]
+SHARD_TOKENS = 'shard_tokens'
+MAX_CONCURRENCY = 'max_concurrency'
+CACHE_PROMPT = 'cache_prompt'
+INCREMENTAL = 'incremental'
+STREAM = 'stream'
+BATCH_COMMENTS = 'batch_comments'
+TOOL_USE = 'tool_use'
+TRIM_CONTEXT = 'trim_context'
+SPECIAL_KEYS = [
+    MODEL, THINKING_TOKENS, MAX_TOKENS, SHARD_TOKENS, MAX_CONCURRENCY, CACHE_PROMPT, INCREMENTAL, STREAM,
+    BATCH_COMMENTS, TOOL_USE, TRIM_CONTEXT,
+]
+
+# https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# with TOOL_USE, the review items are the input of a call of this tool, cf. https://docs.anthropic.com/en/docs/build-with-claude/tool-use
+REVIEW_TOOL_NAME = "submit_review"
+REVIEW_TOOL = {
+    "name": REVIEW_TOOL_NAME,
+    "description": "Submit all items of the code review at once.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "change_id": {
+                            "type": "integer",
+                            "description": "Number of the item, -1 for a general comment that is not about specific lines.",
+                        },
+                        "file_name": {"type": "string", "description": "Path of the file, starting with './'."},
+                        "start_line": {"type": "integer", "description": "Line in the new version of the file."},
+                        "comment": {"type": "string"},
+                        "proposed_code": {"type": "string"},
+                    },
+                    "required": ["change_id", "comment"],
+                },
+            }
+        },
+        "required": ["items"],
+    },
+}
+
+# tried one after the other if there is no index of commentable lines
+LINE_OFFSETS = [0, -1, 1, -2, 2, -3, 3, -4, 4, -5, 5, -6, 6, -7, 7, -8, 8, -9, 9, -10, 10]
+
+# hidden marker in the summary comment to remember the last reviewed commit
+LAST_REVIEWED_SHA_MARKER = "<!-- code-review: last reviewed sha {sha} -->"
+LAST_REVIEWED_SHA_PATTERN = re.compile(r"<!-- code-review: last reviewed sha ([0-9a-f]{40}) -->")
+# author of comments created with the GITHUB_TOKEN of a workflow, which cannot read its own user
+GITHUB_ACTIONS_LOGIN = "github-actions[bot]"
+
+
+def _is_enabled(config: dict, key: str) -> bool:
+    """Check whether a boolean special key is set to a true value."""
+    return str(config.get(key, "")).lower() in ["true", "yes", "1"]
+
+
+def _is_line_comment(json_item: dict) -> bool:
+    """Check whether a review item is posted as a comment on a line of the diff, i.e. as part of a review."""
+    return str(json_item.get("change_id")) not in ["-1", "-2"] and not is_notebook(str(json_item.get("file_name")))
+
+
+class StreamedItemPoster:
+    """Posts the review items as they are completed while the answer is streamed, possibly from several threads.
+
+    With `batch_comments`, only general comments are posted while streaming. The line comments are collected in
+    `collected_items`, to be submitted together as a single review after the answer is complete.
+    """
+
+    def __init__(
+        self,
+        bot: "CodeReviewBot",
+        pull_request: PullRequest,
+        last_commit,
+        batch_comments: bool,
+        line_index: dict[str, set[int] | dict[int, int]] | None,
+    ):
+        self._bot = bot
+        self._pull_request = pull_request
+        self._last_commit = last_commit
+        self._batch_comments = batch_comments
+        self._line_index = line_index
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+
+        self.time_to_first_comment = None
+        self.processed_items = []
+        self.unprocessed_items = []
+        self.collected_items = []
+
+    def __call__(self, json_item: dict):
+        with self._lock:
+            if self._batch_comments and _is_line_comment(json_item):
+                self.collected_items.append(json_item)
+                return
+            self.processed_items.append(json_item)
+            self.unprocessed_items.extend(
+                self._bot.process_answer(
+                    [json_item],
+                    self._pull_request,
+                    self._last_commit,
+                    self._batch_comments,
+                    self._line_index,
+                )
+            )
+            if self.time_to_first_comment is None:
+                self.time_to_first_comment = time.perf_counter() - self._start_time
+                print(f"Time to first comment: {self.time_to_first_comment:.1f}s")
+
 
 class CodeReviewBot:
-    def __init__(self):
+    def __init__(self, anthropic_client=None, github_client=None, tracer: Tracer | None = None):
         # Initialize with environment variables
         self.anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
         self.github_token = os.environ.get("GITHUB_TOKEN")
@@ -35,15 +168,17 @@ class CodeReviewBot:
                 self.anthropic_api_key,
                 self.github_token,
                 self.review_prompt,
-                self.github_workspace_path,
                 self.system_message,
             ]
         ):
             raise ValueError("Missing required environment variables")
 
-        # Initialize clients
-        self.anthropic_client = anthropic.Client(api_key=self.anthropic_api_key)
-        self.github_client = Github(self.github_token)
+        # Initialize clients, unless given (e.g. stubs for testing)
+        self.anthropic_client = anthropic_client or anthropic.Client(api_key=self.anthropic_api_key)
+        self.github_client = github_client or get_github(self.github_token)
+        self.token_estimator = TokenEstimator()
+        self.tracer = tracer or Tracer()
+        self._login = None
 
         # Setup logging
         logging.basicConfig(level=logging.INFO)
@@ -80,49 +215,330 @@ class CodeReviewBot:
                 remaining_lines.append(line)
         return "\n".join(remaining_lines), extracted_dict
     
-    def get_review_feedback(self, changed_files_str, patches_str, config, pr_instructions=None):
-        """
-        Sends the content to Claude and gets the review feedback.
-        Now includes PR instructions if provided.
-        """
-        try:
-            if (thinking_tokens := int(config.get(THINKING_TOKENS, -1))) > 0:
-                thinking_params = {"thinking" : {
-                    "type": "enabled",
-                    "budget_tokens": max(thinking_tokens, MIN_NUM_THINKING_TOKENS)
-                }}
-                print("thinking_params", thinking_params)
-            else:
-                thinking_params = {}
+    def _get_messages(self, changed_files_str, patches_str, pr_instructions, cache_prompt, definitions_str=""):
+        """Get the messages to send to Claude.
 
-            max_tokens = int(config.get(MAX_TOKENS, DEFAULT_NUM_MAX_TOKENS))
+        With `cache_prompt`, the parts that are stable across pushes to a PR (prompt and changed files
+        of the base branch) come first and are marked as cache breakpoints.
+        The definitions from other files (cf. `symbol_index.py`) depend on the changes and are sent with the patches.
+        """
+        instructions = (
+            f"Additional instructions given by the code author:\n\n{pr_instructions}"
+            if pr_instructions
+            else None
+        )
 
+        if not cache_prompt:
             messages = [
                 {"role": "user", "content": f"{self.review_prompt}"},
             ]
-            if pr_instructions:
-                messages.append({
-                    "role": "user",
-                    "content": f"Additional instructions given by the code author:\n\n{pr_instructions}",
-                })
-            messages.extend([
-                {"role": "user", "content": f"{changed_files_str}"},
-                {"role": "user", "content": f"{patches_str}"},
-            ])
-
-            answer = self.anthropic_client.messages.create(
-                model=config.get(MODEL, DEFAULT_MODEL_NAME),
-                max_tokens=max_tokens,
-                system=self.system_message,
-                messages=messages,
-                **thinking_params
+            if instructions:
+                messages.append({"role": "user", "content": instructions})
+            messages.append({"role": "user", "content": f"{changed_files_str}"})
+            if definitions_str:
+                messages.append({"role": "user", "content": definitions_str})
+            messages.append({"role": "user", "content": f"{patches_str}"})
+            return messages
+
+        content = [
+            {"type": "text", "text": text, "cache_control": CACHE_CONTROL}
+            for text in [self.review_prompt, changed_files_str]
+            if text
+        ]
+        content.extend(
+            {"type": "text", "text": text} for text in [instructions, definitions_str, patches_str] if text
+        )
+        return [{"role": "user", "content": content}]
+
+    def _get_request_params(
+        self, changed_files_str, patches_str, config, pr_instructions=None, definitions_str=""
+    ) -> dict:
+        """Get the parameters for the request to Claude."""
+        if (thinking_tokens := int(config.get(THINKING_TOKENS, -1))) > 0:
+            thinking_params = {"thinking" : {
+                "type": "enabled",
+                "budget_tokens": max(thinking_tokens, MIN_NUM_THINKING_TOKENS)
+            }}
+            print("thinking_params", thinking_params)
+        else:
+            thinking_params = {}
+
+        cache_prompt = _is_enabled(config, CACHE_PROMPT)
+        system = (
+            [{"type": "text", "text": self.system_message, "cache_control": CACHE_CONTROL}]
+            if cache_prompt
+            else self.system_message
+        )
+
+        messages = self._get_messages(
+            changed_files_str, patches_str, pr_instructions, cache_prompt, definitions_str
+        )
+
+        if _is_enabled(config, TOOL_USE):
+            messages.append(
+                {"role": "user", "content": f"Submit the review with a single call of the `{REVIEW_TOOL_NAME}` tool."}
             )
+            tool_params = {
+                "tools": [REVIEW_TOOL],
+                # forcing a tool is not supported together with extended thinking
+                "tool_choice": {"type": "auto"} if thinking_params else {"type": "tool", "name": REVIEW_TOOL_NAME},
+            }
+        else:
+            tool_params = {}
+
+        return dict(
+            model=config.get(MODEL, DEFAULT_MODEL_NAME),
+            max_tokens=int(config.get(MAX_TOKENS, DEFAULT_NUM_MAX_TOKENS)),
+            system=system,
+            messages=messages,
+            **thinking_params,
+            **tool_params,
+        )
+
+    def get_review_feedback(
+        self, changed_files_str, patches_str, config, pr_instructions=None, on_item=None, definitions_str=""
+    ):
+        """
+        Sends the content to Claude and gets the review feedback.
+        Now includes PR instructions if provided.
+
+        If `on_item` is given, the answer is streamed and `on_item` is called with each review item
+        as soon as it is complete.
+        """
+        try:
+            params = self._get_request_params(
+                changed_files_str, patches_str, config, pr_instructions, definitions_str
+            )
+            estimated_tokens = self.token_estimator.estimate_request(params)
+            with self.tracer.span(
+                "model_request", model=params["model"], streamed=on_item is not None, estimated_tokens=estimated_tokens
+            ) as attributes:
+                if on_item is None:
+                    answer = self.anthropic_client.messages.create(**params)
+                else:
+                    start_time, start = time.time(), time.perf_counter()
+                    is_first_chunk = True
+                    parser = JsonArrayStreamParser()
+                    with self.anthropic_client.messages.stream(**params) as stream:
+                        if "tools" in params:
+                            # the items are streamed as part of the input of the tool call
+                            chunks = (event.partial_json for event in stream if event.type == "input_json")
+                        else:
+                            chunks = stream.text_stream
+                        for text in chunks:
+                            if is_first_chunk:
+                                self.tracer.add_span("first_token", start_time, time.perf_counter() - start)
+                                is_first_chunk = False
+                            for json_item in parser.feed(text):
+                                on_item(json_item)
+                        answer = stream.get_final_message()
+                    print(f"Streamed {parser.num_items} items")
+
+                actual_tokens = (
+                    answer.usage.input_tokens
+                    + (answer.usage.cache_creation_input_tokens or 0)
+                    + (answer.usage.cache_read_input_tokens or 0)
+                )
+                attributes.update(
+                    input_tokens=actual_tokens, output_tokens=answer.usage.output_tokens, stop_reason=answer.stop_reason
+                )
+            self.token_estimator.record(params, estimated_tokens, actual_tokens)
             return answer
 
         except Exception as e:
             msg = f"Error in get_review_feedback(): {str(e)}"
             raise ValueError(msg)
 
+    def get_sharded_review_feedback(
+        self, changed_files_str, patches_str, config, pr_instructions=None, on_item=None, definitions_str=""
+    ) -> list:
+        """
+        Splits the input into shards of at most `shard_tokens` tokens and gets the review feedback
+        for them with concurrent requests. The definitions are sent with every shard.
+        """
+        shards = build_shards(
+            changed_files_str, patches_str, int(config[SHARD_TOKENS]), self.token_estimator.estimate
+        )
+        max_concurrency = int(config.get(MAX_CONCURRENCY, DEFAULT_MAX_CONCURRENCY))
+        print(f"Reviewing {len(shards)} shards with {max_concurrency=}")
+
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(shards))) as executor:
+            return list(
+                executor.map(
+                    lambda shard: self.get_review_feedback(
+                        shard[0], shard[1], config, pr_instructions, on_item, definitions_str
+                    ),
+                    shards,
+                )
+            )
+
+    def _plan_request(
+        self, changed_files_str, patches_str, definitions_str, config, pr_instructions, can_trim
+    ) -> tuple[str, dict, list[str]] | None:
+        """Choose the budgets that are not set in `config` from the estimated input size, and shrink the input
+        if a part of it that cannot be sharded is too large.
+
+        Returns the changed files (possibly shrunk), the completed config and notes on what was adapted,
+        or None if the input is too large to be reviewed.
+        """
+        config = dict(config)
+        notes = []
+        estimate = self.token_estimator.estimate
+        patches_tokens = estimate(patches_str)
+
+        if MAX_TOKENS not in config:
+            max_tokens = get_output_budget(patches_tokens, UPPER_MAX_TOKEN_LIMIT)
+            if (thinking_tokens := int(config.get(THINKING_TOKENS, -1))) > 0:
+                # the thinking tokens are part of the output
+                max_tokens += max(thinking_tokens, MIN_NUM_THINKING_TOKENS)
+            config[MAX_TOKENS] = max_tokens
+            notes.append(f"{MAX_TOKENS}={max_tokens}")
+
+        # parts that are sent with every shard: system message, prompt, instructions, definitions and tools
+        fixed_tokens = self.token_estimator.estimate_request(
+            self._get_request_params("", "", config, pr_instructions, definitions_str)
+        )
+        input_limit = get_input_limit(int(config[MAX_TOKENS])) - fixed_tokens
+        input_tokens = estimate(changed_files_str) + patches_tokens
+        print(f"Estimated input tokens: {input_tokens} + {fixed_tokens}, limit per request: {input_limit}")
+
+        if MODEL not in config and SMALL_INPUT_MODEL and input_tokens + fixed_tokens <= SMALL_INPUT_TOKENS:
+            config[MODEL] = SMALL_INPUT_MODEL
+            notes.append(f"{MODEL}={SMALL_INPUT_MODEL}")
+
+        if input_tokens <= input_limit:
+            return changed_files_str, config, notes
+
+        if SHARD_TOKENS not in config:
+            config[SHARD_TOKENS] = input_limit
+            notes.append(f"{SHARD_TOKENS}={input_limit}")
+
+        # a file and its patch are always in the same shard
+        patches = Sections(patches_str, PATCH_SECTION_PATTERN).by_file_name
+
+        def get_oversized_files(changed_files_str: str) -> list[str]:
+            files = Sections(changed_files_str, FILE_SECTION_PATTERN).by_file_name
+            return [
+                name
+                for name in set(files) | set(patches)
+                if estimate(files.get(name, "")) + estimate(patches.get(name, "")) > input_limit
+            ]
+
+        if (oversized_files := get_oversized_files(changed_files_str)) and can_trim:
+            changed_files_str = trim_changed_files(changed_files_str, patches_str)
+            notes.append("trimmed the changed files")
+            oversized_files = get_oversized_files(changed_files_str)
+
+        if oversized_files:
+            if any(estimate(patches.get(name, "")) > input_limit for name in oversized_files):
+                return None
+            files = Sections(changed_files_str, FILE_SECTION_PATTERN)
+            changed_files_str = files.join([name for name in files.by_file_name if name not in oversized_files])
+            notes.append(f"left out the content of {', '.join(sorted(oversized_files))}")
+
+        return changed_files_str, config, notes
+
+    def _get_login(self) -> str:
+        """Get the login of the user the comments of the bot are created by."""
+        if self._login is None:
+            try:
+                self._login = self.github_client.get_user().login
+            except GithubException as e:
+                print(f"Cannot get the authenticated user, assuming '{GITHUB_ACTIONS_LOGIN}': {e}")
+                self._login = GITHUB_ACTIONS_LOGIN
+        return self._login
+
+    def get_last_reviewed_sha(self, pull_request: PullRequest) -> str | None:
+        """Get the head commit of the last review from the marker in its summary comment.
+
+        Only comments of the bot itself are considered, as anyone could add a marker to skip commits.
+        """
+        last_reviewed_sha = None
+        login = self._get_login()
+        for comment in pull_request.get_issue_comments():
+            if comment.user.login != login:
+                continue
+            if match := LAST_REVIEWED_SHA_PATTERN.search(comment.body or ""):
+                last_reviewed_sha = match.group(1)
+        return last_reviewed_sha
+
+    def _get_incremental_input(
+        self,
+        repo: Repository,
+        pull_request: PullRequest,
+        last_reviewed_sha: str,
+        changed_files_str: str,
+        patches_str: str,
+    ) -> tuple[str, str] | None:
+        """Get changed files and patches restricted to the commits pushed since `last_reviewed_sha`.
+
+        Only files that are part of the pull request are considered, empty strings are returned if there are none.
+        Returns None if the history was rewritten since the last review (e.g. by a force-push),
+        in which case the full pull request needs to be reviewed.
+        """
+        comparison = repo.compare(last_reviewed_sha, pull_request.head.sha)
+        if comparison.status != "ahead":
+            print(f"Cannot review incrementally, head is '{comparison.status}' of {last_reviewed_sha}")
+            return None
+
+        pr_file_names = Sections(patches_str, PATCH_SECTION_PATTERN).by_file_name
+        files = [file for file in comparison.files if f"./{file.filename}" in pr_file_names]
+        print(f"Reviewing {len(files)} files changed since {last_reviewed_sha}")
+        if not files:
+            return "", ""
+
+        cache = BlobCache()
+        incremental_patches_str = format_pr(
+            [
+                {
+                    "file_name": file.filename,
+                    "patch": (
+                        get_notebook_patch(repo, file, last_reviewed_sha, pull_request.head.sha, cache)
+                        if is_notebook(file.filename)
+                        else get_file_patch(file)
+                    ),
+                }
+                for file in files
+            ]
+        )
+        incremental_changed_files_str = Sections(changed_files_str, FILE_SECTION_PATTERN).join(
+            [f"./{file.filename}" for file in files]
+        )
+        return incremental_changed_files_str, incremental_patches_str
+
+    def _get_tool_items(self, answer: list) -> list[dict] | None:
+        """Get the review items from the call of the review tool in the content of an answer.
+
+        Returns None if the answer contains no valid call, e.g. because it was truncated.
+        """
+        for block in answer:
+            if block.type == "tool_use" and block.name == REVIEW_TOOL_NAME:
+                items = block.input.get("items") if isinstance(block.input, dict) else None
+                if isinstance(items, list):
+                    return [item for item in items if isinstance(item, dict)]
+        return None
+
+    def _merge_answers(self, answers: list[str | list[dict]]) -> str | list[dict]:
+        """Merge the answers of several shards into a single list of items.
+
+        Each answer is either a text containing a JSON list or the already parsed items.
+        """
+        if len(answers) == 1:
+            return answers[0]
+
+        json_items = []
+        for answer in answers:
+            if isinstance(answer, list):
+                json_items.extend(answer)
+                continue
+            try:
+                json_items.extend(self._get_valid_json(answer))
+            except Exception as e:
+                print(f"Error decoding JSON of shard: {e}")
+                # a change_id of -2 makes process_answer() post this as a general comment
+                json_items.append({"change_id": "-2", "comment": answer})
+        return json_items
+
     def _extract_json(self, text: str) -> str:
         """Extract the JSON string from the answer."""
         start_rect = text.find("[")
@@ -180,15 +596,23 @@ class CodeReviewBot:
 
         return json_items
 
-    def process_answer(self, json_string, pr, last_commit):
-        """Process the answer from Claude and post as review comments."""
+    def process_answer(self, json_string, pr, last_commit, batch_comments=False, line_index=None):
+        """Process the answer from Claude (or the already parsed items) and post as review comments.
+
+        With `batch_comments`, all line comments are submitted together as a single review.
+        With a `line_index` (cf. `diff_index.py`), each comment is moved to the closest commentable line
+        beforehand, instead of trying out lines.
+        """
         try:
-            json_items = self._get_valid_json(json_string)
+            json_items = (
+                json_string if isinstance(json_string, list) else self._get_valid_json(json_string)
+            )
         except Exception as e:
             print(f"Error decoding JSON: {e}")
             return json_string
 
         unprocessed_items = []
+        review_comments = []  # tuples of item and line comment for batch_comments
         for json_item in json_items:
             change_id = self._safe_get(json_item, "change_id", "-2")
             print("Processing change_id: ", change_id)
@@ -207,28 +631,28 @@ class CodeReviewBot:
                         file_name = file_name[2:]
 
                     line = int(json_item["start_line"])
-
-                    # Claude is not good at providing the exact line so we brute force
-                    done = False
-                    count = 0
-                    line_offsets = [0, -1, 1, -2, 2, -3, 3, -4, 4, -5, 5, -6, 6, -7, 7, -8, 8, -9, 9, -10, 10] # ruff: noqa
-                    while not done:
-                        try:
-                            pr.create_review_comment(
-                                body=comment,
-                                commit=last_commit,
-                                path=file_name,
-                                line=line + line_offsets[count],
-                                side="RIGHT",
-                            )
-                            done = True
-                        except Exception:
-                            count += 1
-                            if count >= len(line_offsets):
-                                raise ValueError("Could not create review comment for any line offset.")
-                            print(
-                                f"Could not create review comment for line offset {line_offsets[count]}"
-                            )
+                    if is_notebook(file_name):
+                        # the lines of the compact form of notebooks do not exist in the diff on GitHub
+                        self._create_notebook_comment(pr, comment, file_name, line, line_index)
+                        print(f"Successfully processed change_id: {json_item['change_id']}")
+                        continue
+
+                    line_offsets = LINE_OFFSETS
+                    if line_index is not None:
+                        if (snapped_line := snap_line(line_index, file_name, line)) is None:
+                            raise ValueError(f"No commentable line close to line {line} of '{file_name}'.")
+                        line = snapped_line
+                        line_offsets = [0]
+
+                    if batch_comments:
+                        review_comments.append(
+                            (json_item, {"path": file_name, "line": line, "side": "RIGHT", "body": comment})
+                        )
+                        continue
+
+                    self._create_review_comment(
+                        pr, last_commit, comment, file_name, line, line_offsets
+                    )
 
                 print(f"Successfully processed change_id: {json_item['change_id']}")
             except Exception as e:
@@ -236,8 +660,70 @@ class CodeReviewBot:
                 traceback.print_exc()
                 unprocessed_items.append(json_item)
 
+        if review_comments:
+            unprocessed_items.extend(self._create_review(pr, last_commit, review_comments))
+
         return unprocessed_items
 
+    def _create_notebook_comment(
+        self, pr, comment: str, file_name: str, line: int, line_index: dict[str, set[int] | dict[int, int]] | None
+    ):
+        """Create a comment on a line of the compact form of a notebook, referring to its cell."""
+        location = f"line {line} of the cell sources"
+        if line_index is not None and (snapped_line := snap_line(line_index, file_name, line)) is not None:
+            location = f"cell {line_index[file_name][snapped_line]}"
+        pr.create_issue_comment(f"`{file_name}`, {location}:\n\n{comment}")
+
+    def _create_review_comment(
+        self, pr, last_commit, comment: str, file_name: str, line: int, line_offsets: list[int]
+    ):
+        """Create a single review comment at the first of the line offsets that works."""
+        # Claude is not good at providing the exact line so we brute force
+        done = False
+        count = 0
+        while not done:
+            try:
+                pr.create_review_comment(
+                    body=comment,
+                    commit=last_commit,
+                    path=file_name,
+                    line=line + line_offsets[count],
+                    side="RIGHT",
+                )
+                done = True
+            except Exception:
+                count += 1
+                if count >= len(line_offsets):
+                    raise ValueError("Could not create review comment for any line offset.")
+                print(
+                    f"Could not create review comment for line offset {line_offsets[count]}"
+                )
+
+    def _create_review(self, pr, last_commit, review_comments: list[tuple[dict, dict]]) -> list[dict]:
+        """Submit line comments together as a single review.
+
+        GitHub rejects the whole review if a single comment cannot be placed. In this case, the comments are
+        split in halves until the failing ones are isolated. Returns the items whose comments could not be placed.
+        """
+        try:
+            pr.create_review(
+                commit=last_commit,
+                body=f"Automated code review: {len(review_comments)} comments.",
+                event="COMMENT",
+                comments=[review_comment for _, review_comment in review_comments],
+            )
+            print(f"Successfully submitted review with {len(review_comments)} comments")
+            return []
+        except Exception as e:
+            if len(review_comments) == 1:
+                print(f"Could not create review comment for json_item: {review_comments[0][0]} - {str(e)}")
+                return [review_comments[0][0]]
+
+            middle = len(review_comments) // 2
+            return self._create_review(
+                pr, last_commit, review_comments[:middle]
+            ) + self._create_review(pr, last_commit, review_comments[middle:])
+
     def _safe_get(self, json_item: dict, key: str, default=None) -> str:
         """Safely get a key from a JSON item."""
         default = default or f"(no {key})"
@@ -257,21 +743,59 @@ class CodeReviewBot:
         except Exception:
             print(f"Error printing JSON context.")
 
-    def post_review_comments(self, pull_request: PullRequest, answer: str):
+    def _get_last_commit(self, pull_request: PullRequest):
+        """Get the head commit of the pull request, without listing all commits."""
+        return pull_request.base.repo.get_commit(pull_request.head.sha)
+
+    def _get_remaining_items(self, answer: str | list[dict], processed_items: list[dict]) -> list[dict]:
+        """Get the items of the answer (or the already parsed items) that were not processed yet."""
+        try:
+            json_items = answer if isinstance(answer, list) else self._get_valid_json(answer)
+        except Exception as e:
+            print(f"Error decoding JSON, using only the items processed so far: {e}")
+            return []
+        return [json_item for json_item in json_items if json_item not in processed_items]
+
+    def post_review_comments(
+        self,
+        pull_request: PullRequest,
+        answer: str | list[dict],
+        processed_items: list[dict] | None = None,
+        unprocessed_items: list[dict] | None = None,
+        batch_comments: bool = False,
+        line_index: dict[str, set[int] | dict[int, int]] | None = None,
+        collected_items: list[dict] | None = None,
+    ):
         """
-        Posts the review feedback as comments on the pull request.
+        Posts the review feedback (a text containing a JSON list, or the already parsed items)
+        as comments on the pull request.
+
+        Items in `processed_items` were already posted (e.g. while streaming the answer) and are skipped,
+        `unprocessed_items` are added to the feedback that could not be added to specific lines.
+        `collected_items` were collected while streaming, but not posted yet; they are posted together with the
+        remaining items, also if the answer cannot be parsed.
+        With `batch_comments`, all line comments are submitted as a single review.
+        With a `line_index`, comments are placed on the closest commentable line.
         """
         try:
-            last_commit = list(pull_request.get_commits())[-1]
+            last_commit = self._get_last_commit(pull_request)
 
-            unprocessed_items = self.process_answer(answer, pull_request, last_commit)
-
-            unprocessed_text = (
-                unprocessed_items
-                if isinstance(unprocessed_items, str)
-                else "\n\n```\n".join([json.dumps(i) for i in unprocessed_items])
+            if processed_items or collected_items:
+                collected_items = collected_items or []
+                answer = collected_items + self._get_remaining_items(
+                    answer, (processed_items or []) + collected_items
+                )
+            remaining_unprocessed_items = self.process_answer(
+                answer, pull_request, last_commit, batch_comments, line_index
             )
 
+            unprocessed_texts = (
+                [remaining_unprocessed_items]
+                if isinstance(remaining_unprocessed_items, str)
+                else [json.dumps(i) for i in remaining_unprocessed_items]
+            ) + [json.dumps(i) for i in unprocessed_items or []]
+            unprocessed_text = "\n\n```\n".join(unprocessed_texts)
+
             if unprocessed_text:
                 text = (
                     "The following feedback could not be added to specific lines, but still contains valuable information:\n\n"
@@ -285,16 +809,23 @@ class CodeReviewBot:
         except Exception as e:
             self.logger.error(f"Error posting review comments: {str(e)}")
 
-    def process_pull_request(
-        self, changed_files_str: str, patches_str: str, repo_name: str, pr_number: int
-    ):
-        """
-        Main method to process a pull request.
+    def prepare_review(
+        self,
+        changed_files_str: str,
+        patches_str: str,
+        repo: Repository,
+        pull_request: PullRequest,
+        definitions_str: str = "",
+    ) -> dict | None:
+        """Get the plan of the review of a pull request: the input and configuration of the requests, and what is
+        needed to post the answers (cf. `finish_review()`).
+
+        Returns None if there is nothing to review; if appropriate, this is commented on the pull request.
         """
-        try:
-            repo = self.github_client.get_repo(repo_name)
-            pull_request = repo.get_pull(pr_number)
-
+        start_time = time.time()
+        with self.tracer.span(
+            "prompt_assembly", changed_files_bytes=len(changed_files_str), patches_bytes=len(patches_str)
+        ) as attributes:
             # Extract PR description and get review instructions if any
             review_instructions, config = self.extract_review_instructions(pull_request.body)
             if review_instructions:
@@ -302,40 +833,248 @@ class CodeReviewBot:
                     f"Found review instructions in PR description: {review_instructions} {config=}"
                 )
 
-            # Get answer from Claude
-            raw_answer = self.get_review_feedback(
-                changed_files_str, patches_str, config, review_instructions
+            # comments can be placed on all lines of the pull request, also in incremental reviews
+            line_index = build_line_index(patches_str)
+
+            # before the incremental review, as the files are trimmed along the patches against the base branch
+            untrimmed_tokens, trimmed_tokens = None, None
+            if _is_enabled(config, TRIM_CONTEXT):
+                untrimmed_tokens = estimate_tokens(changed_files_str)
+                changed_files_str = trim_changed_files(changed_files_str, patches_str)
+                trimmed_tokens = estimate_tokens(changed_files_str)
+                print(f"Trimmed changed files from {untrimmed_tokens} to {trimmed_tokens} tokens")
+
+            head_sha = pull_request.head.sha
+            last_reviewed_sha = None
+            if _is_enabled(config, INCREMENTAL) and (
+                last_reviewed_sha := self.get_last_reviewed_sha(pull_request)
+            ):
+                if last_reviewed_sha == head_sha:
+                    print(f"Commit {head_sha} was already reviewed.")
+                    return None
+
+                incremental_input = self._get_incremental_input(
+                    repo, pull_request, last_reviewed_sha, changed_files_str, patches_str
+                )
+                if incremental_input is None:
+                    last_reviewed_sha = None
+                elif not incremental_input[1]:
+                    pull_request.create_issue_comment(
+                        f"No changes to review since {last_reviewed_sha}.\n"
+                        + LAST_REVIEWED_SHA_MARKER.format(sha=head_sha)
+                    )
+                    return None
+                else:
+                    changed_files_str, patches_str = incremental_input
+
+            # trimming is only possible along the patches against the base branch
+            can_trim = trimmed_tokens is None and not last_reviewed_sha
+            plan = self._plan_request(
+                changed_files_str, patches_str, definitions_str, config, review_instructions, can_trim
             )
-            print(f"{raw_answer=}")
+            if plan is None:
+                pull_request.create_issue_comment(
+                    "The changes are too large to be reviewed, even when split into shards. "
+                    "Consider splitting them into several pull requests."
+                )
+                return None
+            changed_files_str, config, adapted_notes = plan
+            attributes["estimated_tokens"] = self.token_estimator.estimate(changed_files_str + patches_str)
+
+            return {
+                "changed_files_str": changed_files_str,
+                "patches_str": patches_str,
+                "definitions_str": definitions_str,
+                "review_instructions": review_instructions,
+                "config": config,
+                "line_index": line_index,
+                "head_sha": head_sha,
+                "last_reviewed_sha": last_reviewed_sha,
+                "untrimmed_tokens": untrimmed_tokens,
+                "trimmed_tokens": trimmed_tokens,
+                "adapted_notes": adapted_notes,
+                "start_time": start_time,
+            }
+
+    def get_batch_request_params(self, plan: dict) -> list[dict]:
+        """Get the parameters of the requests of a review (one per shard), to send them in a batch."""
+        config = plan["config"]
+        if SHARD_TOKENS in config:
+            shards = build_shards(
+                plan["changed_files_str"], plan["patches_str"], int(config[SHARD_TOKENS]), self.token_estimator.estimate
+            )
+        else:
+            shards = [(plan["changed_files_str"], plan["patches_str"])]
+        return [
+            self._get_request_params(
+                changed_files_str, patches_str, config, plan["review_instructions"], plan["definitions_str"]
+            )
+            for changed_files_str, patches_str in shards
+        ]
+
+    def finish_review(
+        self,
+        pull_request: PullRequest,
+        plan: dict,
+        raw_answers: list,
+        streamed_item_poster: StreamedItemPoster | None = None,
+    ):
+        """Post the answers to the requests of a review (cf. `prepare_review()`) and a summary on the pull request."""
+        config = plan["config"]
+        review_instructions = plan["review_instructions"]
+        line_index = plan["line_index"]
+        batch_comments = _is_enabled(config, BATCH_COMMENTS)
+
+        print(f"{raw_answers=}")
+        if self.github_workspace_path:
             with open(f"{self.github_workspace_path}/raw_answer.txt", "w") as f:
-                f.write(str(raw_answer))
+                f.write("\n\n".join(str(raw_answer) for raw_answer in raw_answers))
                 print(f"wrote answer to file {self.github_workspace_path}/raw_answer.txt")
 
-            answer, thinking = self.parse_answer(raw_answer)
+        with self.tracer.span("json_parse", num_answers=len(raw_answers)) as attributes:
+            tool_use = _is_enabled(config, TOOL_USE)
+            answer, thinking, shard_answers = [], [], []
+            num_answers_without_tool_call = 0
+            for raw_answer in raw_answers:
+                shard_answer, shard_thinking = self.parse_answer(raw_answer)
+                answer.extend(shard_answer)
+                thinking.extend(shard_thinking)
+                if tool_use and (items := self._get_tool_items(shard_answer)) is not None:
+                    shard_answers.append(items)
+                    continue
+                if tool_use:
+                    num_answers_without_tool_call += 1
+                shard_answers.append("".join(block.text for block in shard_answer if block.type == "text"))
             print(f"{answer=}")
             print(f"{thinking=}")
 
             answer_pretty = self._replace(str(answer))
             print(f"{answer_pretty=}")
-            with open(f"{self.github_workspace_path}/answer.txt", "w") as f:
-                f.write(answer_pretty)
-                print(f"wrote answer to file {self.github_workspace_path}/answer.txt")
-
-            text = answer[0].text
-            self.post_review_comments(pull_request, text)
-
-            input_tokens = raw_answer.usage.input_tokens
-            output_tokens = raw_answer.usage.output_tokens
-            max_tokens = config.get(MAX_TOKENS, DEFAULT_NUM_MAX_TOKENS)
-            general_text = (
-                f"Number of tokens: {input_tokens=} {output_tokens=} {max_tokens=}"
-                f"\n{review_instructions=}"
-                f"\n{config=}"
-                f"\nthinking: ```\n{thinking}\n```"
+            if self.github_workspace_path:
+                with open(f"{self.github_workspace_path}/answer.txt", "w") as f:
+                    f.write(answer_pretty)
+                    print(f"wrote answer to file {self.github_workspace_path}/answer.txt")
+
+            text = self._merge_answers(shard_answers)
+            attributes["answer_bytes"] = len(answer_pretty)
+
+        num_requests = get_num_requests()
+        with self.tracer.span("comment_posting", streamed=streamed_item_poster is not None) as attributes:
+            if streamed_item_poster is None:
+                self.post_review_comments(
+                    pull_request, text, batch_comments=batch_comments, line_index=line_index
+                )
+            else:
+                # post what was missed while streaming (e.g. because the answer was truncated) and, with
+                # batch_comments, the line comments collected while streaming, as a single review
+                self.post_review_comments(
+                    pull_request,
+                    text,
+                    streamed_item_poster.processed_items,
+                    streamed_item_poster.unprocessed_items,
+                    batch_comments,
+                    line_index,
+                    streamed_item_poster.collected_items,
+                )
+            attributes["github_requests"] = get_num_requests() - num_requests
+
+        input_tokens = sum(raw_answer.usage.input_tokens for raw_answer in raw_answers)
+        output_tokens = sum(raw_answer.usage.output_tokens for raw_answer in raw_answers)
+        max_tokens = config.get(MAX_TOKENS, DEFAULT_NUM_MAX_TOKENS)
+        general_text = f"Number of tokens: {input_tokens=} {output_tokens=} {max_tokens=}"
+        if _is_enabled(config, CACHE_PROMPT):
+            cache_creation_input_tokens = sum(
+                raw_answer.usage.cache_creation_input_tokens or 0 for raw_answer in raw_answers
+            )
+            cache_read_input_tokens = sum(
+                raw_answer.usage.cache_read_input_tokens or 0 for raw_answer in raw_answers
+            )
+            general_text += f" {cache_creation_input_tokens=} {cache_read_input_tokens=}"
+        general_text += (
+            f"\n{review_instructions=}"
+            f"\n{config=}"
+            f"\nthinking: ```\n{thinking}\n```"
+        )
+        if streamed_item_poster is not None and (
+            time_to_first_comment := streamed_item_poster.time_to_first_comment
+        ):
+            general_text += f"\nTime to first comment: {time_to_first_comment:.1f}s."
+        if plan["adapted_notes"]:
+            general_text += f"\nAdapted to the input size: {', '.join(plan['adapted_notes'])}."
+        if plan["trimmed_tokens"] is not None:
+            general_text += (
+                f"\nChanged files trimmed from {plan['untrimmed_tokens']} to {plan['trimmed_tokens']} tokens."
+            )
+        if plan["last_reviewed_sha"]:
+            general_text += f"\nIncremental review of the changes since {plan['last_reviewed_sha']}."
+        if len(raw_answers) > 1:
+            general_text += f"\nReviewed in {len(raw_answers)} shards."
+        if num_answers_without_tool_call:
+            general_text += f"\n{num_answers_without_tool_call} answers without tool call, parsed as text."
+        # a call of the review tool ends the answer, like the end of the turn
+        normal_stop_reasons = ["end_turn", "tool_use"] if tool_use else ["end_turn"]
+        if stop_reasons := [
+            raw_answer.stop_reason
+            for raw_answer in raw_answers
+            if raw_answer.stop_reason not in normal_stop_reasons
+        ]:
+            general_text += f"\nPremature stop because: {', '.join(stop_reasons)}."
+        general_text += f"\n{self.tracer.get_summary(since=plan['start_time'])}."
+        general_text += "\n" + LAST_REVIEWED_SHA_MARKER.format(sha=plan["head_sha"])
+        pull_request.create_issue_comment(general_text)
+
+    def process_pull_request(
+        self, changed_files_str: str, patches_str: str, repo_name: str, pr_number: int, definitions_str: str = ""
+    ):
+        """
+        Main method to process a pull request.
+
+        `definitions_str` are definitions of symbols used in the changes, from other files (cf. `symbol_index.py`).
+        """
+        try:
+            repo = self.github_client.get_repo(repo_name)
+            pull_request = repo.get_pull(pr_number)
+
+            plan = self.prepare_review(changed_files_str, patches_str, repo, pull_request, definitions_str)
+            if plan is None:
+                return
+            config = plan["config"]
+
+            streamed_item_poster = (
+                StreamedItemPoster(
+                    self,
+                    pull_request,
+                    self._get_last_commit(pull_request),
+                    _is_enabled(config, BATCH_COMMENTS),
+                    plan["line_index"],
+                )
+                if _is_enabled(config, STREAM)
+                else None
             )
-            if (stop_reason := raw_answer.stop_reason) != "end_turn":
-                general_text += f"\nPremature stop because: {stop_reason}."
-            pull_request.create_issue_comment(general_text)
+
+            # Get answer from Claude
+            if SHARD_TOKENS in config:
+                raw_answers = self.get_sharded_review_feedback(
+                    plan["changed_files_str"],
+                    plan["patches_str"],
+                    config,
+                    plan["review_instructions"],
+                    streamed_item_poster,
+                    definitions_str,
+                )
+            else:
+                raw_answers = [
+                    self.get_review_feedback(
+                        plan["changed_files_str"],
+                        plan["patches_str"],
+                        config,
+                        plan["review_instructions"],
+                        streamed_item_poster,
+                        definitions_str,
+                    )
+                ]
+
+            self.finish_review(pull_request, plan, raw_answers, streamed_item_poster)
 
         except Exception as e:
             self.logger.error(f"Error processing pull request: {str(e)}")
@@ -379,11 +1118,16 @@ def main():
 
     changed_files_str = read_file(sys.argv[1])
     patches_str = read_file(sys.argv[2])
+    # optional, cf. symbol_index.py
+    definitions_str = read_file(sys.argv[3]) if len(sys.argv) > 3 and os.path.isfile(sys.argv[3]) else ""
 
     bot = CodeReviewBot()
-    bot.process_pull_request(
-        changed_files_str, patches_str, github_repository, pull_request_number
-    )
+    try:
+        bot.process_pull_request(
+            changed_files_str, patches_str, github_repository, pull_request_number, definitions_str
+        )
+    finally:
+        bot.tracer.write()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""Fixtures and stubs shared by the tests of the code review action.
+
+The tests import the scripts of the action by their module names, like the scripts import each other, so they are
+run from this directory: `python -m pytest` (with the dependencies of `action.yml` installed).
+"""
+
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from anthropic.types import Message, TextBlock, ToolUseBlock, Usage
+
+from files_to_string import SEPARATOR, get_file_end, get_file_start
+from pr_to_string import format_pr
+
+
+class StubStream:
+    """Stub of `anthropic.MessageStreamManager` and `anthropic.MessageStream`, streaming a message in small chunks."""
+
+    CHUNK_CHARS = 16
+
+    def __init__(self, message: Message):
+        self._message = message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        block = self._message.content[0]
+        text = block.text if block.type == "text" else json.dumps(block.input)
+        for start in range(0, len(text), self.CHUNK_CHARS):
+            chunk = text[start : start + self.CHUNK_CHARS]
+            if block.type == "text":
+                yield SimpleNamespace(type="text", text=chunk)
+            else:
+                yield SimpleNamespace(type="input_json", partial_json=chunk)
+
+    @property
+    def text_stream(self):
+        return (event.text for event in self if event.type == "text")
+
+    def get_final_message(self) -> Message:
+        return self._message
+
+
+class StubMessages:
+    """Stub of `anthropic.Client.messages`, answering each request with the JSON text returned by
+    `get_answer(params)`, or with a call of the review tool with these items if the request has tools.
+
+    The parameters of all requests are recorded in `requests`.
+    """
+
+    def __init__(self, get_answer=lambda params: "[]"):
+        self.get_answer = get_answer
+        self.requests = []
+        self._lock = threading.Lock()  # sharded requests are sent from several threads
+
+    def _get_message(self, params: dict) -> Message:
+        with self._lock:
+            self.requests.append(params)
+        text = self.get_answer(params)
+        if "tools" in params:
+            tool_name = params["tools"][0]["name"]
+            content = [
+                ToolUseBlock(type="tool_use", id="toolu_stub", name=tool_name, input={"items": json.loads(text)})
+            ]
+        else:
+            content = [TextBlock(type="text", text=text)]
+        return Message(
+            id="msg_stub",
+            type="message",
+            role="assistant",
+            model=params["model"],
+            content=content,
+            stop_reason="tool_use" if "tools" in params else "end_turn",
+            stop_sequence=None,
+            usage=Usage(input_tokens=1, output_tokens=1),
+        )
+
+    def create(self, **params) -> Message:
+        return self._get_message(params)
+
+    def stream(self, **params) -> StubStream:
+        return StubStream(self._get_message(params))
+
+
+class StubPullRequest:
+    """Stub of `github.PullRequest.PullRequest`, recording the comments and reviews created on it."""
+
+    def __init__(self, body: str = "", head_sha: str = "1" * 40, issue_comments: list | None = None):
+        self.body = body
+        self.head = SimpleNamespace(sha=head_sha)
+        self.base = SimpleNamespace(
+            sha="0" * 40, repo=SimpleNamespace(get_commit=lambda sha: SimpleNamespace(sha=sha))
+        )
+        self.issue_comments = issue_comments or []  # objects with `body` and `user.login`
+        self.review_comments = []  # keyword arguments of `create_review_comment()`
+        self.reviews = []  # keyword arguments of `create_review()`
+
+    def get_issue_comments(self) -> list:
+        return list(self.issue_comments)
+
+    def create_issue_comment(self, body: str):
+        self.issue_comments.append(SimpleNamespace(body=body, user=SimpleNamespace(login=StubGitHub.LOGIN)))
+
+    def create_review_comment(self, **kwargs):
+        self.review_comments.append(kwargs)
+
+    def create_review(self, **kwargs):
+        self.reviews.append(kwargs)
+
+
+class StubGitHub:
+    """Stub of `github.Github`, serving `pull_request` as every pull request of every repository."""
+
+    LOGIN = "code-review-bot"
+
+    def __init__(self):
+        self.pull_request = StubPullRequest()
+
+    def get_repo(self, repo_name: str):
+        return SimpleNamespace(full_name=repo_name, get_pull=lambda number: self.pull_request)
+
+    def get_user(self):
+        return SimpleNamespace(login=self.LOGIN)
+
+
+def get_request_text(params: dict) -> str:
+    """Get the text of all messages of a request."""
+    texts = []
+    for message in params["messages"]:
+        content = message["content"]
+        texts.extend([content] if isinstance(content, str) else [block["text"] for block in content])
+    return "\n".join(texts)
+
+
+def create_dumps(contents: dict[str, str], patches: dict[str, str]) -> tuple[str, str]:
+    """Get the dumps of the changed files and of the patches, as written by `files_to_string.py` and
+    `pr_to_string.py`, for files given by their names without './'.
+    """
+    changed_files_str = SEPARATOR.join(
+        get_file_start(f"./{name}") + SEPARATOR + content + SEPARATOR + get_file_end(f"./{name}")
+        for name, content in contents.items()
+    )
+    patches_str = format_pr([{"file_name": name, "patch": patch} for name, patch in patches.items()])
+    return changed_files_str, patches_str
+
+
+@pytest.fixture
+def review_env(monkeypatch):
+    """Set the environment required by `CodeReviewBot`, without a cache directory and workspace."""
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setenv("GITHUB_TOKEN", "test")
+    monkeypatch.setenv("CODE_REVIEW_PROMPT", "Review the following pull request.")
+    monkeypatch.setenv("CODE_REVIEW_SYSTEM_MESSAGE", "You are a code reviewer.")
+    monkeypatch.delenv("GITHUB_WORKSPACE_PATH", raising=False)
+
+
+@pytest.fixture
+def stub_anthropic():
+    return SimpleNamespace(messages=StubMessages())
+
+
+@pytest.fixture
+def stub_github():
+    return StubGitHub()
+
+
+@pytest.fixture
+def bot(review_env, stub_anthropic, stub_github):
+    """A `CodeReviewBot` with the stub clients, without calibration records."""
+    from code_review_bot import CodeReviewBot
+
+    bot = CodeReviewBot(anthropic_client=stub_anthropic, github_client=stub_github)
+    bot.token_estimator.calibration_path = None
+    return bot
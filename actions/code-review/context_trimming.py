@@ -0,0 +1,111 @@
+"""Trim the dump of the changed files to the code around the changes.
+
+The changed files are dumped from the base branch (cf. `files_to_string.py`), so the changes are located by the
+line ranges of the hunks on the LEFT side of the patches (cf. `pr_to_string.py`). For Python files, the functions
+and classes that enclose a change are kept in full, of all other functions and classes only the signatures,
+and all imports. The remaining lines are replaced by markers like `# [lines 12-40 elided]`.
+Other files, and files that cannot be parsed, are kept as they are.
+"""
+
+import ast
+import re
+
+from files_to_string import SEPARATOR, get_file_end, get_file_start
+from sharding import FILE_SECTION_PATTERN, PATCH_SECTION_PATTERN, Sections, estimate_tokens
+
+BASE_HUNK_HEADER_PATTERN = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@", re.MULTILINE)
+ELIDED_MARKER = "{indent}# [lines {start}-{end} elided]"
+
+FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def get_changed_base_ranges(patch: str) -> list[tuple[int, int]]:
+    """Get the line ranges (first, last) on the LEFT side of a patch that are covered by its hunks."""
+    ranges = []
+    for match in BASE_HUNK_HEADER_PATTERN.finditer(patch):
+        start = int(match.group(1))
+        num_lines = int(match.group(2)) if match.group(2) is not None else 1
+        # a hunk that only adds lines covers no line on the LEFT side, use the line it is inserted after
+        ranges.append((start, start + max(num_lines, 1) - 1))
+    return ranges
+
+
+def _get_start(node: ast.stmt) -> int:
+    """Get the first line of a statement, including its decorators."""
+    return min([node.lineno] + [decorator.lineno for decorator in getattr(node, "decorator_list", [])])
+
+
+def _overlaps(start: int, end: int, ranges: list[tuple[int, int]]) -> bool:
+    return any(range_start <= end and range_end >= start for range_start, range_end in ranges)
+
+
+def _get_lines_to_keep(nodes: list[ast.stmt], ranges: list[tuple[int, int]], lines: set[int]) -> None:
+    """Add the lines of `nodes` to keep to `lines`."""
+    for node in nodes:
+        start, end = _get_start(node), node.end_lineno
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.update(range(start, end + 1))
+        elif isinstance(node, ast.ClassDef):
+            lines.update(range(start, max(node.body[0].lineno, start + 1)))
+            _get_lines_to_keep(node.body, ranges, lines)
+        elif isinstance(node, FUNCTION_TYPES) and not _overlaps(start, end, ranges):
+            # signature only
+            lines.update(range(start, max(node.body[0].lineno, start + 1)))
+        elif _overlaps(start, end, ranges):
+            lines.update(range(start, end + 1))
+
+
+def trim_python_source(source: str, ranges: list[tuple[int, int]]) -> str:
+    """Trim Python source code to the code around the given line ranges.
+
+    Returns the source unchanged if it cannot be parsed.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return source
+
+    source_lines = source.split("\n")
+    lines_to_keep = {line for start, end in ranges for line in range(start, end + 1)}
+    _get_lines_to_keep(tree.body, ranges, lines_to_keep)
+
+    trimmed_lines = []
+    line = 1
+    while line <= len(source_lines):
+        if line in lines_to_keep:
+            trimmed_lines.append(source_lines[line - 1])
+            line += 1
+            continue
+
+        end = line
+        while end + 1 <= len(source_lines) and end + 1 not in lines_to_keep:
+            end += 1
+        elided_lines = source_lines[line - 1 : end]
+        if len(elided_lines) == 1:
+            # a marker would not be shorter
+            trimmed_lines.extend(elided_lines)
+        else:
+            first_code_line = next((text for text in elided_lines if text.strip()), "")
+            indent = first_code_line[: len(first_code_line) - len(first_code_line.lstrip())]
+            trimmed_lines.append(ELIDED_MARKER.format(indent=indent, start=line, end=end))
+        line = end + 1
+
+    return "\n".join(trimmed_lines)
+
+
+def trim_changed_files(changed_files_str: str, patches_str: str) -> str:
+    """Trim the Python files in a dump of changed files to the code around the changes in their patches."""
+    patches = Sections(patches_str, PATCH_SECTION_PATTERN).by_file_name
+
+    def trim_section(match: re.Match) -> str:
+        file_name, section = match.group(1), match.group(0)
+        if not file_name.endswith(".py") or not (ranges := get_changed_base_ranges(patches.get(file_name, ""))):
+            return section
+
+        start, end = get_file_start(file_name) + SEPARATOR, SEPARATOR + get_file_end(file_name)
+        content = section[len(start) : -len(end)]
+        trimmed_content = trim_python_source(content, ranges)
+        print(f"Trimmed '{file_name}' from {estimate_tokens(content)} to {estimate_tokens(trimmed_content)} tokens")
+        return start + trimmed_content + end
+
+    return FILE_SECTION_PATTERN.sub(trim_section, changed_files_str)
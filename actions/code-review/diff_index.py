@@ -0,0 +1,64 @@
+"""Index of the lines of a pull request that can take a review comment.
+
+GitHub accepts comments on the RIGHT side only on lines that are part of a hunk of the diff, i.e. added lines
+and context lines. Knowing these lines, a line suggested by the model can be moved to the closest valid line
+locally, instead of trying out lines with failing API calls.
+
+The patches of notebooks are created from their compact form (cf. `notebooks.py`), whose lines do not exist in the
+diff on GitHub. For them, the index maps each line to its cell instead.
+"""
+
+import re
+
+from notebooks import get_commentable_cells, is_notebook
+from sharding import PATCH_SECTION_PATTERN
+
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+MAX_LINE_DISTANCE = 10
+
+
+def get_commentable_lines(patch: str) -> set[int]:
+    """Get the line numbers on the RIGHT side of a patch that can be commented on."""
+    commentable_lines = set()
+    line = None  # current line number on the RIGHT side, None outside of hunks
+    for patch_line in patch.split("\n"):
+        if match := HUNK_HEADER_PATTERN.match(patch_line):
+            line = int(match.group(1))
+        elif line is not None and patch_line.startswith(("+", " ")):
+            commentable_lines.add(line)
+            line += 1
+        # removed lines ('-') and '\ No newline at end of file' do not exist on the RIGHT side
+    return commentable_lines
+
+
+def build_line_index(patches_str: str) -> dict[str, set[int] | dict[int, int]]:
+    """Get the commentable lines for each file in a dump of patches (cf. `pr_to_string.py`).
+
+    The file names are given without leading './', like the paths expected by the GitHub API.
+    For notebooks, the lines are mapped to their cells.
+    """
+    line_index = {}
+    for match in PATCH_SECTION_PATTERN.finditer(patches_str):
+        file_name = match.group(1)
+        if file_name.startswith("./"):
+            file_name = file_name[2:]
+        if is_notebook(file_name):
+            line_index[file_name] = get_commentable_cells(match.group(0))
+        else:
+            line_index[file_name] = get_commentable_lines(match.group(0))
+    return line_index
+
+
+def snap_line(
+    line_index: dict[str, set[int] | dict[int, int]], file_name: str, line: int, max_distance: int = MAX_LINE_DISTANCE
+) -> int | None:
+    """Get the commentable line closest to `line`, preferring the lower one on ties.
+
+    Returns None if there is no commentable line within `max_distance`.
+    """
+    commentable_lines = line_index.get(file_name, set())
+    for distance in range(max_distance + 1):
+        for candidate in [line - distance, line + distance]:
+            if candidate in commentable_lines:
+                return candidate
+    return None
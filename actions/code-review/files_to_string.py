@@ -3,18 +3,66 @@
 Required arguments:
 - whitespace-separated list of relative paths of files to dump
 
+Optional environment:
+- FILES_TO_STRING_MODE: 'join' (default) to join all files in memory before writing them,
+    'stream' to copy them to the output one after the other, with memory use independent of the size of the files.
+- FILES_TO_STRING_MAX_WORKERS: Number of files read concurrently in 'stream' mode (default: 8).
+- CODE_REVIEW_TRACE_PATH: Trace file to add the duration of the dump to, cf. `tracing.py`.
+
 Returns
 -------
-- A string containing all files concatenated.
+- A string containing all files concatenated. Notebooks are dumped in compact form, cf. `notebooks.py`.
 """
 
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
 
+from notebooks import compact_notebook, is_notebook
+from tracing import Tracer
 
-def _concatenate_files(file_paths: list[str], excluded_extensions: list[str]) -> str:
-    """Concatenate the content of multiple files into a single string."""
-    file_contents = []
+MODE_JOIN = "join"
+MODE_STREAM = "stream"
+MODE = os.environ.get("FILES_TO_STRING_MODE", MODE_JOIN)
+MAX_WORKERS = int(os.environ.get("FILES_TO_STRING_MAX_WORKERS", 8))
+
+SNIFF_BYTES = 8000  # like git, a file with a NUL byte at the start is considered binary
+CHUNK_SIZE = 1024 * 1024  # larger files are copied in chunks of this many characters
+SEPARATOR = "\n\n"
+
+
+def _read_file(file_path: str) -> str:
+    """Read a text file.
+
+    Raises UnicodeDecodeError for binary files.
+    """
+    with open(file_path, "rb") as infile:
+        return decode_text(infile.read())
+
+
+def decode_text(data: bytes) -> str:
+    """Decode the content of a text file, with the same newline handling as reading in text mode.
+
+    Raises UnicodeDecodeError for binary files.
+    """
+    return data.decode().replace("\r\n", "\n").replace("\r", "\n")
+
+
+def get_file_start(file_path: str) -> str:
+    """Get the line that marks the start of a file."""
+    return f"START FILE '{file_path}' >>>>>>>>>>>>>>>>\n"
+
+
+def get_file_end(file_path: str) -> str:
+    """Get the line that marks the end of a file."""
+    return f"\n<<<<<<<<<<<<<<<< END FILE '{file_path}'"
+
+
+def _get_existing_files(file_paths: list[str], excluded_extensions: list[str]) -> list[str]:
+    """Get the paths (starting with './') of the given files that exist and do not have an excluded extension."""
+    existing_file_paths = []
     for file_path in file_paths:
         if not file_path.strip():
             continue
@@ -33,19 +81,109 @@ def _concatenate_files(file_paths: list[str], excluded_extensions: list[str]) ->
             continue
 
         if os.path.isfile(file_path):
-            try:
-                with open(file_path, "r") as infile:
-                    file_content = infile.read()
-            except UnicodeDecodeError as e:
-                print(f"Error reading file '{file_path}': {e}")
-                continue
+            existing_file_paths.append(file_path)
+
+    return existing_file_paths
+
+
+def _concatenate_files(file_paths: list[str], excluded_extensions: list[str]) -> str:
+    """Concatenate the content of multiple files into a single string."""
+    file_contents = []
+    for file_path in _get_existing_files(file_paths, excluded_extensions):
+        try:
+            file_content = _read_file(file_path)
+        except UnicodeDecodeError as e:
+            print(f"Error reading file '{file_path}': {e}")
+            continue
+        if is_notebook(file_path):
+            file_content = compact_notebook(file_content)
 
-            file_contents.append(f"START FILE '{file_path}' >>>>>>>>>>>>>>>>\n")
-            file_contents.append(file_content)
-            file_contents.append(f"\n<<<<<<<<<<<<<<<< END FILE '{file_path}'")
+        file_contents.append(get_file_start(file_path))
+        file_contents.append(file_content)
+        file_contents.append(get_file_end(file_path))
 
     print(f"Got {len(file_contents)} lines..")
-    return "\n\n".join(file_contents)
+    return SEPARATOR.join(file_contents)
+
+
+def _prefetch_file(file_path: str) -> str | bool | None:
+    """Check the first bytes of a file and read it if it is small.
+
+    Returns the content of small text files and notebooks (in compact form), True for large text files that are
+    to be copied in chunks, and None for binary files and files that cannot be decoded.
+    """
+    with open(file_path, "rb") as infile:
+        if b"\0" in infile.read(SNIFF_BYTES):
+            print(f"Skipping binary file '{file_path}'.")
+            return None
+
+    if os.path.getsize(file_path) > CHUNK_SIZE and not is_notebook(file_path):
+        return True
+
+    try:
+        content = _read_file(file_path)
+        return compact_notebook(content) if is_notebook(file_path) else content
+    except UnicodeDecodeError as e:
+        print(f"Error reading file '{file_path}': {e}")
+        return None
+
+
+def _copy_file(file_path: str, outfile: BinaryIO) -> bool:
+    """Copy a large text file to `outfile` in chunks, with the same newline handling as `_read_file`.
+
+    Returns False if the file cannot be decoded, the part copied so far is then left in `outfile`.
+    """
+    try:
+        # universal newlines mode translates '\r\n' and '\r' also across chunk boundaries
+        with open(file_path, "r", encoding="utf-8", newline=None) as infile:
+            while chunk := infile.read(CHUNK_SIZE):
+                outfile.write(chunk.encode())
+    except UnicodeDecodeError as e:
+        print(f"Error reading file '{file_path}': {e}")
+        return False
+    return True
+
+
+def _write_files(
+    file_paths: list[str],
+    excluded_extensions: list[str],
+    outfile: BinaryIO,
+    max_workers: int = MAX_WORKERS,
+) -> int:
+    """Write the content of multiple files to `outfile`, in the same format as `_concatenate_files`.
+
+    Files are read concurrently, but written in the given order. At most `2 * max_workers` small files
+    are held in memory at a time, larger files are copied in chunks. Returns the number of files written.
+    """
+    num_files = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        file_paths_iter = iter(_get_existing_files(file_paths, excluded_extensions))
+        while True:
+            while len(pending) < 2 * max_workers and (file_path := next(file_paths_iter, None)):
+                pending.append((file_path, executor.submit(_prefetch_file, file_path)))
+            if not pending:
+                break
+
+            file_path, future = pending.popleft()
+            if (content := future.result()) is None:
+                continue
+
+            start_position = outfile.tell()
+            outfile.write(((SEPARATOR if num_files else "") + get_file_start(file_path) + SEPARATOR).encode())
+            if content is True:
+                if not _copy_file(file_path, outfile):
+                    # remove the part of the file that was written already
+                    outfile.seek(start_position)
+                    outfile.truncate()
+                    continue
+            else:
+                outfile.write(content.encode())
+            outfile.write((SEPARATOR + get_file_end(file_path)).encode())
+            num_files += 1
+
+    print(f"Wrote {num_files} files..")
+    return num_files
 
 
 if __name__ == "__main__":
@@ -54,11 +192,27 @@ if __name__ == "__main__":
     excluded_extensions = sys.argv[3].split(";") if len(sys.argv) > 3 else []
 
     print(f"Concatenating {file_paths=} with {excluded_extensions=}")
-    concatenated_string = _concatenate_files(file_paths, excluded_extensions)
-
-    with open(output_path, "w") as outfile:
-        print(
-            f"Writing concatenated content of length {len(concatenated_string)} to '{output_path}' .."
-        )
-        outfile.write(concatenated_string)
+    tracer = Tracer()
+
+    with tracer.span("file_dump", mode=MODE, files=len(file_paths)) as attributes:
+        if MODE == MODE_STREAM:
+            with open(output_path, "wb") as outfile:
+                print(f"Writing files to '{output_path}' ..")
+                attributes["dumped_files"] = _write_files(file_paths, excluded_extensions, outfile)
+
+        elif MODE == MODE_JOIN:
+            concatenated_string = _concatenate_files(file_paths, excluded_extensions)
+
+            with open(output_path, "w") as outfile:
+                print(
+                    f"Writing concatenated content of length {len(concatenated_string)} to '{output_path}' .."
+                )
+                outfile.write(concatenated_string)
+
+        else:
+            raise ValueError(
+                f"Unknown FILES_TO_STRING_MODE '{MODE}', use '{MODE_JOIN}' or '{MODE_STREAM}'."
+            )
+        attributes["bytes"] = os.path.getsize(output_path)
+    tracer.write()
     print("Done.")
@@ -0,0 +1,140 @@
+"""GitHub client shared by the scripts of the code review action, with a cache for conditional requests.
+
+GET requests are sent with the ETag of the last response to the same URL. If nothing changed, GitHub answers
+with `304 Not Modified`, which does not count against the rate limit, and the cached response is used instead.
+The cache is stored on disk, so it is shared between the scripts and can be restored between workflow runs.
+All requests are sent through one keep-alive session.
+
+Optional environment:
+- GITHUB_API_URL: The URL of the GitHub API (default: https://api.github.com).
+- CODE_REVIEW_CACHE_DIR, CODE_REVIEW_CACHE_MAX_MB: Configuration of the cache, cf. `blob_cache.py`.
+    The responses are stored in the 'http' subdirectory. If not set, no responses are cached.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from github import Github
+from github.Requester import (
+    HTTPRequestsConnectionClass,
+    HTTPSRequestsConnectionClass,
+    Requester,
+)
+
+from blob_cache import CACHE_DIR, BlobCache
+
+_initialized = False
+
+
+class CachedResponse:
+    """A cached response, mimicking `github.Requester.RequestsResponse`."""
+
+    def __init__(self, status: int, headers: dict[str, str], text: str):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self) -> str:
+        return self.text
+
+
+class _CachingConnection:
+    """Mixin for the connection classes of PyGithub that sends conditional GET requests and replays cached
+    responses on `304 Not Modified`."""
+
+    cache = BlobCache(os.path.join(CACHE_DIR, "http") if CACHE_DIR else None)
+    num_requests = 0
+    num_not_modified = 0
+
+    _shared_sessions = {}  # by protocol
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # PyGithub creates a connection per request when connection classes are injected,
+        # share one session between them to keep the connections alive
+        with _CachingConnection._lock:
+            if self.protocol not in _CachingConnection._shared_sessions:
+                _CachingConnection._shared_sessions[self.protocol] = self.session
+            else:
+                self.session.close()
+                self.session = _CachingConnection._shared_sessions[self.protocol]
+
+    def _get_cache_key(self) -> str:
+        accept = {key.lower(): value for key, value in self.headers.items()}.get("accept", "")
+        return hashlib.sha256(f"{self.host}:{self.port}{self.url} {accept}".encode()).hexdigest()
+
+    def getresponse(self):
+        cache_key = None
+        cached = None
+        if self.verb == "GET" and self.cache.cache_dir is not None:
+            cache_key = self._get_cache_key()
+            if (cached_bytes := self.cache.get(cache_key)) is not None:
+                cached = json.loads(cached_bytes)
+                self.headers = {**self.headers, "If-None-Match": cached["etag"]}
+
+        response = super().getresponse()
+
+        with _CachingConnection._lock:
+            _CachingConnection.num_requests += 1
+            if response.status == 304 and cached is not None:
+                _CachingConnection.num_not_modified += 1
+
+        if response.status == 304 and cached is not None:
+            # the new headers contain e.g. the current rate limit
+            return CachedResponse(200, {**cached["headers"], **response.headers}, cached["text"])
+
+        if cache_key is not None and response.status == 200 and (etag := response.headers.get("ETag")):
+            cached = {"etag": etag, "headers": dict(response.headers), "text": response.text}
+            self.cache.put(cache_key, json.dumps(cached).encode())
+
+        return response
+
+    def close(self) -> None:
+        # the session is shared, it is closed when the process ends
+        pass
+
+
+class CachingHTTPSConnection(_CachingConnection, HTTPSRequestsConnectionClass):
+    """HTTPS connection with caching, used for the GitHub API."""
+
+
+class CachingHTTPConnection(_CachingConnection, HTTPRequestsConnectionClass):
+    """HTTP connection with caching, e.g. for a local fake of the GitHub API (cf. `benchmark.py`)."""
+
+
+def get_num_requests() -> int:
+    """Get the number of GitHub API requests made by this process so far."""
+    return _CachingConnection.num_requests
+
+
+def _print_stats() -> None:
+    """Print the number of requests and how many of them were answered from the cache."""
+    print(
+        f"{os.path.basename(sys.argv[0])}: {_CachingConnection.num_requests} GitHub API requests, "
+        f"{_CachingConnection.num_not_modified} served from cache."
+    )
+    _CachingConnection.cache.evict()
+
+
+def get_github(token: str, **kwargs) -> Github:
+    """Get a GitHub client that uses the caching connections, `kwargs` are passed to `Github`.
+
+    The API is taken from GITHUB_API_URL if set (as in GitHub Actions, e.g. for GitHub Enterprise Server).
+    """
+    global _initialized
+    if not _initialized:
+        Requester.injectConnectionClasses(CachingHTTPConnection, CachingHTTPSConnection)
+        atexit.register(_print_stats)
+        _initialized = True
+
+    if api_url := os.environ.get("GITHUB_API_URL"):
+        kwargs.setdefault("base_url", api_url)
+    return Github(token, **kwargs)
@@ -0,0 +1,66 @@
+"""Incremental parsing of the JSON array of review items while the answer is streamed."""
+
+import json
+
+
+class JsonArrayStreamParser:
+    """Parse the objects of a JSON array from a stream of text chunks.
+
+    Each object is returned as soon as its closing bracket was fed. Text outside of the array
+    (e.g. an introduction by the model) is ignored, as are objects that are not valid JSON:
+    these are left to the parsing of the full answer.
+    """
+
+    def __init__(self):
+        self._in_array = False
+        self._depth = 0  # nesting depth inside the current item, 0 if between items
+        self._in_string = False
+        self._escaped = False
+        self._item_chars: list[str] = []
+        self.num_items = 0
+
+    def feed(self, text: str) -> list[dict]:
+        """Feed the next chunk of text and get the items that were completed by it."""
+        items = []
+        for char in text:
+            if not self._in_array:
+                # a new array might start after the previous one was closed
+                self._in_array = char == "["
+                continue
+
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                    self._item_chars = [char]
+                elif char == "]":
+                    self._in_array = False
+                continue
+
+            self._item_chars.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0 and (item := self._parse_item()) is not None:
+                    items.append(item)
+
+        self.num_items += len(items)
+        return items
+
+    def _parse_item(self) -> dict | None:
+        item_string = "".join(self._item_chars)
+        try:
+            item = json.loads(item_string)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding streamed JSON item: {e}")
+            return None
+        return item if isinstance(item, dict) else None
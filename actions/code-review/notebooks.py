@@ -0,0 +1,122 @@
+"""Compact Jupyter notebooks to the sources of their cells, for the review.
+
+Most of the JSON of a notebook are outputs (e.g. base64-encoded images) and metadata. In the compact form, each cell
+is a header with its number and type, followed by its source and a one-line summary of each of its outputs:
+
+    # %% [cell 3] code
+    df = load_data()
+    df.plot()
+    # [output: text/plain, 1 line; image/png]
+
+The patches of notebooks are created from the compact form of both versions. Like git does with the enclosing
+function, the cell of each hunk is added to its header, e.g. `@@ -10,4 +10,5 @@ [cell 3]`. As GitHub diffs
+notebooks as JSON, review comments cannot be placed on the lines of the compact form, and are posted with the
+number of their cell instead (cf. `diff_index.py`).
+"""
+
+import difflib
+import json
+import re
+from bisect import bisect_right
+
+NOTEBOOK_EXTENSION = ".ipynb"
+
+CELL_HEADER = "# %% [cell {number}] {cell_type}"
+CELL_HEADER_PATTERN = re.compile(r"^# %% \[cell (\d+)\]")
+OUTPUT_SUMMARY = "# [output: {summary}]"
+MAX_SUMMARY_CHARS = 200
+
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+HUNK_CELL_PATTERN = re.compile(r"^@@ .* @@ \[cell (\d+)\]")
+
+
+def is_notebook(file_name: str) -> bool:
+    return file_name.endswith(NOTEBOOK_EXTENSION)
+
+
+def _get_text(value: str | list[str]) -> str:
+    """Get the text of a multiline field, which is stored as a string or as a list of lines."""
+    return "".join(value) if isinstance(value, list) else value
+
+
+def _count_lines(value: str | list[str]) -> str:
+    num_lines = len(_get_text(value).splitlines())
+    return f"{num_lines} line" if num_lines == 1 else f"{num_lines} lines"
+
+
+def _summarize_output(output: dict) -> str:
+    output_type = output.get("output_type", "output")
+    if output_type == "stream":
+        summary = f"{output.get('name', 'stream')}, {_count_lines(output.get('text', ''))}"
+    elif output_type == "error":
+        # the message of an error is short and relevant for the review
+        summary = f"{output.get('ename')}: {output.get('evalue', '')}"
+    else:  # execute_result and display_data
+        summary = "; ".join(
+            f"{mime_type}, {_count_lines(value)}" if mime_type.startswith("text/") else mime_type
+            for mime_type, value in output.get("data", {}).items()
+        ) or output_type
+    return OUTPUT_SUMMARY.format(summary=summary[:MAX_SUMMARY_CHARS].replace("\n", " "))
+
+
+def compact_notebook(content: str) -> str:
+    """Get the compact form of a notebook.
+
+    Returns the content unchanged if it is not a notebook in the current format (nbformat 4).
+    """
+    try:
+        cells = json.loads(content)["cells"]
+    except (ValueError, KeyError, TypeError):
+        return content
+
+    lines = []
+    for number, cell in enumerate(cells, start=1):
+        lines.append(CELL_HEADER.format(number=number, cell_type=cell.get("cell_type", "code")))
+        lines.extend(_get_text(cell.get("source", "")).splitlines())
+        lines.extend(_summarize_output(output) for output in cell.get("outputs", []))
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _get_cell(cell_starts: list[int], line: int) -> int:
+    """Get the number of the cell of a line of the compact form, given the lines of the cell headers."""
+    return max(bisect_right(cell_starts, line), 1)
+
+
+def create_notebook_patch(original_content: str, new_content: str) -> str:
+    """Create the patch of a notebook from the compact forms of both versions, in the format of `File.patch`.
+
+    The cell of the first line of each hunk is added to the hunk header.
+    """
+    original_lines = compact_notebook(original_content).splitlines()
+    new_lines = compact_notebook(new_content).splitlines()
+    original_cell_starts, new_cell_starts = [
+        [i for i, line in enumerate(lines, start=1) if CELL_HEADER_PATTERN.match(line)]
+        for lines in [original_lines, new_lines]
+    ]
+
+    patch_lines = list(difflib.unified_diff(original_lines, new_lines, lineterm=""))[2:]
+    for i, patch_line in enumerate(patch_lines):
+        if match := HUNK_HEADER_PATTERN.match(patch_line):
+            if match.group(3) == "0":  # the hunk removes all lines
+                cell = _get_cell(original_cell_starts, int(match.group(1)))
+            else:
+                cell = _get_cell(new_cell_starts, int(match.group(2)))
+            patch_lines[i] = f"{patch_line} [cell {cell}]"
+    return "\n".join(patch_lines)
+
+
+def get_commentable_cells(patch: str) -> dict[int, int]:
+    """Get the cell of each line on the RIGHT side of the patch of a notebook (cf. `create_notebook_patch()`)."""
+    cells = {}
+    line = None  # current line number on the RIGHT side, None outside of hunks
+    cell = 1
+    for patch_line in patch.split("\n"):
+        if match := HUNK_HEADER_PATTERN.match(patch_line):
+            line = int(match.group(2))
+            cell = int(cell_match.group(1)) if (cell_match := HUNK_CELL_PATTERN.match(patch_line)) else 1
+        elif line is not None and patch_line.startswith(("+", " ")):
+            if cell_match := CELL_HEADER_PATTERN.match(patch_line[1:]):
+                cell = int(cell_match.group(1))
+            cells[line] = cell
+            line += 1
+    return cells
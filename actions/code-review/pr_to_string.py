@@ -5,6 +5,16 @@ Required environment:
 - GITHUB_REPOSITORY: The repository of the pull request.
 - GITHUB_TOKEN: The token to authenticate with the GitHub API.
 
+Optional environment:
+- PR_TO_STRING_MAX_WORKERS: Number of concurrent requests to the GitHub API (default: 8).
+- PATCH_BACKEND: Where to get the patches from: 'api' (default) for the GitHub API,
+    'git' for a local `git diff BASE_SHA...HEAD_SHA` (needs the history of both commits in the current directory).
+    With both backends, the patches of notebooks are created from their compact form, cf. `notebooks.py`.
+- BASE_SHA, HEAD_SHA: The base and head commits of the pull request, required for the 'git' backend.
+- CODE_REVIEW_CACHE_DIR, CODE_REVIEW_CACHE_MAX_MB: Configuration of the file content and API response cache,
+    cf. `blob_cache.py` and `github_client.py`.
+- CODE_REVIEW_TRACE_PATH: Trace file to add the duration of fetching the patches to, cf. `tracing.py`.
+
 Required arguments:
 - whitespace-separated list of relative paths of files changed in the pull request.
 
@@ -13,76 +23,322 @@ Returns
 - A formatted string containing the data of the pull request.
 """
 
+import base64
+import codecs
+import math
 import os
+import re
+import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import TextIO
 
 from github import Github, File
+from github.PullRequest import PullRequest
+from github.Repository import Repository
+
+from blob_cache import BlobCache
+from github_client import get_github, get_num_requests
+from notebooks import create_notebook_patch, is_notebook
+from tracing import Tracer
+
+MAX_WORKERS = int(os.environ.get("PR_TO_STRING_MAX_WORKERS", 8))
+PER_PAGE = 100  # maximum allowed by the GitHub API
+
+BACKEND_API = "api"
+BACKEND_GIT = "git"
+PATCH_BACKEND = os.environ.get("PATCH_BACKEND", BACKEND_API)
+
+NO_PATCH_AVAILABLE = "Binary file or no patch available"
+
+QUOTED_NAME_PATTERN = re.compile(r'^"((?:[^"\\]|\\.)*)"')
 
-g = Github(os.environ["GITHUB_TOKEN"])
-repo = g.get_repo(os.environ["GITHUB_REPOSITORY"])
-pr = repo.get_pull(int(os.environ["GITHUB_EVENT_NUMBER"]))
+PATCHES_HEADER = "=============\nSTART ALL PATCHES:\n\n"
+PATCHES_FOOTER = "END ALL PATCHES\n============="
 
 
-def _get_file_content(file_path: str, commit_sha: str) -> str:
-    """Get the content of a file in a specific commit."""
+def get_concurrent_github(max_workers: int = MAX_WORKERS) -> Github:
+    """Get a GitHub client suited for concurrent read requests.
+
+    All threads share the keep-alive connection pool of the client, which is sized to the number of workers.
+    The default throttling between requests is disabled, as it would serialize the concurrent reads.
+    """
+    return get_github(
+        os.environ["GITHUB_TOKEN"],
+        per_page=PER_PAGE,
+        pool_size=max_workers,
+        seconds_between_requests=None,
+    )
+
+
+def _get_file_content(
+    repo: Repository,
+    file_path: str,
+    commit_sha: str,
+    cache: BlobCache,
+    blob_sha: str | None = None,
+) -> str:
+    """Get the content of a file in a specific commit.
+
+    If the blob SHA of the file is known (e.g. `File.sha` for the head commit), the content is taken from the
+    cache if possible. Otherwise, it is fetched and then stored in the cache under its blob SHA.
+    """
     try:
-        return repo.get_contents(file_path, ref=commit_sha).decoded_content.decode()
+        if blob_sha is not None:
+            content = cache.get_or_fetch(
+                blob_sha, lambda: base64.b64decode(repo.get_git_blob(blob_sha).content)
+            )
+        else:
+            content_file = repo.get_contents(file_path, ref=commit_sha)
+            content = content_file.decoded_content
+            cache.put(content_file.sha, content)
+        return content.decode()
     except Exception:  # if file doesn't exist in that commit
         return ""
 
 
-def _get_file_patch(file: File) -> str:
+def get_file_patch(file: File) -> str:
     """Get the patch of a file."""
-    return file.patch if file.patch else "Binary file or no patch available"
+    return file.patch if file.patch else NO_PATCH_AVAILABLE
+
+
+def get_base_blob_shas(repo: Repository, base_sha: str) -> dict[str, str]:
+    """Get the blob SHAs of all files in the base commit, by path."""
+    tree = repo.get_git_tree(base_sha, recursive=True)
+    return {element.path: element.sha for element in tree.tree if element.type == "blob"}
+
+
+def get_merge_base_sha(repo: Repository, pr: PullRequest) -> str:
+    """Get the merge base of the base and head commit of a pull request, which GitHub shows its changes against."""
+    return repo.compare(pr.base.sha, pr.head.sha).merge_base_commit.sha
+
+
+def get_notebook_patch(
+    repo: Repository,
+    file: File,
+    base_sha: str,
+    head_sha: str,
+    cache: BlobCache,
+    base_blob_sha: str | None = None,
+) -> str:
+    """Create the patch of a notebook from the compact form of both versions, instead of its JSON.
+
+    For pull requests, `base_sha` needs to be the merge base (cf. `get_merge_base_sha()`).
+    """
+    original_content = (
+        ""
+        if file.status == "added"
+        else _get_file_content(repo, file.previous_filename or file.filename, base_sha, cache, base_blob_sha)
+    )
+    new_content = (
+        "" if file.status == "removed" else _get_file_content(repo, file.filename, head_sha, cache, file.sha)
+    )
+    return create_notebook_patch(original_content, new_content) or NO_PATCH_AVAILABLE
+
+
+def get_pr_files(
+    pr: PullRequest, changed_files: list[str] | None, max_workers: int = MAX_WORKERS
+) -> list[File]:
+    """Get the files of the pull request that are in `changed_files` (all if None), sorted by file name.
+
+    The pages of the file listing are fetched concurrently, the order of the result does not depend on the
+    order in which the requests finish.
+    """
+    paginated_files = pr.get_files()
+    num_pages = max(math.ceil(pr.changed_files / PER_PAGE), 1)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, num_pages)) as executor:
+        pages = list(executor.map(paginated_files.get_page, range(num_pages)))
+
+    files = [file for page in pages for file in page]
+    if changed_files is not None:
+        changed_files_set = set(changed_files)
+        files = [file for file in files if file.filename in changed_files_set]
+    return sorted(files, key=lambda file: file.filename)
+
 
+def _get_patch_start(file_name: str) -> str:
+    """Get the line that marks the start of the patch of a file."""
+    prefix = "" if file_name.startswith("./") else "./"
+    return f"START PATCH FOR FILE: '{prefix}{file_name}' >>>>>>>>>>>>>>>>\n"
 
-def _format_pr(pr_data: list[dict[str, str]]) -> str:
+
+def _get_patch_end(file_name: str) -> str:
+    """Get the line that marks the end of the patch of a file, followed by an empty line."""
+    prefix = "" if file_name.startswith("./") else "./"
+    return f"<<<<<<<<<<<<<<<< END PATCH FOR FILE: '{prefix}{file_name}'\n\n"
+
+
+def format_pr(pr_data: list[dict[str, str]]) -> str:
     """Format the data of the pull request to a AI-readable format."""
-    pr_contents = ["=============", "START ALL PATCHES:", ""]
+    pr_contents = [PATCHES_HEADER]
 
     for item in pr_data:
         file_name = item["file_name"]
-        prefix = "" if file_name.startswith("./") else "./"
+        pr_contents.append(_get_patch_start(file_name))
+        pr_contents.append(f"{item['patch']}\n")
+        pr_contents.append(_get_patch_end(file_name))
+
+    pr_contents.append(PATCHES_FOOTER)
+
+    return "".join(pr_contents)
+
+
+def _parse_diff_header(line: str) -> str:
+    """Get the file name from a `diff --git a/<file_name> b/<file_name>` line.
+
+    Only valid for diffs without renames, where both file names are the same.
+    """
+    names = line[len("diff --git ") :].rstrip("\n")
+    if match := QUOTED_NAME_PATTERN.match(names):
+        # git quotes file names with special characters, using C-style escapes (e.g. '\t', '\"')
+        return codecs.escape_decode(match.group(1).encode())[0].decode()[len("a/") :]
+    return names[len("a/") : len("a/") + (len(names) - len("a/ b/")) // 2]
+
+
+def _git_show(sha: str, file_name: str, repo_path: str = ".") -> str:
+    """Get the content of a file in a commit from the local repository, an empty string if it does not exist."""
+    result = subprocess.run(["git", "show", f"{sha}:{file_name}"], cwd=repo_path, capture_output=True)
+    return result.stdout.decode(errors="replace") if result.returncode == 0 else ""
+
+
+def write_git_patches(
+    changed_files: list[str],
+    base_sha: str,
+    head_sha: str,
+    outfile: TextIO,
+    repo_path: str = ".",
+) -> None:
+    """Write the patches of the changed files from a local `git diff base_sha...head_sha` to `outfile`.
 
-        pr_contents.append(
-            f"START PATCH FOR FILE: '{prefix}{file_name}' >>>>>>>>>>>>>>>>"
-        )
-        pr_contents.append(item["patch"])
-        pr_contents.append(
-            f"<<<<<<<<<<<<<<<< END PATCH FOR FILE: '{prefix}{file_name}'"
-        )
-        pr_contents.append("")
+    The output of git is streamed, and has the same format as `format_pr()`. Like in `File.patch` of the
+    GitHub API, the patch of a file consists of its hunks only, without the preceding diff headers.
+    The patches of notebooks are created from the compact form of both versions instead.
+    """
+    command = [
+        "git",
+        "-c",
+        "core.quotePath=false",
+        "diff",
+        "--no-color",
+        "--no-ext-diff",
+        "--no-renames",
+        f"{base_sha}...{head_sha}",
+    ]
+    changed_files_set = set(changed_files)
 
-    pr_contents.append("END ALL PATCHES")
-    pr_contents.append("=============")
+    outfile.write(PATCHES_HEADER)
 
-    return "\n".join(pr_contents)
+    file_name = None  # file whose patch is currently written, None if the current file is skipped
+    in_hunks = False
+    merge_base_sha = None  # the LEFT side of the diff, needed for notebooks only
+
+    def _end_patch():
+        nonlocal merge_base_sha
+        if file_name is not None:
+            if is_notebook(file_name):
+                if merge_base_sha is None:
+                    merge_base_sha = subprocess.run(
+                        ["git", "merge-base", base_sha, head_sha],
+                        cwd=repo_path,
+                        capture_output=True,
+                        text=True,
+                        check=True,
+                    ).stdout.strip()
+                patch = create_notebook_patch(
+                    _git_show(merge_base_sha, file_name, repo_path), _git_show(head_sha, file_name, repo_path)
+                )
+                outfile.write(f"{patch or NO_PATCH_AVAILABLE}\n")
+            elif not in_hunks:
+                outfile.write(f"{NO_PATCH_AVAILABLE}\n")
+            outfile.write(_get_patch_end(file_name))
+
+    with subprocess.Popen(
+        command,
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    ) as process:
+        for line in process.stdout:
+            if line.startswith("diff --git "):
+                _end_patch()
+                file_name = _parse_diff_header(line)
+                in_hunks = False
+                if file_name in changed_files_set:
+                    outfile.write(_get_patch_start(file_name))
+                else:
+                    file_name = None
+            elif file_name is None or is_notebook(file_name):
+                continue
+            elif in_hunks or line.startswith("@@"):
+                in_hunks = True
+                outfile.write(line)
+        _end_patch()
+
+    if process.returncode != 0:
+        raise ValueError(f"'{' '.join(command)}' failed with exit code {process.returncode}")
+
+    outfile.write(PATCHES_FOOTER)
 
 
 if __name__ == "__main__":
     changed_files = sys.argv[1].split()
     output_path = sys.argv[2]
 
-    pr_data: list[dict[str, str]] = []
-    for file in pr.get_files():
-        file_name = file.filename
-        if file_name in changed_files:
-            original_content = _get_file_content(file_name, pr.base.sha)
-            new_content = _get_file_content(file_name, pr.head.sha)
-            patch = _get_file_patch(file)
-            pr_data.append(
-                {
-                    "file_name": file_name,
-                    "original_content": original_content,
-                    "new_content": new_content,
-                    "patch": patch,
-                }
-            )
+    blob_cache = BlobCache()
+    tracer = Tracer()
+
+    num_requests = get_num_requests()
+    with tracer.span("pr_fetch", backend=PATCH_BACKEND, files=len(changed_files)) as attributes:
+        if PATCH_BACKEND == BACKEND_GIT:
+            with open(output_path, "w") as outfile:
+                write_git_patches(
+                    changed_files, os.environ["BASE_SHA"], os.environ["HEAD_SHA"], outfile
+                )
 
-    formatted_pr = _format_pr(pr_data)
+        elif PATCH_BACKEND == BACKEND_API:
+            g = get_concurrent_github()
+            repo = g.get_repo(os.environ["GITHUB_REPOSITORY"])
+            pr = repo.get_pull(int(os.environ["GITHUB_EVENT_NUMBER"]))
+
+            pr_data: list[dict[str, str]] = []
+            merge_base_sha, base_blob_shas = None, None
+            for file in get_pr_files(pr, changed_files):
+                # file contents are only needed for notebooks
+                if is_notebook(file.filename):
+                    if merge_base_sha is None:
+                        # the changes on the base branch since the merge base are not part of the pull request
+                        merge_base_sha = get_merge_base_sha(repo, pr)
+                        base_blob_shas = get_base_blob_shas(repo, merge_base_sha)
+                    patch = get_notebook_patch(
+                        repo,
+                        file,
+                        merge_base_sha,
+                        pr.head.sha,
+                        blob_cache,
+                        base_blob_shas.get(file.previous_filename or file.filename),
+                    )
+                else:
+                    patch = get_file_patch(file)
+                pr_data.append({"file_name": file.filename, "patch": patch})
+
+            formatted_pr = format_pr(pr_data)
+
+            with open(output_path, "w") as outfile:
+                outfile.write(formatted_pr)
+
+        else:
+            raise ValueError(
+                f"Unknown PATCH_BACKEND '{PATCH_BACKEND}', use '{BACKEND_API}' or '{BACKEND_GIT}'."
+            )
+        attributes["bytes"] = os.path.getsize(output_path)
+        attributes["github_requests"] = get_num_requests() - num_requests
+    tracer.write()
 
-    with open(output_path, "w") as outfile:
-        outfile.write(formatted_pr)
+    blob_cache.evict()
+    blob_cache.print_stats()
 
 # try:
 #     review_comments = {file: [(1, 'cool')] for file in changed_files}
@@ -0,0 +1,248 @@
+"""Review a pull request in a single process, without intermediate files.
+
+Alternative to running `pr_to_string.py`, `files_to_string.py`, `symbol_index.py` and `code_review_bot.py` one
+after the other: the metadata of the pull request, the patches and the contents of the changed files in the base
+commit are fetched concurrently from the GitHub API, so no checkout of the base branch is needed. The dumps are
+built in memory, in the same format as the scripts write them, and passed directly to the review.
+
+Required environment:
+- GITHUB_EVENT_NUMBER, GITHUB_REPOSITORY, GITHUB_TOKEN: cf. `pr_to_string.py`.
+- ANTHROPIC_API_KEY, CODE_REVIEW_PROMPT, CODE_REVIEW_SYSTEM_MESSAGE: cf. `code_review_bot.py`.
+
+Optional environment:
+- GITHUB_WORKSPACE_PATH: If set, 'patches.txt', 'changed_files.txt' and 'answer.txt' are written to this
+    directory, e.g. to upload them as artifacts.
+- PR_TO_STRING_MAX_WORKERS: Number of concurrent requests to the GitHub API (default: 8).
+- PATCH_BACKEND, BASE_SHA, HEAD_SHA: cf. `pr_to_string.py`. The 'git' backend needs the history of both commits
+    in the current directory.
+- EXCLUDED_EXTENSIONS: Semicolon-separated list of file extensions not to dump the contents of, e.g. 'ipynb;txt'.
+- SYMBOL_CONTEXT_TOKENS: Token budget of the definitions of symbols used in the changes (default: 0, disabled).
+    The definitions are taken from the current checkout, cf. `symbol_index.py`.
+- CODE_REVIEW_CACHE_DIR, CODE_REVIEW_CACHE_MAX_MB: Configuration of the cache, cf. `blob_cache.py`.
+- CODE_REVIEW_TRACE_PATH: Path of the trace file of the stages of the review, cf. `tracing.py`.
+"""
+
+import asyncio
+import base64
+import io
+import os
+
+from github.File import File
+from github.PullRequest import PullRequest
+from github.Repository import Repository
+
+from blob_cache import BlobCache
+from code_review_bot import CodeReviewBot
+from files_to_string import SEPARATOR, decode_text, get_file_end, get_file_start
+from github_client import get_num_requests
+from notebooks import compact_notebook, is_notebook
+from pr_to_string import (
+    BACKEND_API,
+    BACKEND_GIT,
+    MAX_WORKERS,
+    PATCH_BACKEND,
+    format_pr,
+    get_base_blob_shas,
+    get_concurrent_github,
+    get_file_patch,
+    get_merge_base_sha,
+    get_notebook_patch,
+    get_pr_files,
+    write_git_patches,
+)
+from tracing import Tracer
+
+EXCLUDED_EXTENSIONS = [
+    extension for extension in os.environ.get("EXCLUDED_EXTENSIONS", "").split(";") if extension
+]
+SYMBOL_CONTEXT_TOKENS = int(os.environ.get("SYMBOL_CONTEXT_TOKENS", 0))
+
+
+def _get_base_content(repo: Repository, blob_sha: str, cache: BlobCache) -> str | None:
+    """Get the content of a file in the base commit by its blob SHA, None for binary files."""
+    data = cache.get_or_fetch(blob_sha, lambda: base64.b64decode(repo.get_git_blob(blob_sha).content))
+    try:
+        return decode_text(data)
+    except UnicodeDecodeError:
+        return None
+
+
+def _is_dumped(file: File, base_blob_shas: dict[str, str]) -> bool:
+    """Whether the content of a file is part of the dump of the changed files.
+
+    Like `files_to_string.py` on a checkout of the base branch, only files that exist there under the same name.
+    """
+    return (
+        file.status != "removed"
+        and file.filename in base_blob_shas
+        and not file.filename.endswith(tuple(EXCLUDED_EXTENSIONS))
+    )
+
+
+class ReviewPipeline:
+    """Fetch the input of the review of a pull request concurrently, and run the review."""
+
+    def __init__(
+        self,
+        repo_name: str,
+        pr_number: int,
+        max_workers: int = MAX_WORKERS,
+        patch_backend: str = PATCH_BACKEND,
+        symbol_context_tokens: int = SYMBOL_CONTEXT_TOKENS,
+        write_side_outputs: bool = True,
+        anthropic_client=None,
+    ):
+        self.repo_name = repo_name
+        self.pr_number = pr_number
+        self.patch_backend = patch_backend
+        self.symbol_context_tokens = symbol_context_tokens
+        self.github = get_concurrent_github(max_workers)
+        self.cache = BlobCache()
+        self.anthropic_client = anthropic_client
+        self.workspace_path = os.environ.get("GITHUB_WORKSPACE_PATH") if write_side_outputs else None
+        # bounds the number of threads that make requests at the same time
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self.tracer = Tracer()
+
+    async def _run(self, func, *args):
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    async def _get_patch(
+        self, repo: Repository, file: File, merge_base_sha: str, head_sha: str, merge_base_blob_shas: dict[str, str]
+    ) -> str:
+        if not is_notebook(file.filename):
+            return get_file_patch(file)
+        return await self._run(
+            get_notebook_patch,
+            repo,
+            file,
+            merge_base_sha,
+            head_sha,
+            self.cache,
+            merge_base_blob_shas.get(file.previous_filename or file.filename),
+        )
+
+    async def _get_patches_str(
+        self, repo: Repository, pr: PullRequest, files: list[File], base_blob_shas: dict[str, str]
+    ) -> str:
+        if self.patch_backend == BACKEND_GIT:
+            outfile = io.StringIO()
+            await asyncio.to_thread(
+                write_git_patches,
+                [file.filename for file in files if file.status != "removed"],
+                os.environ["BASE_SHA"],
+                os.environ["HEAD_SHA"],
+                outfile,
+            )
+            return outfile.getvalue()
+
+        if self.patch_backend != BACKEND_API:
+            raise ValueError(
+                f"Unknown PATCH_BACKEND '{self.patch_backend}', use '{BACKEND_API}' or '{BACKEND_GIT}'."
+            )
+
+        # like on GitHub, the patches are created against the merge base, not the current base commit
+        merge_base_sha, merge_base_blob_shas = pr.base.sha, base_blob_shas
+        if any(is_notebook(file.filename) for file in files):
+            merge_base_sha = await self._run(get_merge_base_sha, repo, pr)
+            if merge_base_sha != pr.base.sha:
+                merge_base_blob_shas = await self._run(get_base_blob_shas, repo, merge_base_sha)
+
+        patches = await asyncio.gather(
+            *(self._get_patch(repo, file, merge_base_sha, pr.head.sha, merge_base_blob_shas) for file in files)
+        )
+        return format_pr(
+            [{"file_name": file.filename, "patch": patch} for file, patch in zip(files, patches)]
+        )
+
+    async def _get_changed_files_str(
+        self, repo: Repository, files: list[File], base_blob_shas: dict[str, str]
+    ) -> str:
+        dumped_files = [file for file in files if _is_dumped(file, base_blob_shas)]
+        contents = await asyncio.gather(
+            *(self._run(_get_base_content, repo, base_blob_shas[file.filename], self.cache) for file in dumped_files)
+        )
+
+        sections = []
+        for file, content in zip(dumped_files, contents):
+            file_name = f"./{file.filename}"
+            if content is None:
+                print(f"Skipping binary file '{file_name}'")
+                continue
+            if is_notebook(file_name):
+                content = compact_notebook(content)
+            sections.append(get_file_start(file_name) + SEPARATOR + content + SEPARATOR + get_file_end(file_name))
+        return SEPARATOR.join(sections)
+
+    async def _trace_file_dump(
+        self, repo: Repository, files: list[File], base_blob_shas: dict[str, str]
+    ) -> str:
+        with self.tracer.span("file_dump", mode="api") as attributes:
+            changed_files_str = await self._get_changed_files_str(repo, files, base_blob_shas)
+            attributes["bytes"] = len(changed_files_str)
+        return changed_files_str
+
+    def _write_side_output(self, file_name: str, content: str) -> None:
+        if self.workspace_path:
+            with open(os.path.join(self.workspace_path, file_name), "w") as outfile:
+                outfile.write(content)
+            print(f"wrote {file_name} to {self.workspace_path}")
+
+    async def get_input(self) -> tuple[str, str, str]:
+        """Get the dumps of the patches, the changed files and the definitions of the pull request."""
+        num_requests = get_num_requests()
+        with self.tracer.span("pr_fetch", backend=self.patch_backend) as attributes:
+            repo = await asyncio.to_thread(self.github.get_repo, self.repo_name)
+            pr = await asyncio.to_thread(repo.get_pull, self.pr_number)
+            files, base_blob_shas = await asyncio.gather(
+                asyncio.to_thread(get_pr_files, pr, None),
+                asyncio.to_thread(get_base_blob_shas, repo, pr.base.sha),
+            )
+            # the file dump is fetched at the same time as the patches, cf. its own span
+            patches_str, changed_files_str = await asyncio.gather(
+                self._get_patches_str(repo, pr, files, base_blob_shas),
+                self._trace_file_dump(repo, files, base_blob_shas),
+            )
+            attributes.update(files=len(files), bytes=len(patches_str))
+            attributes["github_requests"] = get_num_requests() - num_requests
+
+        definitions_str = ""
+        if self.symbol_context_tokens > 0:
+            with self.tracer.span("definitions") as attributes:
+                # imported here, as the index is only needed if enabled
+                from symbol_index import SymbolIndex, get_definitions_str
+
+                symbol_index = await asyncio.to_thread(SymbolIndex)
+                definitions_str = get_definitions_str(symbol_index, patches_str, self.symbol_context_tokens)
+                symbol_index.cache.evict()
+                attributes.update(indexed_files=len(symbol_index.files), parsed_files=symbol_index.num_parsed)
+                attributes["bytes"] = len(definitions_str)
+
+        self._write_side_output("patches.txt", patches_str)
+        self._write_side_output("changed_files.txt", changed_files_str)
+        return patches_str, changed_files_str, definitions_str
+
+    async def run(self) -> None:
+        """Fetch the input of the review, and run the review."""
+        bot = CodeReviewBot(anthropic_client=self.anthropic_client, tracer=self.tracer)
+        try:
+            patches_str, changed_files_str, definitions_str = await self.get_input()
+            await asyncio.to_thread(
+                bot.process_pull_request,
+                changed_files_str,
+                patches_str,
+                self.repo_name,
+                self.pr_number,
+                definitions_str,
+            )
+        finally:
+            self.tracer.write()
+
+        self.cache.evict()
+        self.cache.print_stats()
+
+
+if __name__ == "__main__":
+    pipeline = ReviewPipeline(os.environ["GITHUB_REPOSITORY"], int(os.environ["GITHUB_EVENT_NUMBER"]))
+    asyncio.run(pipeline.run())
@@ -0,0 +1,81 @@
+"""Split the review input of large pull requests into shards that fit into a token budget.
+
+The input consists of the dump of the changed files (cf. `files_to_string.py`) and the dump of the patches
+(cf. `pr_to_string.py`). Both are split along their START/END markers, and each file is put into the same shard
+as its patch, so that every shard can be reviewed on its own.
+"""
+
+import re
+from collections.abc import Callable
+
+CHARS_PER_TOKEN = 4  # rough estimate for code, good enough for budgeting
+
+FILE_SECTION_PATTERN = re.compile(
+    r"^START FILE '(.*?)' >>>>>>>>>>>>>>>>\n.*?\n<<<<<<<<<<<<<<<< END FILE '\1'$",
+    re.MULTILINE | re.DOTALL,
+)
+PATCH_SECTION_PATTERN = re.compile(
+    r"^START PATCH FOR FILE: '(.*?)' >>>>>>>>>>>>>>>>\n.*?\n<<<<<<<<<<<<<<<< END PATCH FOR FILE: '\1'$",
+    re.MULTILINE | re.DOTALL,
+)
+SECTION_SEPARATOR = "\n\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class Sections:
+    """The sections of a dump by file name, together with the text before and after them."""
+
+    def __init__(self, text: str, pattern: re.Pattern):
+        matches = list(pattern.finditer(text))
+        self.by_file_name = {match.group(1): match.group(0) for match in matches}
+        self.prefix = text[: matches[0].start()] if matches else text
+        self.suffix = text[matches[-1].end() :] if matches else ""
+
+    def join(self, file_names: list[str]) -> str:
+        """Get a dump containing only the sections of the given files."""
+        sections = [self.by_file_name[name] for name in file_names if name in self.by_file_name]
+        return self.prefix + SECTION_SEPARATOR.join(sections) + self.suffix
+
+
+def build_shards(
+    changed_files_str: str,
+    patches_str: str,
+    token_budget: int,
+    estimate: Callable[[str], int] = estimate_tokens,
+) -> list[tuple[str, str]]:
+    """Split the changed files and patches into shards of at most `token_budget` tokens.
+
+    The files are packed in the order of the patches. A file whose patch and content exceed the budget
+    on their own gets a shard of its own. The size of the shards is measured with `estimate`, which needs to be
+    the estimator the budget was chosen with (e.g. `TokenEstimator.estimate`).
+    Returns a list of (changed_files_str, patches_str) tuples.
+    """
+    files = Sections(changed_files_str, FILE_SECTION_PATTERN)
+    patches = Sections(patches_str, PATCH_SECTION_PATTERN)
+
+    if not patches.by_file_name:
+        return [(changed_files_str, patches_str)]
+
+    file_names = list(patches.by_file_name) + [
+        name for name in files.by_file_name if name not in patches.by_file_name
+    ]
+
+    # the text around the sections is part of every shard
+    shard_overhead = estimate(files.prefix + files.suffix + patches.prefix + patches.suffix)
+    shards: list[list[str]] = [[]]
+    shard_tokens = shard_overhead
+    for name in file_names:
+        tokens = estimate(patches.by_file_name.get(name, "") + SECTION_SEPARATOR) + estimate(
+            files.by_file_name.get(name, "") + SECTION_SEPARATOR
+        )
+        if shards[-1] and shard_tokens + tokens > token_budget:
+            shards.append([])
+            shard_tokens = shard_overhead
+        shards[-1].append(name)
+        shard_tokens += tokens
+
+    return [(files.join(names), patches.join(names)) for names in shards]
@@ -0,0 +1,259 @@
+"""Add the definitions of symbols used in the changes of a pull request, from other files of the repository.
+
+An index of the Python files of the checked-out repository is built with `ast`: the definitions (functions,
+classes, module-level assignments), the referenced names and the imports of each file. The index is stored
+per git blob SHA in the cache, so only files that changed since the last run are parsed again.
+
+The names on the changed lines of the patches are looked up in the index, and the definitions from files
+that are not part of the pull request are dumped, those imported by the changed files first and then by the
+number of uses, until the token budget is reached. Definitions that do not fit are reduced to their signature.
+
+Required arguments:
+- path of the dump of the patches (cf. `pr_to_string.py`)
+- path of the output file
+
+Optional environment:
+- SYMBOL_CONTEXT_TOKENS: Token budget of the definitions (default: 4000).
+- CODE_REVIEW_CACHE_DIR, CODE_REVIEW_CACHE_MAX_MB: Configuration of the cache, cf. `blob_cache.py`.
+    The index is stored in the 'symbols' subdirectory.
+- CODE_REVIEW_TRACE_PATH: Trace file to add the duration of the lookup to, cf. `tracing.py`.
+"""
+
+import ast
+import builtins
+import json
+import keyword
+import os
+import re
+import sys
+from collections import Counter
+
+from blob_cache import CACHE_DIR, BlobCache, get_blob_shas
+from sharding import PATCH_SECTION_PATTERN, Sections, estimate_tokens
+from tracing import Tracer
+
+TOKEN_BUDGET = int(os.environ.get("SYMBOL_CONTEXT_TOKENS", 4000))
+INDEX_VERSION = 1  # to be increased when the format of the index changes
+
+# names defined more often than this are too ambiguous to add their definitions
+MAX_DEFINITIONS_PER_NAME = 3
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+IGNORED_NAMES = set(keyword.kwlist) | set(dir(builtins)) | {"self", "cls"}
+
+DEFINITIONS_HEADER = "Definitions of symbols used in the changes, from other files of the repository:\n\n"
+
+
+def _get_definitions(nodes: list[ast.stmt], prefix: str = "") -> list[dict]:
+    """Get the functions and classes (including methods) and the module-level assignments in `nodes`."""
+    definitions = []
+    for node in nodes:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            definitions.append(
+                {
+                    "name": node.name,
+                    "qualname": prefix + node.name,
+                    "start": start,
+                    "end": node.end_lineno,
+                    "signature_end": max(node.body[0].lineno - 1, node.lineno),
+                }
+            )
+            if isinstance(node, ast.ClassDef):
+                definitions.extend(_get_definitions(node.body, f"{prefix}{node.name}."))
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)) and not prefix:
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    definitions.append(
+                        {
+                            "name": target.id,
+                            "qualname": target.id,
+                            "start": node.lineno,
+                            "end": node.end_lineno,
+                            "signature_end": node.end_lineno,
+                        }
+                    )
+    return definitions
+
+
+def index_source(source: str) -> dict:
+    """Get the definitions, references and imports of Python source code.
+
+    Returns an empty index if the source cannot be parsed.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return {"definitions": [], "references": [], "imports": []}
+
+    references = set()
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            references.add(node.id)
+        elif isinstance(node, ast.Attribute):
+            references.add(node.attr)
+        elif isinstance(node, ast.Import):
+            imports.extend({"module": alias.name, "name": None} for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            imports.extend({"module": node.module, "name": alias.name} for alias in node.names)
+
+    return {
+        "definitions": _get_definitions(tree.body),
+        "references": sorted(references),
+        "imports": imports,
+    }
+
+
+class SymbolIndex:
+    """Index of the Python files of a repository, cached by blob SHA."""
+
+    def __init__(self, repo_path: str = ".", cache: BlobCache | None = None):
+        self.repo_path = repo_path
+        self.cache = cache or BlobCache(os.path.join(CACHE_DIR, "symbols") if CACHE_DIR else None)
+        self.files: dict[str, dict] = {}  # index by path
+        self.num_parsed = 0
+
+        for path, blob_sha in get_blob_shas(repo_path).items():
+            if path.endswith(".py"):
+                self.files[path] = self._get_file_index(path, blob_sha)
+
+        self.definitions_by_name: dict[str, list[tuple[str, dict]]] = {}
+        for path, file_index in self.files.items():
+            for definition in file_index["definitions"]:
+                self.definitions_by_name.setdefault(definition["name"], []).append((path, definition))
+
+    def _get_file_index(self, path: str, blob_sha: str) -> dict:
+        def parse() -> bytes:
+            self.num_parsed += 1
+            return json.dumps(index_source(self.read_source(path))).encode()
+
+        # the version is part of the key, so that outdated entries are not used
+        return json.loads(self.cache.get_or_fetch(f"{blob_sha}-v{INDEX_VERSION}", parse))
+
+    def read_source(self, path: str) -> str:
+        try:
+            with open(os.path.join(self.repo_path, path), "rb") as infile:
+                return infile.read().decode().replace("\r\n", "\n").replace("\r", "\n")
+        except (OSError, UnicodeDecodeError):
+            return ""
+
+    def _resolve_module(self, module: str) -> str | None:
+        """Get the path of a module of the repository, also if it is in a source directory like 'src/'."""
+        for suffix in [module.replace(".", "/") + ".py", module.replace(".", "/") + "/__init__.py"]:
+            for path in self.files:
+                if path == suffix or path.endswith("/" + suffix):
+                    return path
+        return None
+
+    def get_imported(self, paths: list[str]) -> tuple[set[str], set[str]]:
+        """Get the modules (by path) and names imported by the given files."""
+        modules, names = set(), set()
+        for path in paths:
+            for edge in self.files.get(path, {}).get("imports", []):
+                if (module_path := self._resolve_module(edge["module"])) is not None:
+                    modules.add(module_path)
+                if edge["name"] is not None:
+                    names.add(edge["name"])
+        return modules, names
+
+
+def get_changed_names(patches_str: str) -> tuple[Counter, list[str]]:
+    """Count the names on the changed lines of the Python files in a dump of patches.
+
+    Returns the counts and the paths of the Python files (without leading './').
+    """
+    names = Counter()
+    paths = []
+    for file_name, patch in Sections(patches_str, PATCH_SECTION_PATTERN).by_file_name.items():
+        path = file_name[2:] if file_name.startswith("./") else file_name
+        if not path.endswith(".py"):
+            continue
+        paths.append(path)
+        for line in patch.split("\n")[1:-1]:  # without the START/END lines
+            if line.startswith(("+", "-")):
+                names.update(
+                    name for name in IDENTIFIER_PATTERN.findall(line[1:]) if name not in IGNORED_NAMES
+                )
+    return names, paths
+
+
+def _get_definition_section(path: str, definition: dict, source_lines: list[str], end: int) -> str:
+    code = "\n".join(source_lines[definition["start"] - 1 : end])
+    return (
+        f"START DEFINITION '{definition['qualname']}' IN './{path}' "
+        f"(lines {definition['start']}-{end}) >>>>>>>>>>>>>>>>\n"
+        f"{code}\n"
+        f"<<<<<<<<<<<<<<<< END DEFINITION '{definition['qualname']}'"
+    )
+
+
+def get_definitions_str(index: SymbolIndex, patches_str: str, token_budget: int = TOKEN_BUDGET) -> str:
+    """Dump the definitions of the names used in the changes, from files that are not part of the pull request."""
+    names, changed_paths = get_changed_names(patches_str)
+    imported_modules, imported_names = index.get_imported(changed_paths)
+
+    candidates = []
+    for name, count in names.items():
+        definitions = [
+            (path, definition)
+            for path, definition in index.definitions_by_name.get(name, [])
+            if path not in changed_paths
+        ]
+        if not definitions or len(definitions) > MAX_DEFINITIONS_PER_NAME:
+            continue
+        for path, definition in definitions:
+            is_imported = path in imported_modules or name in imported_names
+            candidates.append((not is_imported, -count, name, path, definition))
+
+    sections = []
+    remaining_tokens = token_budget - estimate_tokens(DEFINITIONS_HEADER)
+    source_lines_by_path = {}
+    added_ranges = []  # (path, start, end), e.g. a method is not added again if its class was added
+    for *_, path, definition in sorted(candidates, key=lambda candidate: candidate[:3]):
+        if any(
+            path == added_path and start <= definition["start"] and definition["end"] <= end
+            for added_path, start, end in added_ranges
+        ):
+            continue
+        if path not in source_lines_by_path:
+            source_lines_by_path[path] = index.read_source(path).split("\n")
+        source_lines = source_lines_by_path[path]
+
+        for end in [definition["end"], definition["signature_end"]]:
+            section = _get_definition_section(path, definition, source_lines, end)
+            if (tokens := estimate_tokens(section)) <= remaining_tokens:
+                sections.append(section)
+                added_ranges.append((path, definition["start"], end))
+                remaining_tokens -= tokens
+                break
+
+    print(
+        f"Added {len(sections)} of {len(candidates)} definitions of {len(names)} changed names "
+        f"within {token_budget} tokens"
+    )
+    return DEFINITIONS_HEADER + "\n\n".join(sections) if sections else ""
+
+
+if __name__ == "__main__":
+    patches_path = sys.argv[1]
+    output_path = sys.argv[2]
+
+    with open(patches_path) as infile:
+        patches_str = infile.read()
+
+    tracer = Tracer()
+    with tracer.span("definitions") as attributes:
+        symbol_index = SymbolIndex()
+        print(f"Indexed {len(symbol_index.files)} Python files, {symbol_index.num_parsed} of them parsed.")
+        definitions_str = get_definitions_str(symbol_index, patches_str)
+        attributes.update(indexed_files=len(symbol_index.files), parsed_files=symbol_index.num_parsed)
+        attributes["bytes"] = len(definitions_str)
+    tracer.write()
+
+    with open(output_path, "w") as outfile:
+        outfile.write(definitions_str)
+
+    symbol_index.cache.evict()
+    symbol_index.cache.print_stats()
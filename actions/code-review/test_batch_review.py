@@ -0,0 +1,237 @@
+import json
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from batch_review import BatchReviewer
+from benchmark import PR_NUMBER, REPO_NAME, FakeGitHub, FakeMessages, SyntheticPullRequest
+from code_review_bot import LAST_REVIEWED_SHA_MARKER
+from github_client import get_github
+
+
+class FakeBatchAPI:
+    """Local fake of the Message Batches API, used through `ANTHROPIC_BASE_URL`.
+
+    Each batch is `in_progress` when it is retrieved for the first time, and has ended afterwards.
+    The batches are listed in one page, the latest first.
+    The answers are created like by the fake client of `benchmark.py`.
+    """
+
+    def __init__(self):
+        self.batches = {}  # requests by ID
+        self._created_at = {}  # by ID
+        self._num_retrieved = {}  # by ID
+        self._messages = FakeMessages(latency=0, tokens_per_second=1, num_comments=2, comment_chars=40)
+        self._lock = threading.Lock()
+
+        fake_api = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake_api._handle(self, None)
+
+            def do_POST(self):
+                fake_api._handle(self, json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _get_batch_data(self, batch_id: str) -> dict:
+        num_requests = len(self.batches[batch_id])
+        ended = self._num_retrieved[batch_id] > 1
+        created_at = self._created_at[batch_id]
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else num_requests,
+                "succeeded": num_requests if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": created_at.isoformat(),
+            "expires_at": (created_at + timedelta(days=1)).isoformat(),
+            "ended_at": created_at.isoformat() if ended else None,
+            "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def _get_results(self, batch_id: str) -> str:
+        """Get the results of a batch in the JSON Lines format."""
+        return "\n".join(
+            json.dumps(
+                {
+                    "custom_id": request["custom_id"],
+                    "result": {
+                        "type": "succeeded",
+                        "message": self._messages._get_answer(request["params"]).model_dump(mode="json"),
+                    },
+                }
+            )
+            for request in self.batches[batch_id]
+        )
+
+    def _handle(self, handler: BaseHTTPRequestHandler, body: dict | None) -> None:
+        match = re.fullmatch(r"/v1/messages/batches(?:/(\w+))?(/results)?(?:\?.*)?", handler.path)
+        batch_id = match and match.group(1)
+        with self._lock:
+            if match and batch_id is None and body is not None:
+                batch_id = f"msgbatch_{len(self.batches)}"
+                self.batches[batch_id] = body["requests"]
+                self._created_at[batch_id] = datetime.now(timezone.utc)
+                self._num_retrieved[batch_id] = 0
+                content_type, text = "application/json", json.dumps(self._get_batch_data(batch_id))
+            elif match and batch_id is None:
+                batch_ids = list(reversed(self.batches))
+                data = {
+                    "data": [self._get_batch_data(batch_id) for batch_id in batch_ids],
+                    "has_more": False,
+                    "first_id": batch_ids[0] if batch_ids else None,
+                    "last_id": batch_ids[-1] if batch_ids else None,
+                }
+                content_type, text = "application/json", json.dumps(data)
+            elif batch_id in self.batches and not match.group(2):
+                self._num_retrieved[batch_id] += 1
+                content_type, text = "application/json", json.dumps(self._get_batch_data(batch_id))
+            elif batch_id in self.batches:
+                content_type, text = "application/binary", self._get_results(batch_id)
+            else:
+                handler.send_error(404)
+                return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(text.encode())))
+        handler.end_headers()
+        handler.wfile.write(text.encode())
+
+
+NUM_PULL_REQUESTS = 3
+
+
+@pytest.fixture
+def fake_apis(tmp_path, monkeypatch):
+    """Local fakes of the GitHub API, with three pull requests, and of the Message Batches API."""
+    prs = [
+        SyntheticPullRequest(str(tmp_path / f"repo_{i}"), 2, 20, no_patch_fraction=0.0, seed=i)
+        for i in range(NUM_PULL_REQUESTS)
+    ]
+    with FakeGitHub(prs, "", latency=0) as fake_github, FakeBatchAPI() as fake_batch_api:
+        monkeypatch.setenv("GITHUB_API_URL", fake_github.url)
+        monkeypatch.setenv("ANTHROPIC_BASE_URL", fake_batch_api.url)
+        monkeypatch.setenv("GITHUB_TOKEN", "test")
+        monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+        monkeypatch.setenv("CODE_REVIEW_PROMPT", "Review the following pull request.")
+        monkeypatch.setenv("CODE_REVIEW_SYSTEM_MESSAGE", "You are a code reviewer.")
+        monkeypatch.delenv("GITHUB_WORKSPACE_PATH", raising=False)
+        yield fake_github, fake_batch_api
+
+
+def _create_reviewer(state_path) -> BatchReviewer:
+    """A `BatchReviewer` with the real clients, without calibration records and without pauses between requests."""
+    github_client = get_github("test", seconds_between_requests=None, seconds_between_writes=None)
+    reviewer = BatchReviewer(str(state_path), github_client=github_client, poll_seconds=0.01)
+    reviewer.bot.token_estimator.calibration_path = None
+    return reviewer
+
+
+def _get_summaries(fake_github: FakeGitHub, number: int) -> list[str]:
+    """Get the summary comments posted to a pull request, for its current head commit."""
+    marker = LAST_REVIEWED_SHA_MARKER.format(sha=fake_github.prs[number].head_sha)
+    return [comment["body"] for comment in fake_github.issue_comments[number] if marker in comment["body"]]
+
+
+def test_resume_after_submit(fake_apis, tmp_path):
+    fake_github, fake_batch_api = fake_apis
+    state_path = tmp_path / "batch_review_state.json"
+
+    # interrupted after the batch was submitted
+    _create_reviewer(state_path).submit([REPO_NAME])
+    assert state_path.is_file()
+    assert all(comments == [] for comments in fake_github.issue_comments.values())
+    updated_number = PR_NUMBER + 1
+    fake_github.prs[updated_number].head_sha = "f" * 40
+
+    _create_reviewer(state_path).run([REPO_NAME])
+
+    assert len(fake_batch_api.batches) == 1
+    assert not state_path.exists()
+    for number in fake_github.prs:
+        if number == updated_number:
+            # the answer is about the previous head commit
+            assert fake_github.issue_comments[number] == []
+            assert fake_github.num_review_comments[number] == 0
+        else:
+            assert len(_get_summaries(fake_github, number)) == 1
+            assert fake_github.num_review_comments[number] > 0
+
+
+@pytest.mark.parametrize("is_created", [True, False])
+def test_resume_while_submitting(fake_apis, tmp_path, monkeypatch, is_created):
+    """Interrupted after the state was saved, but before the ID of the batch was saved."""
+    fake_github, fake_batch_api = fake_apis
+    state_path = tmp_path / "batch_review_state.json"
+    reviewer = _create_reviewer(state_path)
+    batches = reviewer.bot.anthropic_client.messages.batches
+    create = batches.create
+
+    def create_and_interrupt(**kwargs):
+        if is_created:
+            create(**kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(batches, "create", create_and_interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        reviewer.run([REPO_NAME])
+    assert len(fake_batch_api.batches) == (1 if is_created else 0)
+
+    _create_reviewer(state_path).run([REPO_NAME])
+
+    assert len(fake_batch_api.batches) == 1
+    assert not state_path.exists()
+    assert all(len(_get_summaries(fake_github, number)) == 1 for number in fake_github.prs)
+
+
+def test_resume_while_posting(fake_apis, tmp_path, monkeypatch):
+    fake_github, fake_batch_api = fake_apis
+    state_path = tmp_path / "batch_review_state.json"
+    reviewer = _create_reviewer(state_path)
+    finish_review = reviewer.bot.finish_review
+
+    def interrupt_after_first_review(pull_request, *args):
+        if any(fake_github.issue_comments.values()):
+            raise KeyboardInterrupt
+        finish_review(pull_request, *args)
+
+    monkeypatch.setattr(reviewer.bot, "finish_review", interrupt_after_first_review)
+    with pytest.raises(KeyboardInterrupt):
+        reviewer.run([REPO_NAME])
+    assert sum(len(_get_summaries(fake_github, number)) for number in fake_github.prs) == 1
+
+    _create_reviewer(state_path).run([REPO_NAME])
+
+    assert len(fake_batch_api.batches) == 1
+    assert not state_path.exists()
+    assert all(len(_get_summaries(fake_github, number)) == 1 for number in fake_github.prs)
+
+    # the pull requests that were reviewed are skipped, also with the empty state of a complete run
+    state_path.write_text("null")
+    _create_reviewer(state_path).run([REPO_NAME])
+
+    assert len(fake_batch_api.batches) == 1
+    assert all(len(_get_summaries(fake_github, number)) == 1 for number in fake_github.prs)
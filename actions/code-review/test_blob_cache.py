@@ -0,0 +1,33 @@
+import os
+
+from blob_cache import BlobCache, git_blob_sha
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path / "blobs"), max_mb=1)
+    contents = [bytes([i]) * 400 * 1024 for i in range(3)]
+    keys = [git_blob_sha(data) for data in contents]
+    for i, (key, data) in enumerate(zip(keys, contents)):
+        cache.put(key, data)
+        os.utime(cache._get_path(key), (i, i))
+    assert cache.get(keys[0]) == contents[0]  # now the most recently used
+
+    cache.evict()
+
+    assert [cache.get(key) is not None for key in keys] == [True, False, True]
+
+
+def test_evict_only_own_entries(tmp_path):
+    """Other caches and files in the cache directory are neither evicted nor counted."""
+    other_cache = BlobCache(str(tmp_path / "http"), max_mb=1)
+    other_cache.put("a" * 40, b"x" * 900 * 1024)
+    (tmp_path / "token_calibration.jsonl").write_bytes(b"x" * 900 * 1024)
+    cache = BlobCache(str(tmp_path / "blobs"), max_mb=1)
+    cache.put("b" * 40, b"x" * 900 * 1024)
+
+    cache.evict()
+    BlobCache(str(tmp_path), max_mb=0).evict()  # not even by a cache in the parent directory
+
+    assert cache.get("b" * 40) is not None
+    assert other_cache.get("a" * 40) is not None
+    assert (tmp_path / "token_calibration.jsonl").is_file()
@@ -0,0 +1,70 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from code_review_bot import LAST_REVIEWED_SHA_MARKER, MAX_TOKENS, SHARD_TOKENS
+from conftest import StubGitHub, StubPullRequest, create_dumps
+from token_estimator import get_input_limit
+
+
+def test_shards_stay_under_input_limit(bot, stub_anthropic):
+    """The shards chosen for a large pull request fit into the context window, also with a calibrated estimator."""
+    bot.token_estimator.chars_per_token = 3.0
+    names = [f"src/module_{i:02d}.py" for i in range(12)]
+    changed_files_str, patches_str = create_dumps(
+        {name: "x = 1  # a line of code\n" * 5000 for name in names},  # 120 kB each
+        {name: "@@ -1,1 +1,1 @@\n-x = 0\n+x = 1  # a line of code" for name in names},
+    )
+    config = {MAX_TOKENS: 20000}
+
+    changed_files_str, config, _ = bot._plan_request(changed_files_str, patches_str, "", config, "", False)
+    answers = bot.get_sharded_review_feedback(changed_files_str, patches_str, config)
+
+    assert int(config[SHARD_TOKENS]) < get_input_limit(20000)
+    assert len(answers) == len(stub_anthropic.messages.requests) > 2
+    for params in stub_anthropic.messages.requests:
+        assert bot.token_estimator.estimate_request(params) <= get_input_limit(20000)
+
+
+ITEM = {"change_id": 1, "file_name": "./a.py", "start_line": 2, "comment": "Check this.", "proposed_code": "y = 2"}
+A_PATCH = "@@ -1,2 +1,3 @@\n x = 1\n+y = 1\n z = 1"
+
+
+@pytest.mark.parametrize("config_lines", [["tool_use: true"], ["tool_use: true", "stream: true"], []])
+def test_tool_call_is_not_a_premature_stop(bot, stub_anthropic, stub_github, config_lines):
+    stub_anthropic.messages.get_answer = lambda params: json.dumps([ITEM])
+    pull_request = stub_github.pull_request = StubPullRequest("```code-review\n" + "\n".join(config_lines) + "\n```")
+    changed_files_str, patches_str = create_dumps({"a.py": "x = 1\ny = 1\nz = 1\n"}, {"a.py": A_PATCH})
+
+    bot.process_pull_request(changed_files_str, patches_str, "owner/repo", 1)
+
+    assert [comment["line"] for comment in pull_request.review_comments] == [2]
+    summary = pull_request.issue_comments[-1].body
+    assert "Premature stop" not in summary
+
+
+def test_streamed_line_comments_are_batched_into_one_review(bot, stub_anthropic, stub_github):
+    items = [{**ITEM, "change_id": i, "start_line": i} for i in [1, 2, 3]] + [{"change_id": -1, "comment": "Overall."}]
+    stub_anthropic.messages.get_answer = lambda params: json.dumps(items)
+    pull_request = stub_github.pull_request = StubPullRequest("```code-review\nstream: true\nbatch_comments: true\n```")
+    changed_files_str, patches_str = create_dumps({"a.py": "x = 1\ny = 1\nz = 1\n"}, {"a.py": A_PATCH})
+
+    bot.process_pull_request(changed_files_str, patches_str, "owner/repo", 1)
+
+    assert pull_request.review_comments == []
+    assert [[comment["line"] for comment in review["comments"]] for review in pull_request.reviews] == [[1, 2, 3]]
+    assert [comment.body for comment in pull_request.issue_comments[:-1]] == ["Overall."]
+
+
+@pytest.mark.parametrize("login, is_reviewed", [(StubGitHub.LOGIN, True), ("someone-else", False)])
+def test_last_reviewed_sha_only_from_own_comments(bot, stub_anthropic, stub_github, login, is_reviewed):
+    head_sha = "1" * 40
+    comment = SimpleNamespace(body=LAST_REVIEWED_SHA_MARKER.format(sha=head_sha), user=SimpleNamespace(login=login))
+    description = "```code-review\nincremental: true\n```"
+    pull_request = stub_github.pull_request = StubPullRequest(description, head_sha, [comment])
+    changed_files_str, patches_str = create_dumps({"a.py": "x = 1\ny = 1\nz = 1\n"}, {"a.py": A_PATCH})
+
+    assert bot.get_last_reviewed_sha(pull_request) == (head_sha if is_reviewed else None)
+    bot.process_pull_request(changed_files_str, patches_str, "owner/repo", 1)
+    assert len(stub_anthropic.messages.requests) == (0 if is_reviewed else 1)
@@ -0,0 +1,78 @@
+import pytest
+
+from conftest import create_dumps
+from diff_index import build_line_index, get_commentable_lines, snap_line
+
+
+@pytest.mark.parametrize(
+    "patch, expected_lines",
+    [
+        # added and context lines are commentable, removed lines do not exist on the RIGHT side
+        ("@@ -1,3 +1,3 @@\n a\n-b\n+B\n c", {1, 2, 3}),
+        ("@@ -10,2 +10,3 @@\n a\n+b\n c", {10, 11, 12}),
+        ("@@ -5,2 +4,0 @@\n-a\n-b", set()),
+        ("@@ -0,0 +1,2 @@\n+a\n+b", {1, 2}),
+        ("@@ -1 +1 @@\n-a\n+b", {1}),
+        # the marker of a missing newline is neither a line on the LEFT nor on the RIGHT side
+        ("@@ -1,2 +1,2 @@\n a\n-b\n\\ No newline at end of file\n+b\n\\ No newline at end of file", {1, 2}),
+        ("@@ -1,2 +1,3 @@\n a\n-b\n\\ No newline at end of file\n+b\n+c", {1, 2, 3}),
+        # several hunks, the lines between them are not commentable
+        ("@@ -1,2 +1,2 @@\n-a\n+A\n b\n@@ -20,2 +20,3 @@ def f():\n x\n+y\n z", {1, 2, 20, 21, 22}),
+        # text before the first hunk, e.g. no patch
+        ("Binary file or no patch available", set()),
+        ("", set()),
+    ],
+)
+def test_get_commentable_lines(patch, expected_lines):
+    assert get_commentable_lines(patch) == expected_lines
+
+
+LINE_INDEX = {"a.py": {10, 11, 12, 20}, "b.py": set()}
+
+
+@pytest.mark.parametrize(
+    "file_name, line, max_distance, expected_line",
+    [
+        ("a.py", 11, 10, 11),  # commentable
+        ("a.py", 5, 10, 10),  # closest
+        ("a.py", 15, 10, 12),
+        ("a.py", 16, 10, 12),  # tie between 12 and 20: the lower line
+        ("a.py", 17, 10, 20),
+        ("a.py", 30, 10, 20),  # at max_distance
+        ("a.py", 31, 10, None),  # beyond max_distance
+        ("a.py", 14, 1, None),
+        ("a.py", 14, 2, 12),
+        ("a.py", 13, 0, None),
+        ("b.py", 1, 10, None),  # no commentable lines
+        ("c.py", 1, 10, None),  # not in the index
+    ],
+)
+def test_snap_line(file_name, line, max_distance, expected_line):
+    assert snap_line(LINE_INDEX, file_name, line, max_distance) == expected_line
+
+
+def test_build_line_index():
+    notebook_patch = (
+        "@@ -1,4 +1,5 @@ [cell 1]\n"
+        " # %% [cell 1] code\n"
+        "-x = 1\n"
+        "+x = 2\n"
+        " # %% [cell 2] code\n"
+        "+y = 3\n"
+        " print(x)\n"
+        "@@ -9,2 +10,2 @@ [cell 4]\n"
+        "-z = 1\n"
+        "+z = 2\n"
+        " # %% [cell 5] markdown"
+    )
+    _, patches_str = create_dumps({}, {"src/a.py": "@@ -1,2 +1,2 @@\n-a\n+A\n b", "nb/analysis.ipynb": notebook_patch})
+
+    line_index = build_line_index(patches_str)
+
+    assert line_index == {
+        "src/a.py": {1, 2},
+        # notebooks: the cell of each line, from the hunk header and the cell headers within the hunk
+        "nb/analysis.ipynb": {1: 1, 2: 1, 3: 2, 4: 2, 5: 2, 10: 4, 11: 5},
+    }
+    # the lines of notebooks snap like the lines of other files
+    assert snap_line(line_index, "nb/analysis.ipynb", 8) == 10
@@ -0,0 +1,106 @@
+import io
+import json
+import subprocess
+
+import pytest
+
+from pr_to_string import NO_PATCH_AVAILABLE, write_git_patches
+from sharding import PATCH_SECTION_PATTERN
+
+
+def _git(repo_path, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@localhost", *args],
+        cwd=repo_path,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+
+
+def _notebook(*sources: str) -> str:
+    cells = [{"cell_type": "code", "metadata": {}, "outputs": [], "source": source} for source in sources]
+    return json.dumps({"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5})
+
+
+def _commit(repo_path, files: dict[str, str | bytes | None], message: str) -> str:
+    """Write (or with None, delete) the files and commit them. Returns the SHA of the commit."""
+    for name, content in files.items():
+        if content is None:
+            _git(repo_path, "rm", "--quiet", name)
+            continue
+        path = repo_path / name
+        path.write_bytes(content) if isinstance(content, bytes) else path.write_text(content, encoding="utf-8")
+        _git(repo_path, "add", name)
+    _git(repo_path, "commit", "--quiet", "-m", message)
+    return _git(repo_path, "rev-parse", "HEAD")
+
+
+def _get_sections(patches_str: str) -> dict[str, str]:
+    return {match.group(1): match.group(0) for match in PATCH_SECTION_PATTERN.finditer(patches_str)}
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A local repository with a pull request, and a base branch that moved on after the pull request branched off.
+
+    Returns the path, the base and head commit, and the changed files of the pull request.
+    """
+    _git(tmp_path, "init", "--quiet", "--initial-branch=main")
+    _commit(
+        tmp_path,
+        {
+            "deleted.py": "a = 1\nb = 2\n",
+            "analysis.ipynb": _notebook("x = 1\n", "print(x)\n"),
+            "image.bin": b"\x00\x01\x02",
+        },
+        "initial",
+    )
+    _git(tmp_path, "checkout", "--quiet", "-b", "feature")
+    changed_files = {
+        "my file.py": "with space\n",
+        'we"ird.py': "quoted\n",
+        "tab\tname.py": "quoted with escape\n",
+        "überprüfung.py": "unicode\n",
+        "deleted.py": None,
+        "image.bin": b"\x00\x01\x03",
+        "analysis.ipynb": _notebook("x = 2\n", "print(x)\n"),
+    }
+    head_sha = _commit(tmp_path, changed_files, "feature")
+    _git(tmp_path, "checkout", "--quiet", "main")
+    base_sha = _commit(tmp_path, {"analysis.ipynb": _notebook("x = 1\n", "print(x)\n", "more = 3\n")}, "moved on")
+    return tmp_path, base_sha, head_sha, list(changed_files)
+
+
+def test_write_git_patches(repo):
+    repo_path, base_sha, head_sha, changed_files = repo
+    outfile = io.StringIO()
+
+    write_git_patches(changed_files, base_sha, head_sha, outfile, str(repo_path))
+
+    patches = {name: section.split("\n")[1:-1] for name, section in _get_sections(outfile.getvalue()).items()}
+    assert sorted(patches) == sorted(f"./{name}" for name in changed_files)
+    assert patches["./my file.py"] == ["@@ -0,0 +1 @@", "+with space"]
+    assert patches['./we"ird.py'] == ["@@ -0,0 +1 @@", "+quoted"]
+    assert patches["./tab\tname.py"] == ["@@ -0,0 +1 @@", "+quoted with escape"]
+    assert patches["./überprüfung.py"] == ["@@ -0,0 +1 @@", "+unicode"]
+    assert patches["./deleted.py"] == ["@@ -1,2 +0,0 @@", "-a = 1", "-b = 2"]
+    assert patches["./image.bin"] == [NO_PATCH_AVAILABLE]
+    # against the merge base, so the cell added on the base branch afterwards is not shown as removed
+    assert patches["./analysis.ipynb"] == [
+        "@@ -1,4 +1,4 @@ [cell 1]",
+        " # %% [cell 1] code",
+        "-x = 1",
+        "+x = 2",
+        " # %% [cell 2] code",
+        " print(x)",
+    ]
+
+
+def test_write_git_patches_only_changed_files(repo):
+    repo_path, base_sha, head_sha, _ = repo
+    outfile = io.StringIO()
+
+    write_git_patches(["deleted.py"], base_sha, head_sha, outfile, str(repo_path))
+
+    assert list(_get_sections(outfile.getvalue())) == ["./deleted.py"]
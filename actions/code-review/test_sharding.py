@@ -0,0 +1,78 @@
+import json
+import re
+
+from conftest import StubPullRequest, create_dumps, get_request_text
+from sharding import FILE_SECTION_PATTERN, PATCH_SECTION_PATTERN, Sections, build_shards, estimate_tokens
+
+NAMES = ["a.py", "b.py", "c.py", "d.py"]
+PATCH = "@@ -1,1 +1,2 @@\n x = 1\n+y = 2"
+CONTENT = "x = 1\n" * 100
+
+
+def _get_file_names(shard: tuple[str, str]) -> tuple[list[str], list[str]]:
+    changed_files_str, patches_str = shard
+    return (
+        list(Sections(changed_files_str, FILE_SECTION_PATTERN).by_file_name),
+        list(Sections(patches_str, PATCH_SECTION_PATTERN).by_file_name),
+    )
+
+
+def test_build_shards_keeps_file_and_patch_together():
+    changed_files_str, patches_str = create_dumps(dict.fromkeys(NAMES, CONTENT), dict.fromkeys(NAMES, PATCH))
+
+    shards = build_shards(changed_files_str, patches_str, 400)
+
+    assert len(shards) > 1
+    for shard in shards:
+        file_names, patch_names = _get_file_names(shard)
+        assert file_names == patch_names
+    assert [name for shard in shards for name in _get_file_names(shard)[1]] == [f"./{name}" for name in NAMES]
+
+
+def test_build_shards_respects_budget():
+    changed_files_str, patches_str = create_dumps(dict.fromkeys(NAMES, CONTENT), dict.fromkeys(NAMES, PATCH))
+
+    for budget, estimate in [(400, estimate_tokens), (600, lambda text: len(text) // 2)]:
+        shards = build_shards(changed_files_str, patches_str, budget, estimate)
+
+        assert len(shards) > 1
+        for shard_files_str, shard_patches_str in shards:
+            assert estimate(shard_files_str) + estimate(shard_patches_str) <= budget
+
+
+def test_build_shards_oversized_file_gets_own_shard():
+    contents = {"small.py": "x = 1\n", "large.py": "x = 1\n" * 1000, "other.py": "x = 1\n"}
+    changed_files_str, patches_str = create_dumps(contents, dict.fromkeys(contents, PATCH))
+
+    shards = build_shards(changed_files_str, patches_str, 200)
+
+    assert [_get_file_names(shard)[1] for shard in shards] == [["./small.py"], ["./large.py"], ["./other.py"]]
+
+
+def test_build_shards_without_patches():
+    assert build_shards("some text", "no patches", 1) == [("some text", "no patches")]
+
+
+def test_sharded_answers_are_merged(bot, stub_anthropic, stub_github):
+    def get_answer(params: dict) -> str:
+        """Comment on each file of the shard, except that the shard with 'd.py' answers with invalid JSON."""
+        file_names = re.findall(r"START PATCH FOR FILE: '\./(.*?)'", get_request_text(params))
+        if "d.py" in file_names:
+            return "Not JSON"
+        return json.dumps(
+            [{"change_id": 1, "file_name": f"./{name}", "start_line": 2, "comment": name} for name in file_names]
+        )
+
+    stub_anthropic.messages.get_answer = get_answer
+    description = "```code-review\nshard_tokens: 300\nmax_tokens: 4096\n```"
+    pull_request = stub_github.pull_request = StubPullRequest(description)
+    changed_files_str, patches_str = create_dumps(dict.fromkeys(NAMES, CONTENT), dict.fromkeys(NAMES, PATCH))
+
+    bot.process_pull_request(changed_files_str, patches_str, "owner/repo", 1)
+
+    num_shards = len(stub_anthropic.messages.requests)
+    assert num_shards > 1
+    assert sorted(comment["path"] for comment in pull_request.review_comments) == ["a.py", "b.py", "c.py"]
+    issue_comments = [comment.body for comment in pull_request.issue_comments]
+    assert "Not JSON" in issue_comments[0]  # the invalid answer is posted as it is
+    assert f"Reviewed in {num_shards} shards." in issue_comments[-1]
@@ -0,0 +1,102 @@
+"""Estimate the number of input tokens of a request before it is sent, to choose budgets that fit the input.
+
+The estimate is based on the number of characters per token, which is calibrated with the actual token counts
+of earlier requests, as reported by the API. These are recorded together with the estimates, so the accuracy
+of the estimator can be checked.
+
+Optional environment:
+- CODE_REVIEW_CACHE_DIR: The estimated and actual counts are recorded in 'token_calibration.jsonl' in this
+    directory (cf. `blob_cache.py`). If not set, they are only printed.
+"""
+
+import json
+import math
+import os
+import threading
+
+from blob_cache import CACHE_DIR
+from sharding import CHARS_PER_TOKEN
+
+CALIBRATION_FILE_NAME = "token_calibration.jsonl"
+NUM_CALIBRATION_RECORDS = 50  # the most recent records are used for calibration
+MAX_CALIBRATION_RECORDS = 1000  # older records are removed from the file
+
+# https://docs.anthropic.com/en/docs/about-claude/models/all-models#model-comparison-table
+CONTEXT_WINDOW_TOKENS = 200_000
+ESTIMATE_MARGIN = 1.15  # the estimate may be too low by this factor
+
+MIN_OUTPUT_TOKENS = 2048
+OUTPUT_TOKENS_PER_PATCH_TOKEN = 0.5  # for the comments and proposed code
+
+
+def get_output_budget(patches_tokens: int, upper_limit: int) -> int:
+    """Get a budget of output tokens for the review of patches of the given size, in multiples of 1024."""
+    budget = math.ceil(patches_tokens * OUTPUT_TOKENS_PER_PATCH_TOKEN / 1024) * 1024
+    return min(max(budget, MIN_OUTPUT_TOKENS), upper_limit)
+
+
+def get_input_limit(max_tokens: int) -> int:
+    """Get the maximum estimated number of input tokens of a request, so that input and output fit into the context."""
+    return int((CONTEXT_WINDOW_TOKENS - max_tokens) / ESTIMATE_MARGIN)
+
+
+class TokenEstimator:
+    """Estimate the number of tokens of texts and requests, calibrated with the records of earlier requests."""
+
+    def __init__(
+        self, calibration_path: str | None = os.path.join(CACHE_DIR, CALIBRATION_FILE_NAME) if CACHE_DIR else None
+    ):
+        self.calibration_path = calibration_path
+        self._lock = threading.Lock()  # records are added from the threads of sharded requests
+
+        records = self._read_records()[-NUM_CALIBRATION_RECORDS:]
+        num_chars = sum(record["num_chars"] for record in records)
+        actual_tokens = sum(record["actual_tokens"] for record in records)
+        self.chars_per_token = num_chars / actual_tokens if actual_tokens else CHARS_PER_TOKEN
+        print(f"Estimating tokens with {self.chars_per_token:.2f} characters per token from {len(records)} records")
+
+    def _read_records(self) -> list[dict]:
+        if self.calibration_path is None or not os.path.isfile(self.calibration_path):
+            return []
+        with open(self.calibration_path) as infile:
+            return [json.loads(line) for line in infile if line.strip()]
+
+    def estimate(self, text: str) -> int:
+        """Estimate the number of tokens of a text."""
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def get_request_chars(self, params: dict) -> int:
+        """Get the number of characters of the input of a request to the messages API."""
+        system = params.get("system", "")
+        texts = [system] if isinstance(system, str) else [block["text"] for block in system]
+        for message in params["messages"]:
+            content = message["content"]
+            texts.extend([content] if isinstance(content, str) else [block["text"] for block in content])
+        if "tools" in params:
+            texts.append(json.dumps(params["tools"]))
+        return sum(len(text) for text in texts)
+
+    def estimate_request(self, params: dict) -> int:
+        """Estimate the number of input tokens of a request to the messages API."""
+        return math.ceil(self.get_request_chars(params) / self.chars_per_token)
+
+    def record(self, params: dict, estimated_tokens: int, actual_tokens: int) -> None:
+        """Log the estimated and actual number of input tokens of a request, and record them for calibration."""
+        print(
+            f"Input tokens: estimated {estimated_tokens}, actual {actual_tokens} "
+            f"({(estimated_tokens - actual_tokens) / max(actual_tokens, 1):+.1%})"
+        )
+        if self.calibration_path is None:
+            return
+
+        record = {
+            "num_chars": self.get_request_chars(params),
+            "estimated_tokens": estimated_tokens,
+            "actual_tokens": actual_tokens,
+            "model": params.get("model"),
+        }
+        with self._lock:
+            records = self._read_records() + [record]
+            os.makedirs(os.path.dirname(self.calibration_path), exist_ok=True)
+            with open(self.calibration_path, "w") as outfile:
+                outfile.writelines(json.dumps(record) + "\n" for record in records[-MAX_CALIBRATION_RECORDS:])
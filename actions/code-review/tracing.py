@@ -0,0 +1,85 @@
+"""Record the duration of the stages of a review as spans, to diagnose slow runs after the fact.
+
+A span has a name, a start time, a duration and attributes like the number of bytes, tokens or API calls.
+The steps of the action run in separate processes, which add their spans to the same trace file.
+
+Stages (span names):
+- pr_fetch: Getting the metadata and the patches of the pull request (`pr_to_string.py`).
+- file_dump: Dumping the changed files (`files_to_string.py`).
+- definitions: Dumping the definitions of symbols used in the changes (`symbol_index.py`).
+- prompt_assembly: Instructions, trimming and budgets of the review (`CodeReviewBot.prepare_review()`).
+- first_token: Time from sending a streamed request to the first token of the answer.
+- model_request: Time from sending a request to the complete answer.
+- json_parse: Parsing and merging the answers.
+- comment_posting: Posting the review comments.
+
+Optional environment:
+- CODE_REVIEW_TRACE_PATH: Path of the trace file (JSON). If not set, the spans are only kept in memory.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+TRACE_PATH = os.environ.get("CODE_REVIEW_TRACE_PATH")
+
+
+class Tracer:
+    """Record spans, in addition to the spans of earlier steps in the trace file."""
+
+    def __init__(self, trace_path: str | None = TRACE_PATH):
+        self.trace_path = trace_path
+        self.previous_spans = self._read_spans()
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()  # spans are added from the threads of sharded requests
+
+    def _read_spans(self) -> list[dict]:
+        if self.trace_path is None or not os.path.isfile(self.trace_path):
+            return []
+        with open(self.trace_path) as infile:
+            return json.load(infile)["spans"]
+
+    def add_span(self, name: str, start_time: float, duration: float, **attributes) -> None:
+        """Add a span that started at `start_time` (seconds since the epoch) and took `duration` seconds."""
+        with self._lock:
+            self.spans.append(
+                {"name": name, "start_time": start_time, "duration_s": duration, "attributes": attributes}
+            )
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[dict]:
+        """Record the enclosed code as a span. The attributes can be completed in the yielded dict."""
+        start_time, start = time.time(), time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            self.add_span(name, start_time, time.perf_counter() - start, **attributes)
+
+    def write(self) -> None:
+        """Write the spans of earlier steps and of this process to the trace file."""
+        if self.trace_path is None:
+            return
+        with self._lock:
+            spans = self.previous_spans + self.spans
+        with open(self.trace_path, "w") as outfile:
+            json.dump({"spans": spans}, outfile, indent=1)
+        print(f"wrote {len(spans)} spans to {self.trace_path}")
+
+    def get_summary(self, since: float = 0.0) -> str:
+        """Get the total duration per stage, of the spans of earlier steps and the spans since `since`."""
+        totals = {}  # duration and number of spans by name, in the order of their first occurrence
+        with self._lock:
+            spans = self.previous_spans + [span for span in self.spans if span["start_time"] >= since]
+        for span in spans:
+            duration, count = totals.get(span["name"], (0.0, 0))
+            totals[span["name"]] = (duration + span["duration_s"], count + 1)
+        return "Stage timings: " + ", ".join(
+            f"{name} {duration:.1f}s" + (f" ({count}x)" if count > 1 else "")
+            for name, (duration, count) in totals.items()
+        )
@@ -0,0 +1,291 @@
+"""Clone the AlphaX projects, build their wheels in parallel along their dependency graph and install them.
+
+All selected projects are checked out concurrently, each only at the commit its version resolves to
+(cf. `ref_resolver.py`). Then, their dependencies to each other are removed from their
+requirements, so that the user-defined versions are used, and the dependencies of all projects and of the tests
+are resolved together (cf. `resolve_alphax.py`), so conflicts are reported before anything is built.
+
+The wheel of a project is built (without its dependencies) as soon as the wheels of the AlphaX projects it depends
+on are built, so independent projects like alphabase, alphatims and directlfq are built at the same time, and a
+failed project does not hold up unrelated ones. All wheels are then installed with the resolved dependencies in
+one `pip install`, without resolving them again. Finally, the time spent per project and the critical path (the
+chain of clones, resolution and builds that determined the total time) are printed.
+
+The wheels are cached by the commit of the project, the changes to its requirements (i.e. which of its AlphaX
+dependencies are replaced by checkouts) and the Python version. So only projects whose checked-out commit changed
+are built again, e.g. a release candidate of alphabase does not rebuild alphadia. Whether the wheel of each
+project was taken from the cache is part of the printed summary.
+
+Optional environment:
+- <PROJECT>_REF, e.g. ALPHABASE_REF: Version of a project: branch name, commit hash, 'latest' for the latest
+    release, or 'skip' to not install it. The defaults are given in `PROJECTS`.
+- BUILD_ALPHAX_MAX_WORKERS: Number of clones and builds run at the same time (default: number of CPUs).
+- BUILD_ALPHAX_LOG_DIR: Directory for the output of each clone and build (default: 'logs').
+- BUILD_ALPHAX_CACHE_DIR: Directory of the wheel cache (default: no cache).
+- BUILD_ALPHAX_URL: URL of the repositories, with '{project}' as placeholder for the name of the project
+    (default: 'https://github.com/MannLabs/{project}.git'), e.g. the path of local bare repositories for testing.
+- REF_RESOLVER_MIRROR_DIR: Directory of the mirrors of the repositories, cf. `ref_resolver.py`.
+
+Writes the resolved requirements to `requirements_1_resolved.txt` and the summary to `build_summary.txt`
+in the current directory.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from ref_resolver import check_out
+from resolve_alphax import read_resolved_requirements, resolve, strip_local_requirements
+
+MAX_WORKERS = int(os.environ.get("BUILD_ALPHAX_MAX_WORKERS", os.cpu_count() or 4))
+LOG_DIR = os.environ.get("BUILD_ALPHAX_LOG_DIR", "logs")
+CACHE_DIR = os.environ.get("BUILD_ALPHAX_CACHE_DIR")
+URL = os.environ.get("BUILD_ALPHAX_URL", "https://github.com/MannLabs/{project}.git")
+MAX_CACHED_WHEELS = 5  # per project, the least recently used ones are removed
+WHEEL_DIR = "wheels"
+RESOLVED_REQUIREMENTS_PATH = "requirements_1_resolved.txt"
+SUMMARY_PATH = "build_summary.txt"
+
+# additional dependencies for testing, resolved together with the projects
+TEST_REQUIREMENTS = ["pytest", "nbmake", "neptune"]
+
+REF_SKIP = "skip"
+
+# Add new AlphaX projects here. `dependencies` are the AlphaX projects a project depends on, `extras` are installed
+# with it, and `default_ref` is used if <PROJECT>_REF is not set. Base projects have no dependencies.
+PROJECTS = {
+    "alphabase": {"dependencies": [], "extras": "", "default_ref": "main"},
+    "alphatims": {"dependencies": [], "extras": "", "default_ref": "main"},
+    "directlfq": {"dependencies": [], "extras": "", "default_ref": "main"},
+    "alpharaw": {"dependencies": ["alphabase", "alphatims"], "extras": "[viz]", "default_ref": "main"},
+    "alphamap": {"dependencies": ["alphabase"], "extras": "", "default_ref": REF_SKIP},
+    "alphapeptdeep": {"dependencies": ["alphabase", "alpharaw"], "extras": "", "default_ref": "main"},
+    "alphaviz": {
+        "dependencies": ["alphabase", "alphatims", "alpharaw", "alphapeptdeep"],
+        "extras": "",
+        "default_ref": REF_SKIP,
+    },
+    "alphadia": {
+        "dependencies": ["alphabase", "alphatims", "alpharaw", "alphapeptdeep", "directlfq"],
+        "extras": "[stable]",
+        "default_ref": "main",
+    },
+}
+
+
+def get_ref(project: str) -> str:
+    """Get the user-defined version of a project."""
+    return os.environ.get(f"{project.upper()}_REF") or PROJECTS[project]["default_ref"]
+
+
+def _run(args: list[str], log_name: str, cwd: str | None = None) -> str:
+    """Run a command, appending its output to the log file of `log_name`. Returns the output."""
+    result = subprocess.run(args, cwd=cwd, capture_output=True, text=True)
+    with open(os.path.join(LOG_DIR, f"{log_name}.log"), "a") as logfile:
+        logfile.write(f"$ {' '.join(args)}\n{result.stdout}{result.stderr}\n")
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"'{' '.join(args)}' failed with exit code {result.returncode}:\n{result.stdout}{result.stderr}"
+        )
+    return result.stdout
+
+
+def clone(project: str) -> str:
+    """Check out the user-defined version of a project. Returns the SHA of the checked-out commit."""
+    commit = check_out(URL.format(project=project), get_ref(project), project)
+    print(f"{project}: checked out '{get_ref(project)}' ({commit})")
+    return commit
+
+
+def resolve_dependencies(projects: list[str]) -> None:
+    """Remove the dependencies of the projects to each other, and resolve the dependencies of all of them."""
+    strip_local_requirements(projects)
+    project_specs = [project + PROJECTS[project]["extras"] for project in projects]
+    resolve(project_specs, RESOLVED_REQUIREMENTS_PATH, TEST_REQUIREMENTS)
+
+
+def _get_cache_key(project: str) -> str:
+    """Get the key of the wheel of a project: its commit, the changes to its requirements and the Python version."""
+    commit = _run(["git", "rev-parse", "HEAD"], project, cwd=project).strip()
+    changes = _run(["git", "diff"], project, cwd=project)
+    return hashlib.sha256(f"{commit}\n{sys.implementation.cache_tag}\n{changes}".encode()).hexdigest()[:32]
+
+
+def _evict(project_cache_dir: str) -> None:
+    """Remove all but the most recently used wheels of a project from the cache."""
+    entries = sorted(
+        (os.path.join(project_cache_dir, key) for key in os.listdir(project_cache_dir)),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for entry in entries[MAX_CACHED_WHEELS:]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def build(project: str) -> tuple[str, bool]:
+    """Build the wheel of a project, without its dependencies, or take it from the cache.
+
+    Returns the path of the wheel, and whether it was taken from the cache.
+    """
+    wheel_dir = os.path.join(WHEEL_DIR, project)  # one per project, to find its wheel
+    cache_dir = os.path.join(CACHE_DIR, project, _get_cache_key(project)) if CACHE_DIR else None
+    if cache_dir and os.path.isdir(cache_dir):
+        shutil.copytree(cache_dir, wheel_dir)
+        os.utime(cache_dir)  # marks it as recently used
+        (wheel_name,) = os.listdir(wheel_dir)
+        return os.path.join(wheel_dir, wheel_name), True
+
+    _run([sys.executable, "-m", "pip", "wheel", "--no-deps", "--wheel-dir", wheel_dir, f"./{project}"], project)
+    (wheel_name,) = os.listdir(wheel_dir)
+
+    if cache_dir:
+        # moved into place at once, so an interrupted build does not leave an incomplete entry
+        temp_dir = f"{cache_dir}.tmp"
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.copytree(wheel_dir, temp_dir)
+        os.replace(temp_dir, cache_dir)
+        _evict(os.path.dirname(cache_dir))
+    return os.path.join(wheel_dir, wheel_name), False
+
+
+class DagRunner:
+    """Run tasks in parallel, each as soon as the tasks it depends on are done, and record their timings."""
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks: dict[str, tuple] = {}  # name -> (function, args, names of the tasks it depends on)
+        self.timings: dict[str, tuple[float, float]] = {}  # name -> (start, end), relative to the start of `run()`
+        self.results = {}
+        self.errors: dict[str, str] = {}
+
+    def add_task(self, name: str, function, args: tuple, dependencies: list[str]) -> None:
+        self.tasks[name] = (function, args, dependencies)
+
+    def _timed(self, name: str, start_time: float):
+        function, args, _ = self.tasks[name]
+        start = time.perf_counter() - start_time
+        try:
+            return function(*args)
+        finally:
+            self.timings[name] = (start, time.perf_counter() - start_time)
+
+    def run(self) -> None:
+        """Run all tasks. Tasks that depend on a failed task are not run, and recorded as failed."""
+        start_time = time.perf_counter()
+        pending = dict(self.tasks)
+        running: dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, (_, _, dependencies) in list(pending.items()):
+                    if failed := [dependency for dependency in dependencies if dependency in self.errors]:
+                        self.errors[name] = f"skipped, as {', '.join(failed)} failed"
+                        del pending[name]
+                    elif all(dependency in self.results for dependency in dependencies):
+                        running[executor.submit(self._timed, name, start_time)] = name
+                        del pending[name]
+
+                if not running:
+                    if pending:
+                        raise ValueError(f"Cannot run {list(pending)}, their dependencies are unknown")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if (error := future.exception()) is not None:
+                        print(f"{name} failed: {error}")
+                        self.errors[name] = str(error)
+                    else:
+                        print(f"{name} done after {self.timings[name][1]:.1f}s")
+                        self.results[name] = future.result()
+
+    def get_critical_path(self) -> list[str]:
+        """Get the chain of tasks that determined the total time, from the first to the last task.
+
+        Starting from the task that ended last, each task is preceded by the dependency that ended last.
+        """
+        if not self.timings:
+            return []
+        path = [max(self.timings, key=lambda name: self.timings[name][1])]
+        while dependencies := [dependency for dependency in self.tasks[path[-1]][2] if dependency in self.timings]:
+            path.append(max(dependencies, key=lambda name: self.timings[name][1]))
+        return path[::-1]
+
+
+def _print_report(runner: DagRunner, projects: list[str]) -> None:
+    """Print the summary of the build, and write it to `SUMMARY_PATH`."""
+    lines = [
+        f"{'project':<16}{'commit':>10}{'cache':>8}{'clone [s]':>10}{'build [s]':>10}{'start [s]':>10}{'end [s]':>10}"
+    ]
+    for project in projects:
+        commit = runner.results.get(f"clone {project}", "")[:7]
+        _, cache_hit = runner.results.get(f"build {project}", (None, None))
+        cache = {True: "hit", False: "miss", None: "-"}[cache_hit]
+        clone_start, clone_end = runner.timings.get(f"clone {project}", (0.0, 0.0))
+        build_start, build_end = runner.timings.get(f"build {project}", (clone_end, clone_end))
+        lines.append(
+            f"{project:<16}{commit:>10}{cache:>8}{clone_end - clone_start:>10.1f}{build_end - build_start:>10.1f}"
+            f"{clone_start:>10.1f}{build_end:>10.1f}"
+        )
+    if "resolve" in runner.timings:
+        resolve_start, resolve_end = runner.timings["resolve"]
+        lines.append(
+            f"{'resolution':<34}{resolve_end - resolve_start:>20.1f}{resolve_start:>10.1f}{resolve_end:>10.1f}"
+        )
+
+    cache_hits = [runner.results[f"build {project}"][1] for project in projects if f"build {project}" in runner.results]
+    lines.append(f"Build cache: {sum(cache_hits)} hits, {len(cache_hits) - sum(cache_hits)} misses")
+
+    critical_path = runner.get_critical_path()
+    total = runner.timings[critical_path[-1]][1] if critical_path else 0.0
+    waiting = total - sum(end - start for start, end in (runner.timings[name] for name in critical_path))
+    lines.append(
+        "Critical path: "
+        + " -> ".join(f"{name} {runner.timings[name][1] - runner.timings[name][0]:.1f}s" for name in critical_path)
+        + f" ({total:.1f}s in total, of which {waiting:.1f}s waiting for a worker)"
+    )
+
+    print("\n".join(lines))
+    with open(SUMMARY_PATH, "w") as outfile:
+        outfile.write("\n".join(lines) + "\n")
+
+
+def main() -> None:
+    projects = [project for project in PROJECTS if get_ref(project) != REF_SKIP]
+    print(f"Building {', '.join(f'{project}={get_ref(project)}' for project in projects)}")
+    os.makedirs(LOG_DIR, exist_ok=True)
+
+    runner = DagRunner()
+    runner.add_task("resolve", resolve_dependencies, (projects,), [f"clone {project}" for project in projects])
+    for project in projects:
+        # skipped projects are neither built nor waited for
+        dependencies = [
+            f"build {dependency}" for dependency in PROJECTS[project]["dependencies"] if dependency in projects
+        ]
+        runner.add_task(f"clone {project}", clone, (project,), [])
+        runner.add_task(f"build {project}", build, (project,), ["resolve", *dependencies])
+    runner.run()
+    _print_report(runner, projects)
+
+    if runner.errors:
+        for name, error in runner.errors.items():
+            print(f"{name} failed: {error}")
+        sys.exit(1)
+
+    # the dependencies were resolved already, including those of the extras
+    wheels = [runner.results[f"build {project}"][0] for project in projects]
+    requirements = read_resolved_requirements(RESOLVED_REQUIREMENTS_PATH)
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "pip", "install", "--no-deps", *requirements, *wheels], check=True)
+    print(
+        f"Installed {len(wheels)} wheels and {len(requirements)} dependencies "
+        f"in {time.perf_counter() - start_time:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
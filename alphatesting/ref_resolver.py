@@ -0,0 +1,168 @@
+"""Resolve the version of a project to a commit from its remote refs, and check out only this commit.
+
+The version is resolved from the refs of the remote (`git ls-remote`), without cloning the repository:
+- 'latest': the tag of the latest release, by semantic version (e.g. 'v1.10.0' is later than 'v1.9.2');
+    pre-releases are only used if there is no release.
+- a branch or tag name: the commit it points to.
+- a commit SHA: the commit itself. Abbreviated SHAs are expanded from the history of the remote, which is fetched
+    without file contents and trees for that.
+
+The commit is then fetched with depth 1. If a mirror directory is given, the commits are fetched into a bare
+mirror of the remote there, which is reused across runs: a commit that is already in the mirror is not fetched
+again, and the checkout is fetched from the mirror.
+
+Required arguments:
+- URL of the repository, e.g. 'https://github.com/MannLabs/alphabase.git' (local paths work as well)
+- version to check out
+- directory of the checkout (must not exist yet)
+
+Optional environment:
+- REF_RESOLVER_MIRROR_DIR: Directory of the bare mirrors (default: no mirrors).
+
+Returns
+-------
+- The SHA of the checked-out commit.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from packaging.version import InvalidVersion, Version
+
+MIRROR_DIR = os.environ.get("REF_RESOLVER_MIRROR_DIR")
+
+REF_LATEST = "latest"
+SHA_PATTERN = re.compile(r"^[0-9a-f]{4,40}$")
+FULL_SHA_LENGTH = 40
+
+# commits fetched into a mirror are kept under this prefix, so they can be fetched from it by name
+MIRROR_REF_PREFIX = "refs/alphax"
+
+
+def _git(args: list[str], cwd: str | None = None) -> str:
+    """Run a git command, returns its output. Raises RuntimeError if it fails."""
+    result = subprocess.run(["git", *args], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"'git {' '.join(args)}' failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+def list_remote_refs(url: str) -> dict[str, str]:
+    """Get the commits of the branches and tags of a remote, by names like 'heads/main' and 'tags/v1.0.0'."""
+    refs = {}
+    for line in _git(["ls-remote", "--heads", "--tags", url]).splitlines():
+        sha, name = line.split("\t")
+        name = name.removeprefix("refs/")
+        if name.endswith("^{}"):
+            # the commit an annotated tag points to, instead of the tag object
+            refs[name.removesuffix("^{}")] = sha
+        else:
+            refs.setdefault(name, sha)
+    return refs
+
+
+def _parse_version(tag: str) -> Version | None:
+    try:
+        return Version(tag)  # also accepts a 'v' prefix
+    except InvalidVersion:
+        return None
+
+
+def get_latest_tag(refs: dict[str, str]) -> str | None:
+    """Get the tag of the latest release by semantic version, or of the latest pre-release if there is no release."""
+    versions = {
+        tag: version
+        for name in refs
+        if name.startswith("tags/") and (version := _parse_version(tag := name.removeprefix("tags/"))) is not None
+    }
+    releases = [tag for tag, version in versions.items() if not version.is_prerelease] or list(versions)
+    return max(releases, key=versions.get, default=None)
+
+
+def resolve_ref(refs: dict[str, str], ref: str) -> str | None:
+    """Get the SHA of the commit of a version, given the refs of the remote.
+
+    Returns None for abbreviated SHAs, which cannot be resolved from the refs.
+    Raises ValueError if the version is not found.
+    """
+    if ref == REF_LATEST:
+        if (tag := get_latest_tag(refs)) is None:
+            raise ValueError("No release tags found")
+        print(f"Latest release is '{tag}'")
+        ref = tag
+
+    for name in [f"heads/{ref}", f"tags/{ref}"]:
+        if name in refs:
+            return refs[name]
+
+    if SHA_PATTERN.match(ref):
+        return ref if len(ref) == FULL_SHA_LENGTH else None
+    raise ValueError(f"'{ref}' is neither a branch, a tag nor a commit SHA")
+
+
+def expand_sha(url: str, abbreviated_sha: str) -> str:
+    """Get the full SHA of an abbreviated one, from the history of the remote (without trees and file contents)."""
+    with tempfile.TemporaryDirectory() as repo:
+        _git(["init", "--quiet", "--bare"], cwd=repo)
+        _git(["remote", "add", "origin", url], cwd=repo)
+        _git(["fetch", "--quiet", "--filter=tree:0", "--tags", "origin", "+refs/heads/*:refs/heads/*"], cwd=repo)
+        return _git(["rev-parse", f"{abbreviated_sha}^{{commit}}"], cwd=repo).strip()
+
+
+def _has_commit(repo: str, sha: str) -> bool:
+    result = subprocess.run(["git", "cat-file", "-e", f"{sha}^{{commit}}"], cwd=repo, capture_output=True)
+    return result.returncode == 0
+
+
+def _get_mirror(url: str, mirror_dir: str) -> str:
+    """Get the path of the bare mirror of a remote, created if it does not exist yet."""
+    name = re.sub(r"[^\w.-]", "_", url.rstrip("/").removesuffix(".git"))
+    mirror = os.path.join(mirror_dir, f"{name}.git")
+    if not os.path.isdir(mirror):
+        temp_mirror = f"{mirror}.tmp"
+        shutil.rmtree(temp_mirror, ignore_errors=True)
+        os.makedirs(temp_mirror)
+        _git(["init", "--quiet", "--bare"], cwd=temp_mirror)
+        os.replace(temp_mirror, mirror)
+    return mirror
+
+
+def _fetch_commit(repo: str, source: str, sha_or_ref: str) -> None:
+    # a local path as a file:// URL, as shallow fetches are not supported from local paths
+    source = f"file://{os.path.abspath(source)}" if os.path.isdir(source) else source
+    _git(["fetch", "--quiet", "--depth", "1", "--no-tags", source, sha_or_ref], cwd=repo)
+
+
+def check_out(url: str, ref: str, checkout_dir: str, mirror_dir: str | None = MIRROR_DIR) -> str:
+    """Check out a version of a repository with depth 1. Returns the SHA of the checked-out commit."""
+    if os.path.isdir(url):  # a local repository, e.g. for testing
+        url = os.path.abspath(url)
+    sha = resolve_ref(list_remote_refs(url), ref)
+    if sha is None:
+        sha = expand_sha(url, ref)
+    print(f"Resolved '{ref}' to {sha}")
+
+    source, source_ref = url, sha
+    if mirror_dir is not None:
+        mirror = _get_mirror(url, mirror_dir)
+        if _has_commit(mirror, sha):
+            print(f"Found {sha} in mirror '{mirror}'")
+        else:
+            _fetch_commit(mirror, url, sha)
+        source, source_ref = mirror, f"{MIRROR_REF_PREFIX}/{sha}"
+        _git(["update-ref", source_ref, sha], cwd=mirror)
+
+    os.makedirs(checkout_dir)
+    _git(["init", "--quiet"], cwd=checkout_dir)
+    _git(["remote", "add", "origin", url], cwd=checkout_dir)
+    _fetch_commit(checkout_dir, source, source_ref)
+    _git(["checkout", "--quiet", "--detach", sha], cwd=checkout_dir)
+    return sha
+
+
+if __name__ == "__main__":
+    print(check_out(sys.argv[1], sys.argv[2], sys.argv[3]))
@@ -0,0 +1,146 @@
+"""Resolve the dependencies of all AlphaX projects together, with the AlphaX projects taken from local checkouts.
+
+In the requirements files of each project, the requirements of AlphaX projects that are installed from a local
+checkout are commented out (with '### '), so the checked-out versions are used. The requirements are parsed,
+so only requirements of these exact distributions are matched, not e.g. other names they are part of.
+
+Then, the dependencies of all projects (with their extras) and of the tests are resolved with a single
+`uv pip compile`, in which each project is pinned to its checkout. A conflict between the requirements of any
+of the projects is reported before anything is built or installed.
+
+Required arguments:
+- path of the output file, e.g. 'requirements_1_resolved.txt'
+- checkouts of the AlphaX projects, with optional extras, e.g. 'alphabase alpharaw[viz] alphadia[stable]'
+
+Returns
+-------
+- The resolved requirements, with the AlphaX projects given by the paths of their checkouts.
+"""
+
+import glob
+import os
+import re
+import subprocess
+import sys
+import time
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+# distribution names of the AlphaX projects, by the names of their repositories
+DISTRIBUTIONS = {
+    "alphabase": "alphabase",
+    "alphatims": "alphatims",
+    "alpharaw": "alpharaw",
+    "alphaviz": "alphaviz",
+    "alphamap": "alphamap",
+    "alphapeptdeep": "peptdeep",
+    "directlfq": "directlfq",
+    "alphadia": "alphadia",
+}
+
+COMMENT_PREFIX = "### "
+EXTRAS_PATTERN = re.compile(r"^(?P<project>[^\[]+)(?P<extras>\[.*\])?$")
+
+
+def get_requirements_files(project_dir: str) -> list[str]:
+    """Get the requirements files of a project, in its root and in its 'requirements' folder."""
+    return sorted(
+        glob.glob(os.path.join(project_dir, "requirements*.txt"))
+        + glob.glob(os.path.join(project_dir, "requirements", "*.txt"))
+    )
+
+
+def _parse_requirement(line: str) -> Requirement | None:
+    """Parse a line of a requirements file, None for comments, options (e.g. '-r other.txt') and invalid lines."""
+    line = line.split(" #")[0].strip()
+    if not line or line.startswith(("#", "-")):
+        return None
+    try:
+        return Requirement(line)
+    except InvalidRequirement:
+        return None
+
+
+def strip_requirements(file_path: str, local_distributions: set[str]) -> list[str]:
+    """Comment out the requirements of local distributions in a requirements file. Returns the commented lines."""
+    with open(file_path) as infile:
+        lines = infile.readlines()
+
+    stripped = []
+    for i, line in enumerate(lines):
+        requirement = _parse_requirement(line)
+        if requirement is not None and canonicalize_name(requirement.name) in local_distributions:
+            stripped.append(line.strip())
+            lines[i] = COMMENT_PREFIX + line
+
+    if stripped:
+        with open(file_path, "w") as outfile:
+            outfile.writelines(lines)
+    return stripped
+
+
+def strip_local_requirements(project_dirs: list[str]) -> None:
+    """Comment out the requirements of the given AlphaX projects in the requirements files of each of them."""
+    local_distributions = {
+        DISTRIBUTIONS.get(os.path.basename(os.path.abspath(project_dir)), "") for project_dir in project_dirs
+    }
+    for project_dir in project_dirs:
+        for file_path in get_requirements_files(project_dir):
+            for line in strip_requirements(file_path, local_distributions):
+                print(f"{file_path}: replaced '{line}' by the local checkout")
+
+
+def resolve(project_specs: list[str], output_path: str, extra_requirements: list[str] = ()) -> None:
+    """Resolve the dependencies of local projects (given as 'path[extras]') and additional requirements together.
+
+    Raises RuntimeError with the explanation of the resolver if the requirements conflict.
+    """
+    input_path = f"{output_path}.in"
+    with open(input_path, "w") as outfile:
+        for project_spec in project_specs:
+            match = EXTRAS_PATTERN.match(project_spec)
+            outfile.write(f"{os.path.abspath(match.group('project'))}{match.group('extras') or ''}\n")
+        outfile.writelines(f"{requirement}\n" for requirement in extra_requirements)
+
+    # the metadata of local projects is cached by the modification time of their project files, not of the
+    # requirements files they read their dependencies from
+    refresh_args = []
+    for project_spec in project_specs:
+        project = os.path.basename(os.path.abspath(EXTRAS_PATTERN.match(project_spec).group("project")))
+        refresh_args += ["--refresh-package", DISTRIBUTIONS.get(project, project)]
+
+    start_time = time.perf_counter()
+    result = subprocess.run(
+        ["uv", "pip", "compile", input_path, "--output-file", output_path, "--python", sys.executable, *refresh_args],
+        capture_output=True,
+        text=True,
+    )
+    duration = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"Resolution failed after {duration:.1f}s:\n{result.stderr}")
+
+    num_packages = len(read_resolved_requirements(output_path))
+    print(
+        f"Resolved {num_packages} dependencies of {len(project_specs)} projects in {duration:.1f}s, "
+        f"written to '{output_path}'"
+    )
+
+
+def read_resolved_requirements(file_path: str) -> list[str]:
+    """Read the pinned requirements of a file written by `resolve()`, without the local projects."""
+    with open(file_path) as infile:
+        # the local projects are given by their paths
+        return [str(requirement) for line in infile if (requirement := _parse_requirement(line)) is not None]
+
+
+if __name__ == "__main__":
+    output_path = sys.argv[1]
+    project_specs = sys.argv[2:]
+
+    strip_local_requirements([EXTRAS_PATTERN.match(project_spec).group("project") for project_spec in project_specs])
+    try:
+        resolve(project_specs, output_path)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,204 @@
+"""Split the tests of a project into shards of about equal duration, and run them in parallel.
+
+The tests are collected with pytest, and the duration of each test is predicted from the timing history of the
+project: the mean of its durations in the last runs, taken from JUnit XML reports. Tests without history are
+predicted with the median duration. The tests are then assigned to the shards by longest predicted duration first,
+each to the shard with the lowest predicted total so far. The assignment is deterministic, so each of several
+containers can run its own shard with the same history.
+
+The predicted and actual duration of each shard are printed, and the durations of the tests run are added to the
+history.
+
+Usage (in the directory of the tests, e.g. 'alphadia/tests'):
+- `python shard_tests.py <project> --shards N [-- pytest arguments]`: run all N shards as parallel processes.
+- `python shard_tests.py <project> --shards N --shard I [-- pytest arguments]`: run only shard I (1 to N),
+    e.g. in one of N containers.
+- `python shard_tests.py <project> --update-history <JUnit XML files>`: only add the durations from the reports
+    to the history, e.g. to merge the reports of the shards run in separate containers.
+
+The pytest arguments select the tests, e.g. `-- -k 'not slow'`.
+
+Optional environment:
+- SHARD_TESTS_HISTORY_DIR: Directory of the timing history, one file per project (default: 'test_timings').
+- SHARD_TESTS_REPORT_DIR: Directory of the JUnit XML reports of the shards (default: 'test_reports').
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+from heapq import heapify, heapreplace
+
+HISTORY_DIR = os.environ.get("SHARD_TESTS_HISTORY_DIR", "test_timings")
+REPORT_DIR = os.environ.get("SHARD_TESTS_REPORT_DIR", "test_reports")
+
+MAX_HISTORY = 5  # durations kept per test, the prediction is their mean
+DEFAULT_DURATION = 1.0  # seconds, predicted for all tests if there is no history yet
+POLL_SECONDS = 0.5  # interval of checking whether the shards are done
+
+# node IDs relative to the current directory, and reports with the file of each test (cf. `_get_node_id()`)
+PYTEST_ARGS = ["--rootdir=.", "-o", "junit_family=xunit1"]
+
+
+def _get_history_path(project: str) -> str:
+    return os.path.join(HISTORY_DIR, f"{project}.json")
+
+
+def load_history(project: str) -> dict[str, list[float]]:
+    """Get the last durations of each test of a project, by node ID."""
+    if not os.path.isfile(path := _get_history_path(project)):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def save_history(project: str, history: dict[str, list[float]]) -> None:
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    temp_path = f"{_get_history_path(project)}.tmp"
+    with open(temp_path, "w") as outfile:
+        json.dump(history, outfile, indent=1, sort_keys=True)
+    os.replace(temp_path, _get_history_path(project))
+
+
+def _get_node_id(testcase: ElementTree.Element) -> str | None:
+    """Get the pytest node ID of a test case of a JUnit XML report (in the 'xunit1' format), e.g.
+    'unit_tests/test_a.py::TestB::test_c[1]' from file 'unit_tests/test_a.py', classname
+    'unit_tests.test_a.TestB' and name 'test_c[1]'.
+    """
+    if (file := testcase.get("file")) is None:
+        return None
+    num_path_parts = len(file.removesuffix(".py").split("/"))
+    class_names = testcase.get("classname", "").split(".")[num_path_parts:]
+    return "::".join([file, *class_names, testcase.get("name")])
+
+
+def read_durations(report_path: str) -> dict[str, float]:
+    """Get the duration of each test in a JUnit XML report, by node ID."""
+    durations = {}
+    for testcase in ElementTree.parse(report_path).iter("testcase"):
+        if (node_id := _get_node_id(testcase)) is not None:
+            durations[node_id] = float(testcase.get("time", 0.0))
+    return durations
+
+
+def update_history(project: str, report_paths: list[str]) -> None:
+    """Add the durations of the tests in the reports to the history of the project."""
+    history = load_history(project)
+    num_tests = 0
+    for report_path in report_paths:
+        if not os.path.isfile(report_path):  # e.g. a shard that did not run
+            print(f"Skipping missing report '{report_path}'")
+            continue
+        for node_id, duration in read_durations(report_path).items():
+            history[node_id] = (history.get(node_id, []) + [duration])[-MAX_HISTORY:]
+            num_tests += 1
+    save_history(project, history)
+    print(f"Added the durations of {num_tests} tests to '{_get_history_path(project)}'")
+
+
+def collect_tests(pytest_args: list[str]) -> list[str]:
+    """Get the node IDs of the tests selected by the pytest arguments, in the order of their collection."""
+    result = subprocess.run(
+        [sys.executable, "-m", "pytest", "--collect-only", "-q", *PYTEST_ARGS, *pytest_args],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Collecting the tests failed:\n{result.stdout}{result.stderr}")
+    return [line for line in result.stdout.splitlines() if "::" in line]
+
+
+def predict_durations(node_ids: list[str], history: dict[str, list[float]]) -> dict[str, float]:
+    """Predict the duration of each test from its history, the median of all predictions for tests without."""
+    predictions = {node_id: statistics.mean(history[node_id]) for node_id in node_ids if history.get(node_id)}
+    default = statistics.median(predictions.values()) if predictions else DEFAULT_DURATION
+    return {node_id: predictions.get(node_id, default) for node_id in node_ids}
+
+
+def split_into_shards(node_ids: list[str], predictions: dict[str, float], num_shards: int) -> list[list[str]]:
+    """Assign the tests to shards, the longest first, each to the shard with the lowest predicted total so far.
+
+    The tests in each shard keep their collection order, so fixtures shared by a module are set up once per shard.
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0.0, i) for i in range(num_shards)]  # heap of the predicted total and index of each shard
+    heapify(loads)
+    for node_id in sorted(node_ids, key=lambda node_id: (-predictions[node_id], node_id)):
+        load, i = loads[0]
+        shards[i].append(node_id)
+        heapreplace(loads, (load + predictions[node_id], i))
+
+    order = {node_id: position for position, node_id in enumerate(node_ids)}
+    return [sorted(shard, key=order.get) for shard in shards]
+
+
+def _start_shard(shard: list[str], number: int) -> tuple[subprocess.Popen, str, str]:
+    """Start the tests of a shard. Returns the process, the path of its report and of its output."""
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    report_path = os.path.join(REPORT_DIR, f"shard_{number}.xml")
+    log_path = os.path.join(REPORT_DIR, f"shard_{number}.log")
+    with open(log_path, "w") as logfile:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "pytest", *PYTEST_ARGS, f"--junitxml={report_path}", *shard],
+            stdout=logfile,
+            stderr=subprocess.STDOUT,
+        )
+    return process, report_path, log_path
+
+
+def run_shards(project: str, num_shards: int, shard_numbers: list[int], pytest_args: list[str]) -> bool:
+    """Run the given shards (numbered from 1) in parallel. Returns whether all tests passed."""
+    node_ids = collect_tests(pytest_args)
+    predictions = predict_durations(node_ids, load_history(project))
+    shards = split_into_shards(node_ids, predictions, num_shards)
+    print(f"Split {len(node_ids)} tests of {project} into {num_shards} shards")
+
+    running = {}
+    for number in shard_numbers:
+        if shards[number - 1]:
+            running[number] = (*_start_shard(shards[number - 1], number), time.perf_counter())
+
+    passed, actual, report_paths = True, {}, []
+    while len(actual) < len(running):
+        time.sleep(POLL_SECONDS)
+        for number, (process, report_path, log_path, start_time) in running.items():
+            if number in actual or (return_code := process.poll()) is None:
+                continue
+            actual[number] = time.perf_counter() - start_time
+            with open(log_path) as logfile:
+                print(f"{'=' * 30} shard {number} {'=' * 30}\n{logfile.read()}")
+            passed &= return_code == 0
+            if os.path.isfile(report_path):
+                report_paths.append(report_path)
+
+    print(f"{'shard':<8}{'tests':>8}{'predicted [s]':>16}{'actual [s]':>14}")
+    for number, shard in enumerate(shards, start=1):
+        predicted = sum(predictions[node_id] for node_id in shard)
+        actual_str = f"{actual[number]:.1f}" if number in actual else "-"
+        print(f"{number:<8}{len(shard):>8}{predicted:>16.1f}{actual_str:>14}")
+
+    update_history(project, report_paths)
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("project", help="name of the project, for its timing history")
+    parser.add_argument("--shards", type=int, default=1, help="number of shards")
+    parser.add_argument("--shard", type=int, help="number of the shard to run (1 to N), default: all")
+    parser.add_argument("--update-history", nargs="+", metavar="REPORT", help="JUnit XML reports to add")
+    # the pytest arguments are separated by '--', as they may look like arguments of this script
+    argv = sys.argv[1:]
+    pytest_args = argv[argv.index("--") + 1 :] if "--" in argv else []
+    args = parser.parse_args(argv[: argv.index("--")] if "--" in argv else argv)
+
+    if args.update_history:
+        update_history(args.project, args.update_history)
+        sys.exit(0)
+
+    shard_numbers = [args.shard] if args.shard else list(range(1, args.shards + 1))
+    sys.exit(0 if run_shards(args.project, args.shards, shard_numbers, pytest_args) else 1)
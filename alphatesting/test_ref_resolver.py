@@ -0,0 +1,160 @@
+import subprocess
+
+import pytest
+
+import ref_resolver
+from ref_resolver import MIRROR_REF_PREFIX, check_out, get_latest_tag, list_remote_refs
+
+
+def _git(repo_path, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@localhost", *args],
+        cwd=repo_path,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+
+
+def _commit(repo_path, message: str) -> str:
+    (repo_path / "version.txt").write_text(message)
+    _git(repo_path, "add", "version.txt")
+    _git(repo_path, "commit", "--quiet", "-m", message)
+    return _git(repo_path, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """A bare repository with a history on 'main' and 'feature', and release tags (some of them annotated).
+
+    Returns the path and the SHAs of the commits by name.
+    """
+    remote_path, work_path = tmp_path / "remote.git", tmp_path / "work"
+    remote_path.mkdir()
+    work_path.mkdir()
+    _git(remote_path, "init", "--quiet", "--bare", "--initial-branch=main")
+    _git(work_path, "init", "--quiet", "--initial-branch=main")
+
+    shas = {}
+    for name, tag in [
+        ("first", None),
+        ("1.9.2", "v1.9.2"),
+        ("1.10.0", "v1.10.0"),
+        ("1.11.0rc1", "v1.11.0rc1"),
+        ("untagged", None),
+        ("development", "not-a-version"),
+    ]:
+        shas[name] = _commit(work_path, name)
+        if tag is not None:
+            # annotated and lightweight tags
+            _git(work_path, "tag", *(["-a", "-m", tag] if tag in ["v1.10.0", "not-a-version"] else []), tag)
+    _git(work_path, "checkout", "--quiet", "-b", "feature", shas["1.9.2"])
+    shas["feature"] = _commit(work_path, "feature")
+
+    _git(work_path, "push", "--quiet", "--tags", str(remote_path), "main", "feature")
+    return remote_path, shas
+
+
+def test_list_remote_refs(remote):
+    remote_path, shas = remote
+
+    refs = list_remote_refs(str(remote_path))
+
+    assert refs == {
+        "heads/main": shas["development"],
+        "heads/feature": shas["feature"],
+        "tags/v1.9.2": shas["1.9.2"],
+        # the commits of annotated tags, not the tag objects
+        "tags/v1.10.0": shas["1.10.0"],
+        "tags/v1.11.0rc1": shas["1.11.0rc1"],
+        "tags/not-a-version": shas["development"],
+    }
+
+
+@pytest.mark.parametrize(
+    "tags, expected_tag",
+    [
+        (["v1.9.2", "v1.10.0", "v1.9.10"], "v1.10.0"),  # by semantic version, not alphabetically
+        (["1.2.0", "v1.10.0"], "v1.10.0"),  # with or without 'v' prefix
+        (["v1.10.0", "v1.11.0rc1", "v1.11.0.dev0"], "v1.10.0"),  # pre-releases only without releases
+        (["v1.11.0rc1", "v1.11.0rc2", "v1.11.0a1"], "v1.11.0rc2"),
+        (["v1.10.0", "nightly", "release-2"], "v1.10.0"),  # other tags are ignored
+        (["nightly"], None),
+        ([], None),
+    ],
+)
+def test_get_latest_tag(tags, expected_tag):
+    refs = {"heads/v9.0.0": "0" * 40, **{f"tags/{tag}": "1" * 40 for tag in tags}}  # the branch is ignored
+
+    assert get_latest_tag(refs) == expected_tag
+
+
+@pytest.mark.parametrize(
+    "ref, expected_name",
+    [
+        ("latest", "1.10.0"),
+        ("main", "development"),
+        ("feature", "feature"),
+        ("v1.9.2", "1.9.2"),
+        ("v1.10.0", "1.10.0"),  # annotated
+        ("{untagged}", "untagged"),
+        # not the tip of a branch, and abbreviated
+        ("{first}", "first"),
+        ("{first:.7}", "first"),
+        ("{untagged:.12}", "untagged"),
+    ],
+)
+def test_check_out(remote, tmp_path, ref, expected_name):
+    remote_path, shas = remote
+    checkout_path = tmp_path / "checkout"
+
+    sha = check_out(str(remote_path), ref.format(**shas), str(checkout_path), mirror_dir=None)
+
+    assert sha == shas[expected_name]
+    assert _git(checkout_path, "rev-parse", "HEAD") == sha
+    assert (checkout_path / "version.txt").read_text() == expected_name
+    # only the commit is fetched
+    assert _git(checkout_path, "rev-list", "--count", "HEAD") == "1"
+
+
+@pytest.mark.parametrize("ref, expected_error", [("no-such-branch", ValueError), ("abcdef1", RuntimeError)])
+def test_check_out_unknown_ref(remote, tmp_path, ref, expected_error):
+    remote_path, _ = remote
+
+    with pytest.raises(expected_error):
+        check_out(str(remote_path), ref, str(tmp_path / "checkout"), mirror_dir=None)
+
+
+def test_check_out_reuses_mirror(remote, tmp_path, monkeypatch):
+    remote_path, shas = remote
+    mirror_dir = tmp_path / "mirrors"
+    fetched = []  # source and ref of each fetch
+    fetch_commit = ref_resolver._fetch_commit
+
+    def record_fetch(repo: str, source: str, sha_or_ref: str) -> None:
+        fetched.append((source, sha_or_ref))
+        fetch_commit(repo, source, sha_or_ref)
+
+    monkeypatch.setattr(ref_resolver, "_fetch_commit", record_fetch)
+
+    sha = check_out(str(remote_path), "v1.9.2", str(tmp_path / "checkout_1"), mirror_dir=str(mirror_dir))
+    (mirror,) = mirror_dir.iterdir()
+    mirror_ref = f"{MIRROR_REF_PREFIX}/{sha}"
+    # fetched from the remote into the mirror, and from there into the checkout
+    assert fetched == [(str(remote_path), sha), (str(mirror), mirror_ref)]
+    assert _git(mirror, "rev-parse", mirror_ref) == sha == shas["1.9.2"]
+
+    fetched.clear()
+    assert check_out(str(remote_path), "v1.9.2", str(tmp_path / "checkout_2"), mirror_dir=str(mirror_dir)) == sha
+
+    # the commit is already in the mirror
+    assert fetched == [(str(mirror), mirror_ref)]
+    assert list(mirror_dir.iterdir()) == [mirror]
+    assert _git(tmp_path / "checkout_2", "rev-parse", "HEAD") == sha
+
+    fetched.clear()
+    other_sha = check_out(str(remote_path), "feature", str(tmp_path / "checkout_3"), mirror_dir=str(mirror_dir))
+
+    # another commit is fetched into the same mirror
+    assert fetched == [(str(remote_path), other_sha), (str(mirror), f"{MIRROR_REF_PREFIX}/{other_sha}")]
+    assert list(mirror_dir.iterdir()) == [mirror]